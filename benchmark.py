@@ -0,0 +1,242 @@
+#! env python
+"""Benchmark the scrape pipeline against a local stand-in server.
+
+The server generates full size pages matching the structure of the real site, so the benchmark runs offline and is
+repeatable. Results are written as json so runs can be compared between commits.
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Tuple
+from unittest import mock
+
+import myprotein
+import stub_server
+
+
+@contextlib.contextmanager
+def serve(catalog: stub_server.Catalog, latency: stub_server.Latency) -> Iterator[stub_server.StubServer]:
+    """Serve the catalog from a local stand-in server and point the scraper at it."""
+    server = stub_server.StubServer(('127.0.0.1', 0), catalog, latency)
+    stub_server.start_server(server)
+    # Generated categories, as if they were discovered
+    myprotein.get_catalog().update(
+        {
+            i: myprotein.ProductInformation(j.name, j.flavours[0].name, j.sizes[0].name, 0.0, j.default_product_id)
+            for i, j in catalog.categories.items()
+            if i not in myprotein.PRODUCT_INFORMATION
+        }
+    )
+    try:
+        with mock.patch.object(myprotein, 'BASE_URL', server.base_url):
+            yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def time_function(function: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Time function in seconds, clearing caches before every call."""
+    timings = []
+    for _ in range(repeat):
+        myprotein.clear_caches()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return {'min': min(timings), 'median': statistics.median(timings), 'max': max(timings)}
+
+
+def benchmark_functions(catalog: stub_server.Catalog, repeat: int) -> Dict[str, Dict[str, float]]:
+    """Time each parse function on rendered pages, and each fetch function against the local server without latency."""
+    category = next(iter(catalog.categories.values()))
+    flavour, size = category.flavours[1], category.sizes[1]
+    product_page = stub_server.render_product_page(category)
+    product_page_url = myprotein.product_page_url(category.product_category_id)
+    variations = stub_server.render_variations(category, category.default_product_id)
+    vouchers = stub_server.render_vouchers(10)
+
+    with serve(catalog, stub_server.Latency(0)):
+        # Warm up the shared session
+        myprotein.get_default_product_not_found(category.product_category_id)
+
+        return {
+            'find_child_id': time_function(lambda: myprotein.find_child_id(variations), repeat),
+            'find_ld_json': time_function(lambda: myprotein.find_ld_json(product_page), repeat),
+            'parse_product_page': time_function(
+                lambda: myprotein.parse_product_page(product_page_url, product_page), repeat
+            ),
+            'parse_vouchers': time_function(lambda: myprotein.parse_vouchers(vouchers), repeat),
+            'get_product_page': time_function(lambda: myprotein.get_product_page(category.product_category_id), repeat),
+            'get_default_product_not_found': time_function(
+                lambda: myprotein.get_default_product_not_found(category.product_category_id), repeat
+            ),
+            'resolve_options_to_product_id': time_function(
+                lambda: myprotein.resolve_options_to_product_id(category.product_category_id, flavour, size), repeat
+            ),
+            'fetch_vouchers': time_function(myprotein.fetch_vouchers, repeat),
+        }
+
+
+def benchmark_startup(repeat: int) -> Dict[str, Dict[str, float]]:
+    """Time commands that don't make requests, from starting the interpreter until they exit.
+
+    The module is run with -m, like shell completions should, so its bytecode is cached instead of compiled every run.
+    """
+    with tempfile.TemporaryDirectory() as history_dir:
+        commands = {
+            'interpreter': ['-c', 'pass'],
+            'list': ['-m', 'myprotein', '--list'],
+            'invalid_arguments': ['-m', 'myprotein', 'not_a_category'],
+            'lowest_prices': ['-m', 'myprotein', '--lowest', '7', '--history-dir', history_dir],
+        }
+        # Write the bytecode cache
+        subprocess.run([sys.executable, '-c', 'import myprotein'], check=True)
+
+        return {
+            name: time_function(
+                # Some commands are timed failing on purpose
+                functools.partial(
+                    subprocess.run,
+                    [sys.executable, *command],
+                    check=False,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                ),
+                repeat,
+            )
+            for name, command in commands.items()
+        }
+
+
+def benchmark_end_to_end(
+    catalog: stub_server.Catalog, workers: int, latency: stub_server.Latency, parse_workers: int = 0
+) -> Dict[str, float]:
+    """Scrape the whole catalog, measuring throughput and peak memory."""
+    myprotein.clear_caches()
+    myprotein.configure_session(workers)
+
+    # Silence progress bars and skipped variation messages
+    quiet = io.StringIO()
+    with serve(catalog, latency), contextlib.redirect_stderr(quiet), contextlib.redirect_stdout(quiet):
+        tracemalloc.start()
+        start = time.perf_counter()
+        product_information = asyncio.run(
+            myprotein.scrape_product_information(
+                list(catalog.categories), myprotein.ScrapeOptions(workers, workers, parse_workers=parse_workers)
+            )
+        )
+        elapsed = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'skus': len(product_information),
+        'seconds': elapsed,
+        'skus_per_second': len(product_information) / elapsed,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], check=True, stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_comparison(baseline: Dict[str, Any], results: Dict[str, Any]) -> None:
+    """Print how each measurement changed relative to the baseline run."""
+    rows: List[Tuple[str, float, float]] = [
+        (f'{name} median seconds', baseline['functions'][name]['median'], timings['median'])
+        for name, timings in results['functions'].items()
+        if name in baseline['functions']
+    ]
+    rows.extend(
+        (f'startup {name} median seconds', baseline['startup'][name]['median'], timings['median'])
+        for name, timings in results['startup'].items()
+        if name in baseline.get('startup', {})
+    )
+    rows.extend(
+        (f'end to end {name}', baseline['end_to_end'][name], value)
+        for name, value in results['end_to_end'].items()
+        if name in baseline['end_to_end']
+    )
+
+    print(f'Compared to {baseline["revision"]}:', file=sys.stderr)
+    for name, before, after in rows:
+        change = (after - before) / before * 100 if before else 0.0
+        print(f'{name:<50} {before:>14.6g} {after:>14.6g} {change:>+8.1f}%', file=sys.stderr)
+
+
+def parse_cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--categories',
+        help='Categories in the catalog (default: %(default)s)',
+        type=int,
+        default=len(myprotein.PRODUCT_INFORMATION),
+    )
+    parser.add_argument('--flavours', help='Flavours per category (default: %(default)s)', type=int, default=40)
+    parser.add_argument('--sizes', help='Sizes per category (default: %(default)s)', type=int, default=5)
+    parser.add_argument('--repeat', help='Repetitions per function (default: %(default)s)', type=int, default=20)
+    parser.add_argument('--workers', help='Concurrent requests (default: %(default)s)', type=int, default=15)
+    parser.add_argument(
+        '--parse-workers', help='Processes parsing product pages (default: %(default)s)', type=int, default=0
+    )
+    parser.add_argument(
+        '--latency', help='Median latency per request in seconds (default: %(default)s)', type=float, default=0.05
+    )
+    parser.add_argument(
+        '--latency-sigma', help='Spread of the lognormal latency (default: %(default)s)', type=float, default=0.5
+    )
+    parser.add_argument('-o', '--output', help='Json file to write results to (default: stdout)')
+    parser.add_argument('--baseline', help='Json results of an earlier run to compare against')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_cli()
+    catalog = stub_server.Catalog(args.categories, args.flavours, args.sizes)
+
+    results: Dict[str, Any] = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'parameters': vars(args),
+        'functions': benchmark_functions(catalog, args.repeat),
+        'startup': benchmark_startup(args.repeat),
+        'end_to_end': benchmark_end_to_end(
+            catalog, args.workers, stub_server.Latency(args.latency, args.latency_sigma), args.parse_workers
+        ),
+    }
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            print_comparison(json.load(baseline_file), results)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
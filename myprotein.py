@@ -1,37 +1,124 @@
 #! env python
+# Every command and its library counterpart are kept in this single module
+# pylint: disable=too-many-lines
+# Annotations aren't evaluated, so that lazily imported modules are only loaded once they're used
+from __future__ import annotations
+
 import argparse
-import concurrent.futures
+import array
+import atexit
+import bisect
+import collections
+import contextlib
+import csv
+import heapq
+import importlib.util
 import itertools
 import json
-import operator
+import math
+import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
 
 # pylint doesn't work correctly locally and in TravisCI env. This can be removed when isort releases updated version
 # noreorder pylint: disable=wrong-import-order
 from dataclasses import asdict
 from dataclasses import dataclass
+from dataclasses import fields
+from dataclasses import replace
 
 # noreorder pylint: enable=wrong-import-order
+import functools
 from functools import lru_cache
 
 # Disable wrong-import-order until isort is fixed to recognize dataclasses as standard
 # noreorder pylint: disable=wrong-import-order
 from typing import Any
+from typing import AsyncGenerator
+from typing import AsyncIterator
+from typing import Callable
 from typing import cast
+from typing import ContextManager
+from typing import Counter
 from typing import Dict
+from typing import FrozenSet
+from typing import Generic
+from typing import Hashable
 from typing import List
+from typing import Iterable
+from typing import Iterator
+from typing import Mapping
 from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import TextIO
 from typing import Tuple
-
-import addict
-import bs4
-import requests
-from tabulate import tabulate
-from tqdm import tqdm
+from typing import Type
+from typing import TYPE_CHECKING
+from typing import TypeVar
+from typing import Union
 
 # noreorder pylint: enable=wrong-import-order
 
+
+class LazyModule:  # pylint: disable=too-few-public-methods
+    """Stand-in for a module that is only imported once one of its attributes is used.
+
+    Unlike importlib.util.LazyLoader, it's safe to use from several threads at once, since the import itself is done by
+    import_module.
+    """
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._package = name.partition('.')[0]
+
+    def __getattr__(self, attribute: str) -> Any:
+        importlib.import_module(self._name)
+        return getattr(sys.modules[self._package], attribute)
+
+
+def lazy_import(name: str) -> Any:
+    """Import a module that is only loaded once one of its attributes is used. Like import, return the top package.
+
+    Most commands only need a few of the dependencies, and loading all of them takes longer than the commands that only
+    read the catalog or the caches.
+    """
+    if importlib.util.find_spec(name) is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    return LazyModule(name)
+
+
+if TYPE_CHECKING:
+    import asyncio
+    import concurrent.futures
+    import email.utils
+    import sqlite3
+
+    import bs4
+    import orjson
+    import requests
+    import tabulate
+    import tqdm
+    import urllib3
+else:
+    asyncio = lazy_import('asyncio')
+    concurrent = lazy_import('concurrent.futures')
+    email = lazy_import('email.utils')
+    sqlite3 = lazy_import('sqlite3')
+
+    bs4 = lazy_import('bs4')
+    # Optional, ld+json is parsed with json when it isn't installed
+    orjson = lazy_import('orjson') if importlib.util.find_spec('orjson') else None  # pylint: disable=invalid-name
+    requests = lazy_import('requests')
+    tabulate = lazy_import('tabulate')
+    tqdm = lazy_import('tqdm')
+    urllib3 = lazy_import('urllib3')
+
 JsonDict = Dict[str, Any]
-AddictDict = Any  # pylint: disable=invalid-name
+T = TypeVar('T')  # pylint: disable=invalid-name
 
 
 class Option(NamedTuple):
@@ -45,13 +132,145 @@ class ProductInformation:
     flavour: str
     size: str
     price: float
+    sku: str = ''
+    # Code of the region whose storefront priced the product, empty for the single site of --base-url
+    region: str = ''
+
+
+class OfferTable(Mapping[str, float]):
+    """Prices by sku, kept as sorted skus and an array of prices instead of a dict of float objects.
+
+    Skus are interned, since every fetch of a page has the same skus.
+    """
+
+    __slots__ = ('_skus', '_prices')
+
+    def __init__(self, offers: Iterable[Tuple[str, float]] = ()) -> None:
+        # Like a dict, a later offer for the same sku replaces the earlier one
+        by_sku = dict(offers)
+        self._skus = [sys.intern(i) for i in sorted(by_sku)]
+        self._prices = array.array('d', [by_sku[i] for i in self._skus])
+
+    def __getitem__(self, sku: str) -> float:
+        index = bisect.bisect_left(self._skus, sku)
+        if index == len(self._skus) or self._skus[index] != sku:
+            raise KeyError(sku)
+        return self._prices[index]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._skus)
+
+    def __len__(self) -> int:
+        return len(self._skus)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({dict(self)!r})'
+
+
+@dataclass
+class ProductPage:
+    url: str
+    flavours: List[Option]
+    sizes: List[Option]
+    # Mapping from product id to price, None if the page has no offers
+    price_data: Optional[Mapping[str, float]]
+    # Product name from the ld+json, None if the page doesn't have one
+    name: Optional[str] = None
+
+
+@dataclass
+class Voucher:
+    title: str
+    message: str
+    # None when the message doesn't name a code
+    code: Optional[str] = None
+    # None when the discount isn't a percentage
+    discount_percent: Optional[float] = None
+
+
+class VoucherRule(NamedTuple):
+    code: Optional[str]
+    percent_off: float
+    # Price a product has to reach for the voucher to apply, 0 if there is no threshold
+    min_spend: float
+    # Fragments of the category names the voucher is restricted to, None if it applies to everything
+    categories: Optional[FrozenSet[str]]
+
+    def applies_to(self, category: str) -> bool:
+        return self.categories is None or any(i in category for i in self.categories)
+
+
+class EffectivePrice(NamedTuple):
+    product: ProductInformation
+    effective_price: float
+    # Code of the best voucher, None if no voucher applies
+    voucher_code: Optional[str]
+
+    @property
+    def effective_price_per_kg(self) -> Optional[float]:
+        return price_per_kg(replace(self.product, price=self.effective_price))
+
+
+class RawProductPage(NamedTuple):
+    url: str
+    html: str
+    # Response to cache once the page is parsed, None if the page came from the cache
+    response: Optional[requests.Response]
+
+
+class CachedResponse(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    body: str
+
+
+class Size(NamedTuple):
+    # None when the size isn't a weight
+    grams: Optional[float]
+    # None when the size doesn't name the servings
+    servings: Optional[int]
+
+
+class Job(NamedTuple):
+    product_category_id: str
+    flavour: Option
+    size: Option
+    # Site of the region to resolve on, None for BASE_URL
+    base_url: Optional[str] = None
+
+
+class Region(NamedTuple):
+    code: str
+    base_url: str
+    currency: str
+
+
+class Resolution(NamedTuple):
+    job: Job
+    # Exactly one of product_id and error is set
+    product_id: Optional[str]
+    error: Optional[Exception]
+
+
+class PriceChange(NamedTuple):
+    product: ProductInformation
+    # None if the product wasn't seen before
+    old_price: Optional[float]
+
+
+class PriceLow(NamedTuple):
+    category: str
+    flavour: str
+    size: str
+    sku: str
+    lowest_price: float
+    current_price: float
 
 
 class ProductNotExistError(Exception):
     pass
 
 
-URL = 'http://us.myprotein.com/variations.json?productId={}'
 PRODUCT_INFORMATION = {
     # Whey
     '10852500': ProductInformation('impact_whey', 'Unflavored', '2.2 lb', 0.0),
@@ -64,7 +283,101 @@ PRODUCT_INFORMATION = {
     '10852411': ProductInformation('creapure', 'Unflavored', '1.1 lb', 0.0),
 }
 
-VOUCHER_URL = 'https://us.myprotein.com/voucher-codes.list'
+# Can be pointed at a local stand-in server for testing, see stub_server.py
+BASE_URL = os.environ.get('MYPROTEIN_BASE_URL', 'https://us.myprotein.com')
+REGIONS = {
+    i.code: i
+    for i in [
+        Region('us', 'https://us.myprotein.com', 'USD'),
+        Region('uk', 'https://www.myprotein.com', 'GBP'),
+        Region('eu', 'https://eu.myprotein.com', 'EUR'),
+        Region('ie', 'https://www.myprotein.ie', 'EUR'),
+        Region('ca', 'https://ca.myprotein.com', 'CAD'),
+        Region('au', 'https://au.myprotein.com', 'AUD'),
+    ]
+}
+# Approximate value of each currency in USD, to compare prices across regions. Override them with --rate.
+EXCHANGE_RATES = {'USD': 1.0, 'GBP': 1.27, 'EUR': 1.08, 'CAD': 0.73, 'AUD': 0.66}
+VOUCHER_PATH = '/voucher-codes.list'
+
+# Number of concurrent workers resolving product options. The connection pool is sized to match so that every worker
+# can keep its connection alive.
+MAX_WORKERS = 15
+# Number of concurrent requests allowed against a single host
+MAX_PER_HOST = MAX_WORKERS
+# Responses slower than this make the concurrency controller back off
+SLOW_RESPONSE_SECONDS = 5.0
+# Seconds to connect and to wait for a response, a stalled request fails with a Timeout that is retried
+REQUEST_TIMEOUT_SECONDS = (10.0, 30.0)
+# Attempts to resolve a variation when the site is throttling or failing
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 0.5
+# Seconds between polls in watch mode
+WATCH_INTERVAL = 60 * 60
+# Fetched product pages waiting for each parse worker, fetching pauses when the queue is full
+PARSE_QUEUE_PER_WORKER = 2
+
+# lxml is much faster than the builtin parser, use it when it's installed
+HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
+CHILD_ID_PATTERN = re.compile(r'''data-child-id\s*=\s*["']?([^"'\s>]+)''', re.IGNORECASE)
+# The flavour dropdown and size list on the product page
+OPTIONS_PATTERN = re.compile(
+    r'''<select[^>]*\bid\s*=\s*["']?athena-product-variation-dropdown-5\b.*?</select\s*>'''
+    r'''|<ul[^>]*\bclass\s*=\s*["'][^"']*\bathenaProductVariations_list\b.*?</ul\s*>''',
+    re.IGNORECASE | re.DOTALL,
+)
+# The dropdowns in variations markup, by variation id
+VARIATION_DROPDOWN_PATTERN = re.compile(
+    r'''<select[^>]*\bdata-variation-id\s*=\s*["']?(\d+)[^>]*>(.*?)</select\s*>''', re.IGNORECASE | re.DOTALL
+)
+VARIATION_OPTION_PATTERN = re.compile(r'''<option\b([^>]*)>''', re.IGNORECASE)
+OPTION_VALUE_PATTERN = re.compile(r'''\bvalue\s*=\s*["']?(\d+)''', re.IGNORECASE)
+OPTION_SELECTED_PATTERN = re.compile(r'\bselected\b', re.IGNORECASE)
+FLAVOUR_VARIATION_ID = '5'
+SIZE_VARIATION_ID = '7'
+LD_JSON_PATTERN = re.compile(
+    r'''<script[^>]*\btype\s*=\s*["']?application/ld\+json["']?[^>]*>(.*?)</script\s*>''', re.IGNORECASE | re.DOTALL
+)
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'myprotein')
+# Flavour and size resolutions rarely change, unlike prices
+SKU_CACHE_TTL_DAYS = 7.0
+RESPONSE_CACHE_MAX_MB = 50.0
+# Sizes like "2.2 lb", "2 x 2.5kg" or "1000g"
+SIZE_WEIGHT_PATTERN = re.compile(r'(?:(\d+)\s*x\s*)?(\d+(?:\.\d+)?)\s*(kg|g|lbs?|oz)\b', re.IGNORECASE)
+SIZE_SERVINGS_PATTERN = re.compile(
+    r'(\d+)\s*(?:servings?|tablets?|capsules?|softgels?|sachets?|bars?)\b', re.IGNORECASE
+)
+GRAMS_PER_UNIT = {'kg': 1000.0, 'g': 1.0, 'lb': 453.59237, 'lbs': 453.59237, 'oz': 28.349523125}
+# Vouchers change daily at most
+VOUCHER_CACHE_TTL_SECONDS = 60 * 60
+# Lookups shared by concurrent callers, prices go stale sooner than default products
+FETCH_CACHE_SIZE = 256
+PRODUCT_PAGE_TTL_SECONDS = 5 * 60
+DEFAULT_PRODUCT_TTL_SECONDS = 24 * 60 * 60
+VOUCHER_CODE_PATTERN = re.compile(r'\bcode\s*:?\s*([A-Z0-9]{3,})\b', re.IGNORECASE)
+DISCOUNT_PERCENT_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*%')
+MIN_SPEND_PATTERN = re.compile(
+    r'(?:over|above|spend(?:ing)?|orders? of|at least)\s+\$\s*(\d+(?:\.\d+)?)', re.IGNORECASE
+)
+# Words restricting a voucher to some categories, and the fragments of the category names they cover
+VOUCHER_CATEGORY_KEYWORDS = {
+    'whey': frozenset({'whey'}),
+    'protein': frozenset({'whey', 'iospro', 'impact_blend', 'protein'}),
+    'creatine': frozenset({'creatine', 'creapure'}),
+}
+DEFAULT_DATA_DIR = os.path.join(os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share')), 'myprotein')
+DEFAULT_HISTORY_DIR = os.path.join(DEFAULT_DATA_DIR, 'history')
+DEFAULT_CATALOG_PATH = os.path.join(DEFAULT_DATA_DIR, 'catalog.json')
+DEFAULT_CHECKPOINT_PATH = os.path.join(DEFAULT_DATA_DIR, 'checkpoint.jsonl')
+# Discovered categories, on top of PRODUCT_INFORMATION. None for the built in categories only
+CATALOG_PATH: Optional[str] = None
+
+_SESSION_LOCK = threading.Lock()
+_SESSION: Optional[requests.Session] = None
+# Connections kept alive per host by _SESSION
+_SESSION_POOL_SIZE = 0
+_SINGLE_FLIGHT_CACHES: List['SingleFlightCache[Any]'] = []
 
 
 def parse_cli() -> argparse.Namespace:  # pragma: no cover
@@ -72,196 +385,2378 @@ def parse_cli() -> argparse.Namespace:  # pragma: no cover
 
     parser.add_argument('--vouchers', help='Show current vouchers', action='store_true')
 
-    parser.add_argument('-l', '--list', help='List possible product categories to query', action='store_true')
+    parser.add_argument(
+        '--max-price-per-kg', help='Only show products costing at most this much per kg', type=float, metavar='PRICE'
+    )
+
+    parser.add_argument('--top', help='Only show the N products cheapest per kg, cheapest first', type=int, metavar='N')
 
-    all_product_categories = sorted(i.category for i in PRODUCT_INFORMATION.values())
+    parser.add_argument(
+        '--effective-prices',
+        help='Show the products ranked by their price with the best voucher that applies',
+        action='store_true',
+    )
 
-    def element_in_list(element: str) -> str:
-        if element not in all_product_categories:
-            raise KeyError(f'{element} is not in list. Use -l to see all possible values.')
+    parser.add_argument(
+        '-w', '--workers', help='Number of concurrent requests (default: %(default)s)', type=int, default=MAX_WORKERS
+    )
 
-        return element
+    parser.add_argument(
+        '--per-host',
+        help='Number of concurrent requests per host (default: %(default)s)',
+        type=int,
+        default=MAX_PER_HOST,
+    )
+
+    parser.add_argument(
+        '--parse-workers',
+        help='Processes parsing product pages, 0 to parse them in the fetching threads (default: %(default)s)',
+        type=int,
+        default=0,
+    )
 
     parser.add_argument(
-        'product_categories',
-        help='List of products to query %(default)s',
-        nargs='*',
-        default=all_product_categories,
-        type=element_in_list,
+        '--cache-dir', help='Directory for persistent caches (default: %(default)s)', default=DEFAULT_CACHE_DIR
     )
 
+    parser.add_argument(
+        '--sku-ttl',
+        help='Days before cached product ids are resolved again (default: %(default)s)',
+        type=float,
+        default=SKU_CACHE_TTL_DAYS,
+    )
+
+    parser.add_argument(
+        '--response-cache-mb',
+        help='Size of the cache of product pages, 0 to disable (default: %(default)s)',
+        type=float,
+        default=RESPONSE_CACHE_MAX_MB,
+    )
+
+    parser.add_argument('--refresh-skus', help='Ignore cached product ids and resolve them again', action='store_true')
+
+    parser.add_argument('--base-url', help=f'Site to query (default: {BASE_URL})')
+
+    parser.add_argument(
+        '--regions',
+        help='Query the storefronts of these regions together, instead of the single site of --base-url',
+        nargs='+',
+        choices=sorted(REGIONS),
+        metavar='REGION',
+    )
+
+    parser.add_argument(
+        '--currency',
+        help='Add a column of prices converted to this currency, to compare --regions',
+        type=str.upper,
+        choices=sorted(EXCHANGE_RATES),
+    )
+
+    parser.add_argument(
+        '--rate',
+        help='Value of one unit of a currency in USD, overriding the built in approximation, e.g. GBP=1.25',
+        action='append',
+        default=[],
+        metavar='CURRENCY=USD',
+    )
+
+    parser.add_argument(
+        '--watch', help='Keep running, polling prices and printing only the ones that changed', action='store_true'
+    )
+
+    parser.add_argument(
+        '--interval',
+        help='Seconds between polls in watch mode (default: %(default)s)',
+        type=float,
+        default=WATCH_INTERVAL,
+    )
+
+    parser.add_argument(
+        '--history-dir', help='Directory of the price history (default: %(default)s)', default=DEFAULT_HISTORY_DIR
+    )
+
+    parser.add_argument('--record-history', help='Append the prices to the price history', action='store_true')
+
+    parser.add_argument(
+        '--checkpoint',
+        help='Journal of finished variations, kept until a run finishes without failures (default: %(default)s)',
+        default=DEFAULT_CHECKPOINT_PATH,
+    )
+
+    parser.add_argument(
+        '--resume',
+        help='Skip the variations finished by the last run, according to the checkpoint',
+        action='store_true',
+    )
+
+    parser.add_argument(
+        '--lowest',
+        help='Print the lowest price of every product in the last DAYS days of price history and exit',
+        type=float,
+        metavar='DAYS',
+    )
+
+    parser.add_argument(
+        '--at-low',
+        help='Print the products currently at their lowest price in the last DAYS days of price history and exit',
+        type=float,
+        metavar='DAYS',
+    )
+
+    parser.add_argument(
+        '--format',
+        help='Output format, jsonl and csv print each product as soon as it is priced (default: %(default)s)',
+        choices=sorted(OUTPUT_FORMATS),
+        default='table',
+    )
+
+    parser.add_argument('-o', '--output', help='File to write the products to (default: stdout)')
+
+    parser.add_argument(
+        '--catalog', help='File of discovered product categories (default: %(default)s)', default=DEFAULT_CATALOG_PATH
+    )
+
+    parser.add_argument(
+        '--discover',
+        help='Add the product categories of these product ids to the catalog and exit',
+        nargs='+',
+        metavar='ID',
+    )
+
+    parser.add_argument(
+        '--profile',
+        help='Print the latency percentiles of every stage, requests per second and cache hits to stderr at the end',
+        action='store_true',
+    )
+
+    parser.add_argument(
+        '--profile-output', help='Write a Chrome trace of every request to this json file, implies --profile'
+    )
+
+    parser.add_argument('-l', '--list', help='List possible product categories to query', action='store_true')
+
+    parser.add_argument('product_categories', help='List of products to query (default: all)', nargs='*')
+
     args = parser.parse_args()
+    validate_args(parser, args)
+
+    if args.discover:
+        return args
 
+    catalog = load_catalog(args.catalog)
     if args.list:
-        parser.exit(message='\n'.join(all_product_categories))
+        parser.exit(message='\n'.join(catalog.names()))
+
+    unknown = [i for i in args.product_categories if i not in catalog]
+    if unknown:
+        parser.error(f'{", ".join(unknown)} not in catalog. Use -l to see all possible values.')
+
+    args.product_categories = args.product_categories or catalog.names()
 
     return args
 
 
+def validate_args(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:  # pragma: no cover
+    """Exit with the usage when options conflict, parse the exchange rates."""
+    if args.regions and args.base_url:
+        parser.error('--base-url and --regions are exclusive, every region has its own site.')
+    if args.currency and not args.regions:
+        parser.error('--currency converts the prices of --regions, the single site has no known currency.')
+    unsupported = [
+        name
+        for name, value in [
+            ('--watch', args.watch),
+            ('--vouchers', args.vouchers),
+            ('--effective-prices', args.effective_prices),
+            ('--record-history', args.record_history),
+        ]
+        if value
+    ]
+    if args.regions and unsupported:
+        parser.error(f'{", ".join(unsupported)} only support a single site, not --regions.')
+
+    try:
+        args.rates = {**EXCHANGE_RATES, **parse_rates(args.rate)}
+    except ValueError as exc:
+        parser.error(str(exc))
+
+
+def parse_rates(rates: Iterable[str]) -> Dict[str, float]:
+    """Parse CURRENCY=USD exchange rates."""
+    parsed = {}
+    for rate in rates:
+        currency, _, value = rate.partition('=')
+        try:
+            parsed[currency.strip().upper()] = float(value)
+        except ValueError:
+            raise ValueError(f'Invalid rate {rate!r}, expected CURRENCY=USD like GBP=1.25') from None
+    return parsed
+
+
+def create_session(pool_size: int = MAX_WORKERS, retries: int = 3, backoff_factor: float = 0.5) -> requests.Session:
+    """Create a keep-alive session with a connection pool of pool_size that retries failed connections with backoff.
+
+    Throttled and failed responses are returned for resolve_jobs and run_with_retries to retry, so that a failure is
+    retried once per attempt and resolve_jobs' AdaptiveLimiter sees every one of them. That includes throttled
+    responses with a Retry-After, which urllib3 would otherwise wait for in the worker thread.
+    """
+    retry = urllib3.Retry(total=retries, status=0, backoff_factor=backoff_factor, respect_retry_after_header=False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(pool_size: int = 0) -> requests.Session:
+    """Get the shared session, creating it on first use.
+
+    When its connection pool doesn't fit pool_size workers, it's replaced by a larger one. The replaced session isn't
+    closed, other queries may still be using it.
+    """
+    global _SESSION, _SESSION_POOL_SIZE  # pylint: disable=global-statement
+
+    with _SESSION_LOCK:
+        if _SESSION is None or _SESSION_POOL_SIZE < pool_size:
+            _SESSION_POOL_SIZE = max(pool_size, MAX_WORKERS)
+            _SESSION = create_session(_SESSION_POOL_SIZE)
+        return _SESSION
+
+
+def configure_session(pool_size: int) -> requests.Session:
+    """Replace the shared session with one whose connection pool fits pool_size workers."""
+    global _SESSION, _SESSION_POOL_SIZE  # pylint: disable=global-statement
+
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = create_session(pool_size)
+        _SESSION_POOL_SIZE = pool_size
+        return _SESSION
+
+
+class SingleFlightCache(Generic[T]):
+    """Cache of a function's results for ttl seconds, where concurrent calls with the same arguments share one call.
+
+    Unlike lru_cache, callers that miss the cache while the result is being fetched wait for it instead of fetching it
+    again. Errors are shared by the callers that waited for them, but not cached. At most maxsize results are kept,
+    evicting the least recently used one. With a ttl of 0, calls are only shared while they are in flight.
+    """
+
+    def __init__(self, function: Callable[..., T], maxsize: int = FETCH_CACHE_SIZE, ttl: float = 0.0) -> None:
+        self.function = function
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Result of every key, along with when it expires. In flight results never expire
+        self._results: 'collections.OrderedDict[Hashable, Tuple[concurrent.futures.Future[T], float]]'
+        self._results = collections.OrderedDict()
+        functools.update_wrapper(self, function)
+
+    def __call__(self, *args: Any, **kwargs: Any) -> T:
+        key = (args, tuple(sorted(kwargs.items())))
+        future: 'concurrent.futures.Future[T]'
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[1] > time.monotonic():
+                self._results.move_to_end(key)
+                future = cached[0]
+                owner = False
+            else:
+                future = concurrent.futures.Future()
+                self._results[key] = (future, math.inf)
+                if len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+                owner = True
+
+        if not owner:
+            PROFILER.count('single_flight_hit')
+            return future.result()
+
+        try:
+            result = self.function(*args, **kwargs)
+        except BaseException as exc:
+            self._expire(key, future, keep=False)
+            future.set_exception(exc)
+            raise
+
+        self._expire(key, future, keep=self.ttl > 0)
+        future.set_result(result)
+        return result
+
+    def _expire(self, key: Hashable, future: 'concurrent.futures.Future[T]', keep: bool) -> None:
+        """Start the ttl of a finished call, or forget it, unless a later call already replaced it."""
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is None or cached[0] is not future:
+                return
+            if keep:
+                self._results[key] = (future, time.monotonic() + self.ttl)
+            else:
+                del self._results[key]
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._results.clear()
+
+
+def single_flight(
+    maxsize: int = FETCH_CACHE_SIZE, ttl: float = 0.0
+) -> Callable[[Callable[..., T]], SingleFlightCache[T]]:
+    """Decorate a function with a SingleFlightCache."""
+
+    def decorator(function: Callable[..., T]) -> SingleFlightCache[T]:
+        cache = SingleFlightCache(function, maxsize, ttl)
+        _SINGLE_FLIGHT_CACHES.append(cache)
+        return cache
+
+    return decorator
+
+
+def clear_caches() -> None:
+    """Forget the results of every single_flight function."""
+    for cache in _SINGLE_FLIGHT_CACHES:
+        cache.cache_clear()
+
+
+class Span(NamedTuple):
+    stage: str
+    # perf_counter seconds
+    start: float
+    end: float
+    thread_id: int
+    args: JsonDict
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """Nearest rank percentile of sorted values."""
+    rank = max(0, min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+class Profiler:
+    """Record how long every stage of a run takes, along with counters like cache hits.
+
+    Stages are timed with span, which yields a dict for details of the span such as the bytes transferred.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.spans: List[Span] = []
+        self.counters: Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def span(self, stage: str, **args: Any) -> ContextManager[JsonDict]:
+        return self._timed(stage, args)
+
+    @contextlib.contextmanager
+    def _timed(self, stage: str, args: JsonDict) -> Iterator[JsonDict]:
+        start = time.perf_counter()
+        try:
+            yield args
+        except BaseException as exc:
+            args['error'] = type(exc).__name__
+            raise
+        finally:
+            self.record(stage, start, time.perf_counter(), **args)
+
+    def record(self, stage: str, start: float, end: float, **args: Any) -> None:
+        """Record a span that was timed by the caller."""
+        # list.append is atomic, no lock needed for the worker threads
+        self.spans.append(Span(stage, start, end, threading.get_ident(), args))
+
+    def count(self, counter: str, value: int = 1) -> None:
+        # Unlike append, incrementing isn't atomic, and counters are counted from the worker threads
+        with self._lock:
+            self.counters[counter] += value
+
+    def summary(self) -> List[JsonDict]:
+        """Summarize the spans of each stage, in milliseconds."""
+        stages: Dict[str, List[Span]] = collections.defaultdict(list)
+        for span in self.spans:
+            stages[span.stage].append(span)
+
+        elapsed = max((i.end for i in self.spans), default=self.start) - self.start
+        rows = []
+        for stage, spans in sorted(stages.items()):
+            durations = sorted((i.end - i.start) * 1000 for i in spans)
+            rows.append(
+                {
+                    'stage': stage,
+                    'count': len(spans),
+                    'per_second': len(spans) / elapsed if elapsed else 0.0,
+                    'p50_ms': percentile(durations, 50),
+                    'p95_ms': percentile(durations, 95),
+                    'p99_ms': percentile(durations, 99),
+                    'total_ms': sum(durations),
+                    'bytes': sum(i.args.get('bytes', 0) for i in spans),
+                    'errors': sum(1 for i in spans if 'error' in i.args),
+                }
+            )
+        return rows
+
+    def chrome_trace(self) -> JsonDict:
+        """Export the spans in the Chrome trace event format, for chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        events = [
+            {
+                'name': i.stage,
+                'cat': i.stage,
+                'ph': 'X',
+                'ts': (i.start - self.start) * 1e6,
+                'dur': (i.end - i.start) * 1e6,
+                'pid': pid,
+                'tid': i.thread_id,
+                'args': i.args,
+            }
+            for i in self.spans
+        ]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': dict(self.counters)}
+
+
+class NullProfiler(Profiler):
+    """Profiler that records nothing, used unless profiling is enabled."""
+
+    # Entering it again and again yields the same throwaway dict
+    _NULL_SPAN: ContextManager[JsonDict] = contextlib.nullcontext({})
+
+    def span(self, stage: str, **args: Any) -> ContextManager[JsonDict]:
+        return self._NULL_SPAN
+
+    def record(self, stage: str, start: float, end: float, **args: Any) -> None:
+        pass
+
+    def count(self, counter: str, value: int = 1) -> None:
+        pass
+
+
+# Replaced by main() when profiling
+PROFILER: Profiler = NullProfiler()
+
+
+def report_profile(profiler: Profiler, trace_path: Optional[str] = None, output: Optional[TextIO] = None) -> None:
+    """Print the summary of a profile, and write its trace to trace_path."""
+    output = output or sys.stderr
+    print(tabulate.tabulate(profiler.summary(), headers='keys', floatfmt='.1f'), file=output)
+    for counter, value in sorted(profiler.counters.items()):
+        print(f'{counter}: {value}', file=output)
+
+    if trace_path:
+        with open(trace_path, 'w') as trace_file:
+            json.dump(profiler.chrome_trace(), trace_file)
+
+
+class SkuCache:
+    """Persistent cache of flavour and size resolutions to product ids, on every site.
+
+    Variations that do not exist are cached too, so they are not queried again. The product id of the default product
+    of every category, which tells them apart, is cached and expires alike.
+    """
+
+    def __init__(self, directory: str, ttl_days: float = SKU_CACHE_TTL_DAYS) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.ttl = ttl_days * 24 * 60 * 60
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(directory, 'skus.sqlite3'), check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS site_skus (
+                    site TEXT NOT NULL,
+                    product_category_id TEXT NOT NULL,
+                    flavour_id INTEGER NOT NULL,
+                    size_id INTEGER NOT NULL,
+                    -- NULL when the variation does not exist
+                    product_id TEXT,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (site, product_category_id, flavour_id, size_id)
+                )
+                '''
+            )
+            # Resolutions from before sites were told apart were all made on BASE_URL
+            tables = self._connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'skus'")
+            if tables.fetchone():
+                self._connection.execute(
+                    '''
+                    INSERT OR IGNORE INTO site_skus
+                    SELECT ?, product_category_id, flavour_id, size_id, product_id, updated FROM skus
+                    ''',
+                    (BASE_URL,),
+                )
+                self._connection.execute('DROP TABLE skus')
+            self._connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS default_skus (
+                    site TEXT NOT NULL,
+                    product_category_id TEXT NOT NULL,
+                    product_id TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (site, product_category_id)
+                )
+                '''
+            )
+
+    def get(self, job: Job) -> Optional[Resolution]:
+        """Get the cached resolution for job, None if it is not cached or has expired."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT product_id FROM site_skus WHERE site = ? AND product_category_id = ? AND flavour_id = ? '
+                'AND size_id = ? AND updated >= ?',
+                (
+                    job.base_url or BASE_URL,
+                    job.product_category_id,
+                    job.flavour.id,
+                    job.size.id,
+                    time.time() - self.ttl,
+                ),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        product_id = row[0]
+        if product_id is None:
+            error = ProductNotExistError(f'Flavour {job.flavour} and size {job.size} does not exist.')
+            return Resolution(job, None, error)
+        return Resolution(job, product_id, None)
+
+    def put(self, resolution: Resolution) -> None:
+        job = resolution.job
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO site_skus VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    job.base_url or BASE_URL,
+                    job.product_category_id,
+                    job.flavour.id,
+                    job.size.id,
+                    resolution.product_id,
+                    time.time(),
+                ),
+            )
+
+    def get_default(self, product_category_id: str, base_url: Optional[str] = None) -> Optional[str]:
+        """Get the cached product id of the default product of a category, None if it is not cached or has expired."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT product_id FROM default_skus WHERE site = ? AND product_category_id = ? AND updated >= ?',
+                (base_url or BASE_URL, product_category_id, time.time() - self.ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_default(self, product_category_id: str, product_id: str, base_url: Optional[str] = None) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO default_skus VALUES (?, ?, ?, ?)',
+                (base_url or BASE_URL, product_category_id, product_id, time.time()),
+            )
+
+    def invalidate(self, product_category_ids: Iterable[str]) -> None:
+        """Forget cached resolutions and default products for categories, on every site."""
+        rows = [(i,) for i in product_category_ids]
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM site_skus WHERE product_category_id = ?', rows)
+            self._connection.executemany('DELETE FROM default_skus WHERE product_category_id = ?', rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class ResponseCache:
+    """On disk cache of response bodies and their validators, evicting the least recently used past max_mb.
+
+    Parsed responses are also kept in memory, so an unmodified response is neither transferred nor parsed again.
+    """
+
+    def __init__(self, directory: str, max_mb: float = RESPONSE_CACHE_MAX_MB) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._parsed: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(directory, 'responses.sqlite3'), check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    body TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                '''
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                'SELECT etag, last_modified, body FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            self._connection.execute('UPDATE responses SET last_used = ? WHERE url = ?', (time.time(), url))
+            return CachedResponse(*row)
+
+    def get_parsed(self, url: str) -> Any:
+        """Get the parsed response, None if it has to be parsed again."""
+        with self._lock:
+            return self._parsed.get(url)
+
+    def set_parsed(self, url: str, parsed: Any) -> None:
+        with self._lock:
+            self._parsed[url] = parsed
+
+    def put(self, url: str, response: requests.Response, parsed: Any) -> None:
+        """Cache a successful response and its parsed result, if it has validators for conditional requests."""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status_code != 200 or not (etag or last_modified):
+            return
+
+        body = response.text
+        size = len(body.encode())
+        if size > self.max_bytes:
+            return
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, body, size, time.time()),
+            )
+            self._parsed[url] = parsed
+            self._evict()
+
+    def _evict(self) -> None:
+        """Delete the least recently used responses until the cache fits in max_bytes."""
+        (total,) = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+
+        while total > self.max_bytes:
+            url, size = self._connection.execute(
+                'SELECT url, size FROM responses ORDER BY last_used LIMIT 1'
+            ).fetchone()
+            self._connection.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self._parsed.pop(url, None)
+            total -= size
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class PriceHistory:
+    """Append only, columnar history of prices.
+
+    Every column is a file of fixed width values and strings are interned into a table of their own, so a row takes 32
+    bytes on disk. Rows are appended in time order, so queries binary search for the start of their window and scan it
+    in chunks. Memory grows with the number of skus, not the length of the history.
+    """
+
+    # Column name to array typecode
+    COLUMNS = {'timestamp': 'd', 'category': 'I', 'flavour': 'I', 'size': 'I', 'sku': 'I', 'price': 'd'}
+    CHUNK_ROWS = 64 * 1024
+
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._strings_path = os.path.join(directory, 'strings.jsonl')
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        # Bytes of complete lines in the strings file
+        self._strings_size = 0
+
+        if os.path.exists(self._strings_path):
+            with open(self._strings_path, 'rb') as strings_file:
+                for line in strings_file:
+                    # A line cut short by an interrupted append is dropped, its string is interned again
+                    if not line.endswith(b'\n'):
+                        break
+                    self._intern(json.loads(line), [])
+                    self._strings_size += len(line)
+
+    def _column_path(self, name: str) -> str:
+        return os.path.join(self.directory, f'{name}.bin')
+
+    def _intern(self, value: str, new_strings: List[str]) -> int:
+        if value not in self._string_ids:
+            self._string_ids[value] = len(self._strings)
+            self._strings.append(value)
+            new_strings.append(value)
+        return self._string_ids[value]
+
+    def append(self, products: Iterable[ProductInformation], timestamp: Optional[float] = None) -> None:
+        """Append the prices of a run, at timestamp or now."""
+        timestamp = time.time() if timestamp is None else timestamp
+        columns: Dict[str, 'array.array[Any]'] = {
+            name: array.array(typecode) for name, typecode in self.COLUMNS.items()
+        }
+        new_strings: List[str] = []
+
+        for product in products:
+            columns['timestamp'].append(timestamp)
+            columns['category'].append(self._intern(product.category, new_strings))
+            columns['flavour'].append(self._intern(product.flavour, new_strings))
+            columns['size'].append(self._intern(product.size, new_strings))
+            columns['sku'].append(self._intern(product.sku, new_strings))
+            columns['price'].append(product.price)
+
+        # Strings go first, so that every id in a column always has its string
+        if os.path.exists(self._strings_path) and os.path.getsize(self._strings_path) > self._strings_size:
+            os.truncate(self._strings_path, self._strings_size)
+        lines = b''.join(json.dumps(i).encode() + b'\n' for i in new_strings)
+        with open(self._strings_path, 'ab') as strings_file:
+            strings_file.write(lines)
+        self._strings_size += len(lines)
+
+        # Drop incomplete rows of an interrupted append, so that new rows line up in every column
+        num_rows = len(self)
+        for name, typecode in self.COLUMNS.items():
+            path = self._column_path(name)
+            if os.path.exists(path) and os.path.getsize(path) > num_rows * array.array(typecode).itemsize:
+                os.truncate(path, num_rows * array.array(typecode).itemsize)
+
+        for name, values in columns.items():
+            with open(self._column_path(name), 'ab') as column_file:
+                values.tofile(column_file)
+
+    def __len__(self) -> int:
+        # An interrupted append can leave columns of different lengths, ignore the incomplete rows
+        return min(
+            os.path.getsize(path) // array.array(typecode).itemsize if os.path.exists(path) else 0
+            for path, typecode in ((self._column_path(i), j) for i, j in self.COLUMNS.items())
+        )
+
+    def _first_row_since(self, since: float, num_rows: int) -> int:
+        """Binary search for the first row at or after since."""
+        itemsize = array.array('d').itemsize
+        low, high = 0, num_rows
+        with open(self._column_path('timestamp'), 'rb') as timestamps:
+            while low < high:
+                middle = (low + high) // 2
+                timestamps.seek(middle * itemsize)
+                value = array.array('d')
+                value.fromfile(timestamps, 1)
+                if value[0] < since:
+                    low = middle + 1
+                else:
+                    high = middle
+        return low
+
+    def _scan(self, since: float) -> Iterator[Tuple[float, int, int, int, int, float]]:
+        """Iterate over the rows at or after since, as (timestamp, category, flavour, size, sku, price)."""
+        num_rows = len(self)
+        if not num_rows:
+            return
+
+        row = self._first_row_since(since, num_rows)
+
+        with contextlib.ExitStack() as stack:
+            files = []
+            for name, typecode in self.COLUMNS.items():
+                column_file = stack.enter_context(open(self._column_path(name), 'rb'))
+                column_file.seek(row * array.array(typecode).itemsize)
+                files.append((column_file, typecode))
+
+            while row < num_rows:
+                chunk_rows = min(self.CHUNK_ROWS, num_rows - row)
+                chunks = []
+                for column_file, typecode in files:
+                    chunk = array.array(typecode)
+                    chunk.fromfile(column_file, chunk_rows)
+                    chunks.append(chunk)
+
+                yield from zip(*chunks)
+                row += chunk_rows
+
+    def _summarize(self, days: float, now: Optional[float]) -> Tuple[List[PriceLow], List[float]]:
+        """Get the lowest and latest price of every sku in the last days, with the timestamp of its latest price."""
+        now = time.time() if now is None else now
+        # (category, sku) to (flavour, size, lowest price, latest price, latest timestamp)
+        skus: Dict[Tuple[int, int], Tuple[int, int, float, float, float]] = {}
+
+        for timestamp, category, flavour, size, sku, price in self._scan(now - days * 24 * 60 * 60):
+            key = (category, sku)
+            lowest = skus[key][2] if key in skus else price
+            skus[key] = (flavour, size, min(lowest, price), price, timestamp)
+
+        strings = self._strings
+        price_lows = [
+            PriceLow(strings[category], strings[flavour], strings[size], strings[sku], lowest, latest)
+            for (category, sku), (flavour, size, lowest, latest, _) in skus.items()
+        ]
+        return price_lows, [i[4] for i in skus.values()]
+
+    def lowest_prices(self, days: float, now: Optional[float] = None) -> List[PriceLow]:
+        """Get the lowest price of every sku in the last days, along with its latest price."""
+        return self._summarize(days, now)[0]
+
+    def at_low(self, days: float, now: Optional[float] = None) -> List[PriceLow]:
+        """Get the skus of the latest run whose price is the lowest of the last days."""
+        price_lows, timestamps = self._summarize(days, now)
+        latest_run = max(timestamps, default=0.0)
+        return [
+            price_low
+            for price_low, timestamp in zip(price_lows, timestamps)
+            if timestamp == latest_run and price_low.current_price <= price_low.lowest_price
+        ]
+
+
+class Checkpoint:
+    """Journal of finished jobs, so that an interrupted run can resume where it stopped.
+
+    Every finished job is appended as a line of json and flushed straight away, with its product or None when the
+    variation doesn't exist. Failed jobs aren't journaled, so they are tried again on resume. A line cut short by a
+    crash is ignored. Jobs are journaled with their site, so resuming against another site starts it over.
+    """
+
+    def __init__(self, path: str, resume: bool = False) -> None:
+        self.path = path
+        self.failed: List[Job] = []
+        self._finished: Dict[Tuple[str, int, int, str], Optional[ProductInformation]] = {}
+
+        complete_line = True
+        if resume and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                for line in checkpoint_file:
+                    complete_line = line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                        product_category_id, flavour_id, size_id, *site = entry['job']
+                        product = ProductInformation(**entry['product']) if entry['product'] else None
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    # Journals from before sites were told apart only have jobs of BASE_URL
+                    self._finished[product_category_id, flavour_id, size_id, site[0] if site else BASE_URL] = product
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'a' if resume else 'w')
+        if not complete_line:
+            self._file.write('\n')
+
+    @staticmethod
+    def _key(job: Job) -> Tuple[str, int, int, str]:
+        return job.product_category_id, job.flavour.id, job.size.id, job.base_url or BASE_URL
+
+    def __len__(self) -> int:
+        return len(self._finished)
+
+    def __contains__(self, job: Job) -> bool:
+        return self._key(job) in self._finished
+
+    def __getitem__(self, job: Job) -> Optional[ProductInformation]:
+        """Get the product of a finished job, None when its variation doesn't exist."""
+        return self._finished[self._key(job)]
+
+    def finish(self, job: Job, product: Optional[ProductInformation]) -> None:
+        self._finished[self._key(job)] = product
+        self._file.write(json.dumps({'job': self._key(job), 'product': asdict(product) if product else None}) + '\n')
+        self._file.flush()
+
+    def fail(self, job: Job) -> None:
+        self.failed.append(job)
+
+    def close(self, finished: bool = False) -> None:
+        """Close the journal, deleting it when the run finished without failures since there's nothing to resume."""
+        self._file.close()
+        if finished and not self.failed:
+            os.remove(self.path)
+
+
+class Catalog:
+    """Product categories by id, with the flavour, size and product id of their default product, indexed by name."""
+
+    def __init__(self, categories: Dict[str, ProductInformation]) -> None:
+        self._by_id: Dict[str, ProductInformation] = {}
+        self._by_name: Dict[str, str] = {}
+        self._names: Optional[List[str]] = None
+        self.update(categories)
+
+    @classmethod
+    def load(cls, path: str) -> 'Catalog':
+        with open(path) as catalog_file:
+            categories = json.load(catalog_file)
+        return cls({i: ProductInformation(price=0.0, **product) for i, product in categories.items()})
+
+    def save(self, path: str) -> None:
+        """Write the catalog to path, replacing it atomically."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        categories = {
+            i: {'category': j.category, 'flavour': j.flavour, 'size': j.size, 'sku': j.sku}
+            for i, j in self._by_id.items()
+        }
+
+        with open(f'{path}.tmp', 'w') as catalog_file:
+            json.dump(categories, catalog_file, indent=4, sort_keys=True)
+        os.replace(f'{path}.tmp', path)
+
+    def update(self, categories: Dict[str, ProductInformation]) -> None:
+        for product_category_id, default_product in categories.items():
+            old_default_product = self._by_id.get(product_category_id)
+            if old_default_product:
+                self._by_name.pop(old_default_product.category, None)
+
+            self._by_id[product_category_id] = default_product
+            self._by_name[default_product.category] = product_category_id
+        self._names = None
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def items(self) -> Iterable[Tuple[str, ProductInformation]]:
+        return self._by_id.items()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._by_name
+
+    def __getitem__(self, product_category_id: str) -> ProductInformation:
+        """Get the default product of a category."""
+        return self._by_id[product_category_id]
+
+    def find(self, name: str) -> str:
+        """Get the id of a category by its name."""
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise KeyError(f'{name} is not in the catalog') from None
+
+    def names(self) -> List[str]:
+        if self._names is None:
+            self._names = sorted(self._by_name)
+        return self._names
+
+
+@lru_cache()
+def load_catalog(path: Optional[str]) -> Catalog:
+    """Get the built in categories, along with the ones discovered into path."""
+    catalog = Catalog(PRODUCT_INFORMATION)
+    if path and os.path.exists(path):
+        catalog.update(dict(Catalog.load(path).items()))
+    return catalog
+
+
+def get_catalog() -> Catalog:
+    """Get the catalog at CATALOG_PATH, loaded on first use."""
+    return load_catalog(CATALOG_PATH)
+
+
 def get_product_information(name: str) -> str:
-    for category_id, product_information in PRODUCT_INFORMATION.items():
-        if product_information.category == name:
-            return category_id
+    return get_catalog().find(name)
+
+
+class VariationIndex:
+    """Sizes sold in each flavour of each category.
+
+    Variations markup lists the sizes sold in the selected flavour, so one resolution per flavour tells which of the
+    other sizes exist before they are requested. The default options of sites other than BASE_URL, which the catalog
+    doesn't describe, are kept from the product pages that were already fetched.
+    """
+
+    def __init__(self) -> None:
+        self._sizes: Dict[Tuple[Optional[str], str, int], FrozenSet[int]] = {}
+        self._default_options: Dict[Tuple[Optional[str], str], Tuple[str, str]] = {}
+
+    def learn(
+        self, product_category_id: str, flavour_id: int, size_ids: Iterable[int], base_url: Optional[str] = None
+    ) -> None:
+        self._sizes[base_url, product_category_id, flavour_id] = frozenset(size_ids)
+
+    def is_sold(self, job: Job) -> Optional[bool]:
+        """Whether the variation of job exists, None if the sizes of its flavour aren't known yet."""
+        size_ids = self._sizes.get((job.base_url, job.product_category_id, job.flavour.id))
+        return None if size_ids is None else job.size.id in size_ids
+
+    def learn_default_options(
+        self, product_category_id: str, product_page: ProductPage, base_url: Optional[str] = None
+    ) -> None:
+        """Keep the first flavour and size of a product page, which are the options of the default product."""
+        if product_page.flavours and product_page.sizes:
+            default_options = (product_page.flavours[0].name, product_page.sizes[0].name)
+            self._default_options[base_url, product_category_id] = default_options
+
+    def default_options(self, product_category_id: str, base_url: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        return self._default_options.get((base_url, product_category_id))
+
+
+@lru_cache()
+def get_variation_index() -> VariationIndex:
+    """Get the variation index, shared for the whole process like the other lookups."""
+    return VariationIndex()
+
+
+def discover_category(product_category_id: str, session: Optional[requests.Session] = None) -> ProductInformation:
+    """Get the name and default product of a category.
+
+    The default product is the first flavour and size on the product page, the name comes from its ld+json.
+    """
+    product_page = fetch_product_page(product_category_id, session)
+    if not product_page.flavours or not product_page.sizes:
+        raise ValueError(f'Could not find flavours and sizes from {product_page.url}')
 
-    # Should have found something
-    raise Exception('This should not happen, name should always match product category.')
+    name = re.sub(r'\W+', '_', (product_page.name or product_category_id).lower()).strip('_')
+    default_product_id = get_default_product_not_found(product_category_id, session)
+    return ProductInformation(name, product_page.flavours[0].name, product_page.sizes[0].name, 0.0, default_product_id)
+
+
+async def discover_catalog(product_category_ids: List[str], max_concurrency: int) -> Dict[str, ProductInformation]:
+    """Discover categories concurrently, skipping the ones that fail."""
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(max_concurrency)
+
+    async def discover(product_category_id: str) -> Optional[ProductInformation]:
+        async with limit:
+            try:
+                return await loop.run_in_executor(None, discover_category, product_category_id, None)
+            except (requests.RequestException, ValueError) as exc:
+                tqdm.tqdm.write(f'Could not discover {product_category_id}, skipping... {exc}')
+                return None
+
+    default_products = await asyncio.gather(*(discover(i) for i in product_category_ids))
+    return {i: j for i, j in zip(product_category_ids, default_products) if j is not None}
+
+
+@dataclass
+class ScrapeOptions:
+    """Limits and caches of a scrape, shared by the command, the library and the watcher."""
+
+    max_concurrency: int = MAX_WORKERS
+    max_per_host: int = MAX_PER_HOST
+    sku_cache: Optional[SkuCache] = None
+    response_cache: Optional[ResponseCache] = None
+    parse_workers: int = 0
+    # Storefronts to query, the single site of BASE_URL when there are none
+    regions: Sequence[Region] = ()
 
 
 def main() -> None:  # pragma: no cover
+    global BASE_URL, CATALOG_PATH  # pylint: disable=global-statement
+
     args = parse_cli()
+    BASE_URL = (args.base_url or BASE_URL).rstrip('/')
+    CATALOG_PATH = args.catalog
 
-    product_information: List[ProductInformation] = []
+    if args.lowest is not None or args.at_low is not None:
+        print_price_lows(args)
+        return
 
-    product_category_ids = [get_product_information(i) for i in args.product_categories]
+    # Only commands that make requests load requests
+    configure_session(args.workers)
 
-    for product_category_id in tqdm(product_category_ids, desc='Products', unit=''):
-        flavours, sizes = get_all_products(product_category_id)
-        price_data = get_price_data(product_category_id)
+    if args.profile or args.profile_output:
+        start_profiler(args.profile_output)
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=15) as executor:
-            futures_arguments = {
-                executor.submit(resolve_options_to_product_id, product_category_id, flavour, size): (flavour, size)
-                for flavour, size in itertools.product(flavours, sizes)
-            }
+    if args.discover:
+        update_catalog(args)
+        return
 
-            for future in tqdm(
-                concurrent.futures.as_completed(futures_arguments), total=len(futures_arguments), unit='items'
-            ):
-                flavour, size = futures_arguments[future]
-                try:
-                    product_id = future.result()
-                    category = PRODUCT_INFORMATION[product_category_id].category
-                    product_information.append(
-                        ProductInformation(category, flavour.name, size.name, price_data[product_id])
-                    )
-                except ProductNotExistError as exc:
-                    tqdm.write(f'Variation does not exist, skipping... {exc}')
+    product_category_ids = [get_product_information(i) for i in args.product_categories]
+    price_history = PriceHistory(args.history_dir) if args.record_history else None
+
+    sku_cache = SkuCache(args.cache_dir, args.sku_ttl)
+    if args.refresh_skus:
+        sku_cache.invalidate(product_category_ids)
+    options = ScrapeOptions(
+        args.workers,
+        args.per_host,
+        sku_cache,
+        ResponseCache(args.cache_dir, args.response_cache_mb) if args.response_cache_mb else None,
+        args.parse_workers,
+        [REGIONS[i] for i in args.regions or []],
+    )
+
+    checkpoint = None if args.watch else Checkpoint(args.checkpoint, args.resume)
+    finished = False
 
-    print_product_information(product_information)
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = create_writer(args, output)
+    product_information: List[ProductInformation] = []
+    vouchers: List[Voucher] = []
+
+    try:
+        if args.watch:
+            asyncio.run(watch(PriceWatcher(product_category_ids, options), args.interval, price_history))
+            return
+
+        product_information, vouchers = asyncio.run(scrape(args, product_category_ids, options, checkpoint, writer))
+        writer.close()
+        finished = True
+    except KeyboardInterrupt:
+        return
+    finally:
+        if checkpoint is not None:
+            checkpoint.close(finished)
+        sku_cache.close()
+        if options.response_cache:
+            options.response_cache.close()
+        if output is not sys.stdout:
+            output.close()
+
+    if price_history is not None:
+        price_history.append(product_information)
+
+    print_summary(args, checkpoint, product_information, vouchers)
+
+
+def print_summary(  # pragma: no cover
+    args: argparse.Namespace,
+    checkpoint: Optional[Checkpoint],
+    product_information: List[ProductInformation],
+    vouchers: List[Voucher],
+) -> None:
+    """Print the variations left to retry, then the effective prices and the vouchers when the command asks for them."""
+    if checkpoint is not None and checkpoint.failed:
+        print(f'{len(checkpoint.failed)} variations failed, rerun with --resume to retry them.', file=sys.stderr)
+
+    # Keep streamed products on stdout parseable
+    summary_output = sys.stdout if args.format == 'table' or args.output else sys.stderr
+    if args.effective_prices:
+        print_effective_prices(PricingEngine(vouchers).rank(product_information), summary_output)
 
     if args.vouchers:
-        get_all_vouchers()
+        print_vouchers(vouchers, summary_output)
+
+
+def start_profiler(trace_path: Optional[str]) -> None:  # pragma: no cover
+    global PROFILER  # pylint: disable=global-statement
+
+    PROFILER = Profiler()
+    # Report however the run ends, including when it's interrupted
+    atexit.register(report_profile, PROFILER, trace_path)
+
+
+def print_price_lows(args: argparse.Namespace) -> None:  # pragma: no cover
+    history = PriceHistory(args.history_dir)
+    price_lows = history.lowest_prices(args.lowest) if args.lowest is not None else history.at_low(args.at_low)
+    print(tabulate.tabulate([i._asdict() for i in sorted(price_lows)], headers='keys'))
 
 
-def print_product_information(product_information: List[ProductInformation]) -> None:  # pragma: no cover
-    table = [asdict(i) for i in sorted(product_information, key=operator.attrgetter('category', 'size', 'price'))]
-    print(tabulate(table, headers='keys'))
+def update_catalog(args: argparse.Namespace) -> None:  # pragma: no cover
+    catalog = Catalog.load(args.catalog) if os.path.exists(args.catalog) else Catalog({})
+    discovered = asyncio.run(discover_catalog(args.discover, args.workers))
+    catalog.update(discovered)
+    catalog.save(args.catalog)
+    print(tabulate.tabulate([{'id': i, **asdict(j)} for i, j in discovered.items()], headers='keys'))
 
 
-def get_all_vouchers() -> None:  # pragma: no cover
-    print('Vouchers:')
-    print('=' * 80)
-    page = requests.get(VOUCHER_URL)
-    soup = bs4.BeautifulSoup(page.content, 'html.parser')
-    voucher_infos = soup.select('.voucher-info-wrapper')
-    for voucher in voucher_infos:
-        print(voucher.find('h2').find(text=True))
-        voucher_message = voucher.select('.voucher-message')[0]
-        message = voucher_message.find_all(text=True)
-        message = '\n'.join(message).strip()
-        print(message)
-        print('-' * 80)
+def create_writer(args: argparse.Namespace, output: TextIO) -> ProductWriter:  # pragma: no cover
+    normalizer = PriceNormalizer(args.currency, args.rates) if args.currency else None
+    writer = OUTPUT_FORMATS[args.format](output, normalizer=normalizer)
+    if args.top and isinstance(writer, TableWriter):
+        writer.key = price_per_kg_sort_key
+    return writer
+
+
+async def scrape(  # pragma: no cover
+    args: argparse.Namespace,
+    product_category_ids: List[str],
+    options: ScrapeOptions,
+    checkpoint: Optional[Checkpoint],
+    writer: ProductWriter,
+) -> Tuple[List[ProductInformation], List[Voucher]]:
+    """Write the products of the command, get those it records or ranks along with the vouchers it needs."""
+    # Vouchers are fetched alongside the products, instead of after them
+    loop = asyncio.get_running_loop()
+    vouchers_future = (
+        loop.create_task(run_with_retries(get_vouchers, args.cache_dir))
+        if args.vouchers or args.effective_prices
+        else None
+    )
+    top_products = TopProducts(args.top) if args.top else None
+    # Only kept in memory when they need to be recorded or ranked
+    keep_products = args.record_history or args.effective_prices
+    product_information = []
+
+    async for product in stream_product_information(product_category_ids, options, checkpoint):
+        if keep_products:
+            product_information.append(product)
+
+        if args.max_price_per_kg is not None and price_per_kg_sort_key(product) > args.max_price_per_kg:
+            continue
+        if top_products:
+            top_products.push(product)
+        else:
+            writer.write(product)
+
+    for product in top_products.products() if top_products else []:
+        writer.write(product)
+
+    vouchers = []
+    if vouchers_future:
+        # Vouchers are extras, the products are still written without them
+        try:
+            vouchers = await vouchers_future
+        except requests.RequestException as exc:
+            print(f'Could not fetch vouchers, skipping them... {exc}', file=sys.stderr)
+
+    return product_information, vouchers
+
+
+async def scrape_product_information(
+    product_category_ids: List[str], options: ScrapeOptions
+) -> List[ProductInformation]:
+    """Resolve every flavour and size of every category in one work queue."""
+    return [i async for i in stream_product_information(product_category_ids, options)]
+
+
+async def stream_product_information(
+    product_category_ids: List[str],
+    options: ScrapeOptions,
+    checkpoint: Optional[Checkpoint] = None,
+    progress: bool = True,
+) -> AsyncIterator[ProductInformation]:
+    """Like scrape_product_information, but yield every product as soon as it is priced.
+
+    Jobs finished according to checkpoint are yielded from it without any request, newly finished jobs are added to it.
+    Jobs that fail are skipped, so that the rest of the run isn't lost. Without progress, nothing is printed about them.
+
+    Every region is queried, or the single site of BASE_URL when there are none. The jobs of all regions share one
+    queue, so that they share the connection pools and the concurrency limits of every host. Categories that the site
+    of a region doesn't have are skipped on that site.
+    """
+    # Region code by site, where the site of BASE_URL is None
+    sites: Dict[Optional[str], str] = {i.base_url: i.code for i in options.regions} or {None: ''}
+
+    def skip(message: str) -> None:
+        if progress:
+            tqdm.tqdm.write(message)
+
+    price_data, jobs = await plan_jobs(product_category_ids, options, list(sites), skip)
+
+    with tqdm.tqdm(total=len(jobs), unit='items', disable=not progress) as progress_bar:
+        unfinished_jobs = []
+        for job in jobs:
+            if checkpoint is not None and job in checkpoint:
+                progress_bar.update()
+                product = checkpoint[job]
+                if product:
+                    yield product
+            else:
+                unfinished_jobs.append(job)
+
+        async for resolution in resolve_jobs(
+            unfinished_jobs, options.max_concurrency, options.max_per_host, sku_cache=options.sku_cache
+        ):
+            progress_bar.update()
+            job = resolution.job
+
+            if isinstance(resolution.error, ProductNotExistError):
+                skip(f'Variation does not exist, skipping... {resolution.error}')
+                if checkpoint is not None:
+                    checkpoint.finish(job, None)
+                continue
+
+            if resolution.error is not None:
+                skip(f'Could not resolve {job.flavour.name} {job.size.name}, skipping... {resolution.error}')
+                if checkpoint is not None:
+                    checkpoint.fail(job)
+                continue
+
+            product_id = cast(str, resolution.product_id)
+            product = ProductInformation(
+                get_catalog()[job.product_category_id].category,
+                job.flavour.name,
+                job.size.name,
+                price_data[job.base_url, job.product_category_id][product_id],
+                product_id,
+                sites[job.base_url],
+            )
+            if checkpoint is not None:
+                checkpoint.finish(job, product)
+            yield product
+
+
+async def plan_jobs(
+    product_category_ids: List[str], options: ScrapeOptions, sites: List[Optional[str]], skip: Callable[[str], None]
+) -> Tuple[Dict[Tuple[Optional[str], str], Mapping[str, float]], List[Job]]:
+    """Fetch the product pages of every site, to get their prices by site and category and the jobs to resolve.
+
+    Pages without variations, like those of categories that the site of a region doesn't have, are reported to skip.
+    """
+    # Category ids are those of the catalog, which other sites may not have
+    site_product_pages = await asyncio.gather(
+        *(fetch_product_pages(product_category_ids, options, i, bool(options.regions)) for i in sites)
+    )
+
+    price_data: Dict[Tuple[Optional[str], str], Mapping[str, float]] = {}
+    jobs: List[Job] = []
+    for base_url, product_pages in zip(sites, site_product_pages):
+        for product_category_id, product_page in zip(product_category_ids, product_pages):
+            if product_page.price_data is None:
+                raise ValueError(f'Could not find product data from {product_page.url}')
+            if not product_page.flavours:
+                skip(f'No variations found at {product_page.url}, skipping...')
+            price_data[base_url, product_category_id] = product_page.price_data
+            # Spares fetching the page again to tell the default product of other sites
+            get_variation_index().learn_default_options(product_category_id, product_page, base_url)
+            jobs.extend(
+                Job(product_category_id, flavour, size, base_url)
+                for flavour, size in itertools.product(product_page.flavours, product_page.sizes)
+            )
+
+    return price_data, jobs
+
+
+async def query_products_async(
+    categories: Iterable[str], options: Optional[ScrapeOptions] = None
+) -> AsyncIterator[ProductInformation]:
+    """Query every product of the named categories, yielding each as soon as it is priced.
+
+    This is the library counterpart of main, it prints nothing and skips variations that don't exist or fail. The shared
+    session and the lookups of default products and variations are kept for later queries in the same process, pass a
+    sku_cache in options to keep resolutions between them too.
+    """
+    product_category_ids = [get_product_information(i) for i in categories]
+    options = options or ScrapeOptions()
+    # Every worker keeps its connection alive
+    get_session(options.max_concurrency)
+    async for product in stream_product_information(product_category_ids, options, progress=False):
+        yield product
+
+
+def query_products(categories: Iterable[str], options: Optional[ScrapeOptions] = None) -> Iterator[ProductInformation]:
+    """Like query_products_async, for callers that aren't running an event loop.
+
+    The query runs on an event loop of its own, products are still yielded as soon as they are priced.
+    """
+    loop = asyncio.new_event_loop()
+    products = query_products_async(categories, options).__aiter__()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(products.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        # Stop the query when the caller stops early
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+class PriceWatcher:
+    """Poll product pages for price changes.
+
+    Product ids are resolved on the first poll and kept in memory, so later polls only fetch the product pages. A
+    category is only resolved again when its flavours or sizes change. Variations that failed to resolve are retried on
+    the next poll.
+    """
+
+    def __init__(self, product_category_ids: List[str], options: Optional[ScrapeOptions] = None) -> None:
+        self.product_category_ids = product_category_ids
+        # Regions aren't watched, only the single site of BASE_URL
+        self.options = options or ScrapeOptions()
+        self._variations: Dict[str, Tuple[List[Option], List[Option]]] = {}
+        self._product_ids: Dict[str, Dict[Tuple[Option, Option], str]] = {}
+        self._failed_jobs: Dict[str, List[Job]] = {}
+        self._products: Dict[Tuple[str, Option, Option], ProductInformation] = {}
+        self._latest: List[ProductInformation] = []
+
+    async def poll(self) -> List[PriceChange]:
+        """Get the products whose price changed since the last poll, all products on the first poll."""
+        options = self.options
+        product_pages = await fetch_product_pages(self.product_category_ids, options)
+
+        jobs: List[Job] = []
+        for product_category_id, product_page in zip(self.product_category_ids, product_pages):
+            variations = (product_page.flavours, product_page.sizes)
+            failed_jobs = self._failed_jobs.pop(product_category_id, [])
+            if self._variations.get(product_category_id) != variations:
+                self._variations[product_category_id] = variations
+                self._product_ids[product_category_id] = {}
+                jobs.extend(Job(product_category_id, flavour, size) for flavour, size in itertools.product(*variations))
+            else:
+                jobs.extend(failed_jobs)
+
+        async for resolution in resolve_jobs(
+            jobs, options.max_concurrency, options.max_per_host, sku_cache=options.sku_cache
+        ):
+            job = resolution.job
+            if resolution.product_id is not None:
+                self._product_ids[job.product_category_id][(job.flavour, job.size)] = resolution.product_id
+            elif not isinstance(resolution.error, ProductNotExistError):
+                # A failed request tells nothing about whether the variation exists
+                self._failed_jobs.setdefault(job.product_category_id, []).append(job)
+
+        return self._price_changes(product_pages)
+
+    def snapshot(self) -> List[ProductInformation]:
+        """Get every product priced by the last poll."""
+        return self._latest
+
+    def _price_changes(self, product_pages: List[ProductPage]) -> List[PriceChange]:
+        changes = []
+        self._latest = []
+        for product_category_id, product_page in zip(self.product_category_ids, product_pages):
+            category = get_catalog()[product_category_id].category
+            price_data = product_page.price_data or {}
+
+            for (flavour, size), product_id in self._product_ids[product_category_id].items():
+                if product_id not in price_data:
+                    continue
+
+                product = ProductInformation(category, flavour.name, size.name, price_data[product_id], product_id)
+                self._latest.append(product)
+                old_product = self._products.get((product_category_id, flavour, size))
+                if old_product is None or product.price != old_product.price:
+                    self._products[product_category_id, flavour, size] = product
+                    changes.append(PriceChange(product, old_product.price if old_product else None))
+
+        return changes
+
+
+def print_price_changes(changes: Iterable[PriceChange]) -> None:
+    for change in changes:
+        product = change.product
+        old_price = 'new' if change.old_price is None else f'{change.old_price:.2f}'
+        print(f'{product.category} {product.flavour} {product.size}: {old_price} -> {product.price:.2f}')
+
+
+async def watch(watcher: PriceWatcher, interval: float, price_history: Optional[PriceHistory] = None) -> None:
+    """Print all prices, then only the changes on each poll.
+
+    A poll that fails, after the retries of every request, is reported and tried again on the next one instead of
+    stopping the watch.
+    """
+    printed = False
+    while True:
+        try:
+            changes = await watcher.poll()
+        except (requests.RequestException, ValueError) as exc:
+            print(f'Could not poll prices, trying again in {interval:g} seconds... {exc}', file=sys.stderr)
+        else:
+            if price_history is not None:
+                price_history.append(watcher.snapshot())
+
+            if printed:
+                print_price_changes(changes)
+            else:
+                print_product_information([i.product for i in changes])
+                printed = True
+
+        await asyncio.sleep(interval)
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that adapts to how the site responds, by additive increase and multiplicative decrease.
+
+    The limit starts at half of maximum and grows by one for every limit healthy responses. It halves whenever a request
+    fails, is throttled or takes longer than slow_seconds. No requests are started while the site asks to retry after.
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, slow_seconds: float = SLOW_RESPONSE_SECONDS) -> None:
+        self.maximum = maximum
+        self.minimum = minimum
+        self.slow_seconds = slow_seconds
+        self.limit = float(max(minimum, maximum // 2))
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            pause = self._paused_until - loop.time()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            async with self._condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                await self._condition.wait()
+
+    async def release(self, seconds: float, healthy: bool = True, retry_after: Optional[float] = None) -> None:
+        """Release a slot, adapting the limit to the outcome of the request that took seconds."""
+        async with self._condition:
+            self.in_flight -= 1
+
+            if healthy and seconds <= self.slow_seconds:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            else:
+                self.limit = max(float(self.minimum), self.limit / 2)
+
+            if retry_after:
+                self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + retry_after)
+
+            self._condition.notify_all()
+
+
+def parse_retry_after(response: Optional[requests.Response]) -> Optional[float]:
+    """Get the seconds to wait from a Retry-After header, which is either seconds or a date."""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+
+    if value.strip().isdigit():
+        return float(value)
+
+    retry_at = email.utils.parsedate_to_datetime(value)
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def is_retryable(exc: Exception) -> bool:
+    """Whether a request failed because the site is throttling, overloaded or unreachable."""
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and (exc.response.status_code == 429 or exc.response.status_code >= 500)
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+async def resolve_jobs(
+    jobs: Iterable[Job],
+    max_concurrency: int = MAX_WORKERS,
+    max_per_host: int = MAX_PER_HOST,
+    session: Optional[requests.Session] = None,
+    sku_cache: Optional[SkuCache] = None,
+) -> AsyncIterator[Resolution]:
+    """Resolve jobs concurrently, yielding each resolution as it completes.
+
+    All jobs share one queue, bounded by max_concurrency requests in total. Requests to each host are limited by an
+    AdaptiveLimiter of up to max_per_host, which backs off when the host throttles or fails. Throttled and failed
+    requests are retried up to MAX_ATTEMPTS times. Nonexistent variations and requests that still fail are yielded as
+    resolutions with an error, so a network blip doesn't abort the other jobs. Any other error is raised.
+
+    Resolutions found in sku_cache are yielded first without any request, new resolutions are added to it. Sizes are
+    only requested once a resolution in their flavour has told whether they exist, see VariationIndex.
+    """
+    uncached_jobs = []
+    for job in jobs:
+        cached = sku_cache.get(job) if sku_cache else None
+        if cached:
+            PROFILER.count('sku_cache_hit')
+            yield cached
+        else:
+            uncached_jobs.append(job)
+
+    resolver = JobResolver(max_concurrency, max_per_host, session, sku_cache)
+    resolutions = schedule_jobs(uncached_jobs, resolver)
+    try:
+        async for resolution in resolutions:
+            # Failed requests tell nothing about whether the variation exists
+            if sku_cache and not isinstance(resolution.error, requests.RequestException):
+                sku_cache.put(resolution)
+            yield resolution
+    finally:
+        # Cancel the pending resolutions before waiting for the requests already started
+        await resolutions.aclose()
+        resolver.close()
+
+
+async def schedule_jobs(jobs: Iterable[Job], resolver: JobResolver) -> AsyncGenerator[Resolution, None]:
+    """Resolve one size of every flavour first, the others are only requested once its markup tells they exist."""
+    variation_index = get_variation_index()
+    pending = set()
+    later_jobs: Dict[Tuple[Optional[str], str, int], List[Job]] = {}
+    for job in jobs:
+        key = (job.base_url, job.product_category_id, job.flavour.id)
+        if key in later_jobs:
+            later_jobs[key].append(job)
+        else:
+            later_jobs[key] = []
+            pending.add(asyncio.ensure_future(resolver.resolve(job)))
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                resolutions = [task.result()]
+                job = resolutions[0].job
+
+                for later_job in later_jobs.pop((job.base_url, job.product_category_id, job.flavour.id), []):
+                    if variation_index.is_sold(later_job) is False:
+                        PROFILER.count('variation_not_sold')
+                        error = ProductNotExistError(f'Size {later_job.size} is not sold in {later_job.flavour}.')
+                        resolutions.append(Resolution(later_job, None, error))
+                    else:
+                        pending.add(asyncio.ensure_future(resolver.resolve(later_job)))
+
+                for resolution in resolutions:
+                    yield resolution
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class JobResolver:
+    """Resolve jobs on a pool of threads, with the limits of requests in total and to each host of resolve_jobs."""
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_per_host: int,
+        session: Optional[requests.Session] = None,
+        sku_cache: Optional[SkuCache] = None,
+    ) -> None:
+        self.session = session
+        self.sku_cache = sku_cache
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+        self._global_limit = asyncio.Semaphore(max_concurrency)
+        self._host_limits: Dict[str, AdaptiveLimiter] = collections.defaultdict(lambda: AdaptiveLimiter(max_per_host))
+
+    async def resolve(self, job: Job) -> Resolution:
+        """Resolve a job, retrying it when it's throttled or fails."""
+        loop = asyncio.get_running_loop()
+        host = urllib.parse.urlsplit(variations_url(job.product_category_id, job.base_url)).netloc
+        host_limit = self._host_limits[host]
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            # Wait for the host before taking a global slot, so a busy host doesn't starve the others
+            queued = time.perf_counter()
+            await host_limit.acquire()
+            start = loop.time()
+            try:
+                async with self._global_limit:
+                    PROFILER.record('resolve_queue', queued, time.perf_counter(), category=job.product_category_id)
+                    product_id = await loop.run_in_executor(
+                        self._executor,
+                        resolve_options_to_product_id,
+                        job.product_category_id,
+                        job.flavour,
+                        job.size,
+                        self.session,
+                        job.base_url,
+                        self.sku_cache,
+                    )
+            except ProductNotExistError as exc:
+                await host_limit.release(loop.time() - start)
+                return Resolution(job, None, exc)
+            except Exception as exc:  # pylint: disable=broad-except
+                if not is_retryable(exc):
+                    await host_limit.release(loop.time() - start)
+                    if isinstance(exc, requests.RequestException):
+                        return Resolution(job, None, exc)
+                    raise
+
+                PROFILER.count('retry')
+                retry_after = parse_retry_after(getattr(exc, 'response', None))
+                await host_limit.release(loop.time() - start, healthy=False, retry_after=retry_after)
+                if attempt == MAX_ATTEMPTS:
+                    return Resolution(job, None, exc)
+                if retry_after is None:
+                    await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            else:
+                await host_limit.release(loop.time() - start)
+                return Resolution(job, product_id, None)
+
+        raise AssertionError('Every attempt either returns or raises')
+
+    def close(self) -> None:
+        """Wait for the requests already started."""
+        self._executor.shutdown()
 
 
 @lru_cache()
-def get_price_data(product_category_id: str) -> Dict[str, float]:
-    """Get price information for skus.
+def parse_size(size: str) -> Size:
+    """Parse the weight and servings of a size option. Every option name is only parsed once."""
+    weight = SIZE_WEIGHT_PATTERN.search(size)
+    servings = SIZE_SERVINGS_PATTERN.search(size)
 
-    :return: Mapping from product id to price
+    grams = None
+    if weight:
+        count, amount, unit = weight.groups()
+        grams = int(count or 1) * float(amount) * GRAMS_PER_UNIT[unit.lower()]
+
+    return Size(grams, int(servings.group(1)) if servings else None)
+
+
+def price_per_kg(product: ProductInformation) -> Optional[float]:
+    grams = parse_size(product.size).grams
+    return product.price / grams * 1000 if grams else None
+
+
+class PriceNormalizer:  # pylint: disable=too-few-public-methods
+    """Convert the prices of every region to one currency, to compare them."""
+
+    def __init__(self, currency: str, rates: Optional[Mapping[str, float]] = None) -> None:
+        self.currency = currency
+        self.rates = EXCHANGE_RATES if rates is None else rates
+        self.column = f'price_{currency.lower()}'
+
+    def normalize(self, product: ProductInformation) -> Optional[float]:
+        """Get the price of product in currency, None when the currency of its region isn't known."""
+        region = REGIONS.get(product.region)
+        if region is None or region.currency not in self.rates:
+            return None
+        return product.price * self.rates[region.currency] / self.rates[self.currency]
+
+
+def product_row(product: ProductInformation, normalizer: Optional[PriceNormalizer] = None) -> JsonDict:
+    """Fields of a product for output, along with its price per kg and its price converted by normalizer."""
+    row = asdict(product)
+    if not product.region:
+        del row['region']
+
+    unit_price = price_per_kg(product)
+    row['price_per_kg'] = round(unit_price, 2) if unit_price is not None else None
+    if normalizer:
+        price = normalizer.normalize(product)
+        row[normalizer.column] = round(price, 2) if price is not None else None
+    return row
+
+
+def product_sort_key(product: ProductInformation) -> Tuple[str, float, str, str, float]:
+    """Sort by category, then numerically by size, with sizes that aren't weights last, then by region."""
+    return product.category, parse_size(product.size).grams or math.inf, product.size, product.region, product.price
+
+
+def price_per_kg_sort_key(product: ProductInformation) -> float:
+    unit_price = price_per_kg(product)
+    return math.inf if unit_price is None else unit_price
+
+
+class TopProducts:
+    """Keep the count products cheapest per kg, without keeping or sorting all of them."""
+
+    def __init__(self, count: int) -> None:
+        self.count = count
+        # Max heap of (-price per kg, -insertion order, product), so the most expensive, latest kept product is on top
+        self._heap: List[Tuple[float, int, ProductInformation]] = []
+        self._counter = itertools.count()
+
+    def push(self, product: ProductInformation) -> None:
+        unit_price = price_per_kg(product)
+        if unit_price is None:
+            return
+
+        # pylint doesn't narrow unit_price to a float
+        item = (-unit_price, -next(self._counter), product)  # pylint: disable=invalid-unary-operand-type
+        if len(self._heap) < self.count:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    def products(self) -> List[ProductInformation]:
+        """Get the kept products, cheapest per kg first."""
+        return [i[2] for i in sorted(self._heap, reverse=True)]
+
+
+def print_product_information(
+    product_information: List[ProductInformation],
+    output: Optional[TextIO] = None,
+    key: Callable[[ProductInformation], Any] = product_sort_key,
+    normalizer: Optional[PriceNormalizer] = None,
+) -> None:
+    table = [product_row(i, normalizer) for i in sorted(product_information, key=key)]
+    print(tabulate.tabulate(table, headers='keys'), file=output)
+
+
+class ProductWriter:
+    """Write products to output as they are priced."""
+
+    def __init__(self, output: TextIO, normalizer: Optional[PriceNormalizer] = None) -> None:
+        self.output = output
+        self.normalizer = normalizer
+
+    def write(self, product: ProductInformation) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Finish the output once every product is written."""
+
+
+class TableWriter(ProductWriter):
+    """Collect every product, then print them sorted by key in a table."""
+
+    def __init__(
+        self,
+        output: TextIO,
+        key: Callable[[ProductInformation], Any] = product_sort_key,
+        normalizer: Optional[PriceNormalizer] = None,
+    ) -> None:
+        super().__init__(output, normalizer)
+        self.key = key
+        self._products: List[ProductInformation] = []
+
+    def write(self, product: ProductInformation) -> None:
+        self._products.append(product)
+
+    def close(self) -> None:
+        print_product_information(self._products, self.output, self.key, self.normalizer)
+
+
+class JsonLinesWriter(ProductWriter):
+    def write(self, product: ProductInformation) -> None:
+        self.output.write(json.dumps(product_row(product, self.normalizer)) + '\n')
+        self.output.flush()
+
+
+class CsvWriter(ProductWriter):
+    def __init__(self, output: TextIO, normalizer: Optional[PriceNormalizer] = None) -> None:
+        super().__init__(output, normalizer)
+        columns = [i.name for i in fields(ProductInformation)] + ['price_per_kg']
+        if normalizer:
+            columns.append(normalizer.column)
+        self._writer = csv.DictWriter(output, columns, lineterminator='\n')
+        self._writer.writeheader()
+
+    def write(self, product: ProductInformation) -> None:
+        self._writer.writerow(product_row(product, self.normalizer))
+        self.output.flush()
+
+
+OUTPUT_FORMATS: Dict[str, Type[ProductWriter]] = {'table': TableWriter, 'jsonl': JsonLinesWriter, 'csv': CsvWriter}
+
+
+def parse_voucher_rule(voucher: Voucher) -> Optional[VoucherRule]:
+    """Parse the discount of a voucher, None if it isn't a percentage off."""
+    if voucher.discount_percent is None:
+        return None
+
+    text = f'{voucher.title}\n{voucher.message}'
+    min_spend = MIN_SPEND_PATTERN.search(text)
+    words = set(re.findall(r'[a-z]+', text.lower()))
+    categories = frozenset().union(*(j for i, j in VOUCHER_CATEGORY_KEYWORDS.items() if i in words))
+
+    return VoucherRule(
+        voucher.code, voucher.discount_percent, float(min_spend.group(1)) if min_spend else 0.0, categories or None
+    )
+
+
+class PricingEngine:
+    """Best price of products with the vouchers that apply to them.
+
+    The vouchers of a category are kept sorted by spend threshold, dropping the ones that a lower threshold beats. The
+    best voucher for a price is then the last threshold it reaches, found by binary search. Ranking n products against
+    v vouchers takes O(n log v) instead of trying every voucher on every product.
     """
 
-    url = f'https://us.myprotein.com/{product_category_id}.html'
+    def __init__(self, vouchers: Iterable[Voucher]) -> None:
+        self.rules = [i for i in map(parse_voucher_rule, vouchers) if i]
+        # Category to the increasing thresholds and the best voucher from each threshold on
+        self._tiers: Dict[str, Tuple[List[float], List[VoucherRule]]] = {}
+
+    def _tiers_of(self, category: str) -> Tuple[List[float], List[VoucherRule]]:
+        if category not in self._tiers:
+            thresholds: List[float] = []
+            best_rules: List[VoucherRule] = []
+            for rule in sorted(
+                (i for i in self.rules if i.applies_to(category)), key=lambda i: (i.min_spend, -i.percent_off)
+            ):
+                if best_rules and rule.percent_off <= best_rules[-1].percent_off:
+                    continue
+                thresholds.append(rule.min_spend)
+                best_rules.append(rule)
+            self._tiers[category] = (thresholds, best_rules)
+
+        return self._tiers[category]
+
+    def effective_price(self, product: ProductInformation) -> EffectivePrice:
+        thresholds, best_rules = self._tiers_of(product.category)
+        index = bisect.bisect_right(thresholds, product.price) - 1
+        if index < 0:
+            return EffectivePrice(product, product.price, None)
+
+        rule = best_rules[index]
+        return EffectivePrice(product, round(product.price * (1 - rule.percent_off / 100), 2), rule.code)
+
+    def rank(self, products: Iterable[ProductInformation]) -> List[EffectivePrice]:
+        """Get the effective price of every product, cheapest per kg first and products without a weight last."""
+
+        def key(effective_price: EffectivePrice) -> Tuple[float, float]:
+            unit_price = effective_price.effective_price_per_kg
+            return math.inf if unit_price is None else unit_price, effective_price.effective_price
+
+        return sorted(map(self.effective_price, products), key=key)
+
+
+def print_effective_prices(effective_prices: List[EffectivePrice], output: Optional[TextIO] = None) -> None:
+    table = []
+    for effective_price in effective_prices:
+        unit_price = effective_price.effective_price_per_kg
+        table.append(
+            {
+                **product_row(effective_price.product),
+                'effective_price': effective_price.effective_price,
+                'effective_price_per_kg': round(unit_price, 2) if unit_price is not None else None,
+                'voucher': effective_price.voucher_code or '',
+            }
+        )
+    print(tabulate.tabulate(table, headers='keys'), file=output)
 
-    response = requests.get(url)
-    dom = bs4.BeautifulSoup(response.text, 'html.parser')
 
-    for script in dom.find_all('script', type='application/ld+json'):
-        script_json = addict.Dict(json.loads(script.string))
+def print_vouchers(vouchers: List[Voucher], output: Optional[TextIO] = None) -> None:
+    print('Vouchers:', file=output)
+    print('=' * 80, file=output)
+    for voucher in vouchers:
+        print(voucher.title, file=output)
+        print(voucher.message, file=output)
+        print('-' * 80, file=output)
 
-        if 'offers' in script_json:
-            price_data = {i.sku: float(i.price) for i in script_json.offers}
-            break
-    else:
-        raise ValueError(f'Could not find product data from {url}')
 
-    return price_data
+def parse_vouchers(html: str) -> List[Voucher]:
+    dom = bs4.BeautifulSoup(html, HTML_PARSER, parse_only=bs4.SoupStrainer(class_='voucher-info-wrapper'))
+    vouchers = []
+    for voucher_info in dom.select('.voucher-info-wrapper'):
+        title = voucher_info.select('h2')[0].get_text().strip()
+        message = '\n'.join(voucher_info.select('.voucher-message')[0].find_all(string=True)).strip()
 
+        code = VOUCHER_CODE_PATTERN.search(message)
+        discount = DISCOUNT_PERCENT_PATTERN.search(title) or DISCOUNT_PERCENT_PATTERN.search(message)
+        vouchers.append(
+            Voucher(title, message, code.group(1) if code else None, float(discount.group(1)) if discount else None)
+        )
 
-def get_all_products(product_id: str) -> Tuple[List[Option], List[Option]]:
-    """Query endpoint to get possible product variations (size and flavour)"""
-    response = requests.get(f'https://us.myprotein.com/{product_id}.html')
-    dom = bs4.BeautifulSoup(response.text, 'html.parser')
+    return vouchers
+
+
+def fetch_vouchers(session: Optional[requests.Session] = None, base_url: Optional[str] = None) -> List[Voucher]:
+    with PROFILER.span('vouchers') as span:
+        response = (session or get_session()).get(voucher_url(base_url), timeout=REQUEST_TIMEOUT_SECONDS)
+        span['bytes'] = len(response.content)
+    response.raise_for_status()
+    return parse_vouchers(response.text)
+
+
+def get_vouchers(
+    cache_dir: Optional[str] = None,
+    ttl_seconds: float = VOUCHER_CACHE_TTL_SECONDS,
+    session: Optional[requests.Session] = None,
+    base_url: Optional[str] = None,
+) -> List[Voucher]:
+    """Get the current vouchers of the site of base_url or BASE_URL, cached in cache_dir for ttl_seconds."""
+    # Every site has vouchers of its own
+    site = re.sub(r'\W+', '_', urllib.parse.urlsplit(base_url or BASE_URL).netloc)
+    cache_path = os.path.join(cache_dir, f'vouchers_{site}.json') if cache_dir else None
+    if cache_path and os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < ttl_seconds:
+        PROFILER.count('voucher_cache_hit')
+        with open(cache_path) as cache_file:
+            return [Voucher(**i) for i in json.load(cache_file)]
+
+    vouchers = fetch_vouchers(session, base_url)
+    if cache_path:
+        os.makedirs(cast(str, cache_dir), exist_ok=True)
+        with open(f'{cache_path}.tmp', 'w') as cache_file:
+            json.dump([asdict(i) for i in vouchers], cache_file)
+        os.replace(f'{cache_path}.tmp', cache_path)
+    return vouchers
+
+
+def product_page_url(product_category_id: str, base_url: Optional[str] = None) -> str:
+    return f'{base_url or BASE_URL}/{product_category_id}.html'
+
+
+def voucher_url(base_url: Optional[str] = None) -> str:
+    return f'{base_url or BASE_URL}{VOUCHER_PATH}'
+
+
+def find_child_id(html: str) -> Optional[str]:
+    """Find the canonical product id in variations markup.
+
+    The raw markup is searched for the first data-child-id attribute, without building a document tree. BeautifulSoup is
+    only used as a fallback when the pattern finds nothing.
+    """
+    match = CHILD_ID_PATTERN.search(html)
+    if match:
+        return match.group(1)
+
+    dom = bs4.BeautifulSoup(html, HTML_PARSER)
+    product_id_node = dom.find(attrs={'data-child-id': True})
+    return cast(str, product_id_node['data-child-id']) if product_id_node else None
+
+
+def find_variation_options(html: str) -> Dict[str, Tuple[Optional[int], List[int]]]:
+    """Find the options of the dropdowns in variations markup.
 
-    products = dom.select('#athena-product-variation-dropdown-5 option')
-    flavours = [Option(int(i['value']), i.text.strip()) for i in products]
+    :return: Mapping from variation id to the id of its selected option and the ids of all its options
+    """
+    variations = {}
+    for variation_id, options_html in VARIATION_DROPDOWN_PATTERN.findall(html):
+        selected = None
+        option_ids = []
+        for attributes in VARIATION_OPTION_PATTERN.findall(options_html):
+            value = OPTION_VALUE_PATTERN.search(attributes)
+            if not value:
+                continue
+
+            option_ids.append(int(value.group(1)))
+            if OPTION_SELECTED_PATTERN.search(attributes):
+                selected = option_ids[-1]
+        variations[variation_id] = (selected, option_ids)
+
+    return variations
+
+
+def find_ld_json(html: str) -> List[str]:
+    """Find the contents of ld+json scripts, falling back to BeautifulSoup when the pattern finds nothing."""
+    scripts = LD_JSON_PATTERN.findall(html)
+    if scripts:
+        return cast(List[str], scripts)
+
+    dom = bs4.BeautifulSoup(html, HTML_PARSER, parse_only=bs4.SoupStrainer('script', type='application/ld+json'))
+    return [i.string for i in dom.find_all('script') if i.string]
+
+
+@single_flight(ttl=PRODUCT_PAGE_TTL_SECONDS)
+def get_product_page(
+    product_category_id: str,
+    session: Optional[requests.Session] = None,
+    response_cache: Optional[ResponseCache] = None,
+    base_url: Optional[str] = None,
+) -> ProductPage:
+    """Fetch and parse the product page once every PRODUCT_PAGE_TTL_SECONDS.
+
+    Both the product variations and the price data live on the same page, so callers share this snapshot instead of
+    each downloading and parsing the page.
+    """
+    return fetch_product_page(product_category_id, session, response_cache, base_url)
+
+
+@single_flight()
+def fetch_product_page(
+    product_category_id: str,
+    session: Optional[requests.Session] = None,
+    response_cache: Optional[ResponseCache] = None,
+    base_url: Optional[str] = None,
+) -> ProductPage:
+    """Fetch and parse the current product page.
+
+    With a response_cache, the page is only transferred and parsed again if it was modified. Concurrent calls for the
+    same page share one request.
+    """
+    raw_product_page = fetch_raw_product_page(product_category_id, session, response_cache, base_url)
+    if isinstance(raw_product_page, ProductPage):
+        return raw_product_page
+
+    with PROFILER.span('parse', category=product_category_id):
+        product_page = parse_product_page(raw_product_page.url, raw_product_page.html)
+    return store_product_page(raw_product_page, product_page, response_cache)
+
+
+@single_flight()
+def fetch_raw_product_page(
+    product_category_id: str,
+    session: Optional[requests.Session] = None,
+    response_cache: Optional[ResponseCache] = None,
+    base_url: Optional[str] = None,
+) -> Union[ProductPage, RawProductPage]:
+    """Fetch the current product page without parsing it, unless an unmodified page was already parsed."""
+    url = product_page_url(product_category_id, base_url)
+    cached = response_cache.get(url) if response_cache else None
+
+    headers = {}
+    if cached and cached.etag:
+        headers['If-None-Match'] = cached.etag
+    if cached and cached.last_modified:
+        headers['If-Modified-Since'] = cached.last_modified
+
+    with PROFILER.span('product_page', category=product_category_id) as span:
+        response = (session or get_session()).get(url, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+        span['bytes'] = len(response.content)
+
+    if cached and response_cache and response.status_code == 304:
+        PROFILER.count('response_cache_hit')
+        product_page = response_cache.get_parsed(url)
+        return cast(ProductPage, product_page) if product_page else RawProductPage(url, cached.body, None)
+
+    # Throttled and error pages have no product data
+    response.raise_for_status()
+    return RawProductPage(url, response.text, response)
 
-    sizes = dom.select('.athenaProductVariations_list button')
-    sizes = [Option(int(i['data-option-id']), name=i.text.strip()) for i in sizes]
 
-    return flavours, sizes
+def store_product_page(
+    raw_product_page: RawProductPage, product_page: ProductPage, response_cache: Optional[ResponseCache] = None
+) -> ProductPage:
+    """Cache a freshly parsed product page."""
+    if response_cache and raw_product_page.response is not None:
+        response_cache.put(raw_product_page.url, raw_product_page.response, product_page)
+    elif response_cache:
+        response_cache.set_parsed(raw_product_page.url, product_page)
+    return product_page
 
 
 @lru_cache()
-def get_default_product_not_found(product_category_id: str) -> str:
+def get_parse_pool(parse_workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """Get the process pool parsing product pages, shared for the whole process like the session."""
+    return concurrent.futures.ProcessPoolExecutor(parse_workers)
+
+
+async def run_with_retries(function: Callable[..., T], *args: Any) -> T:
+    """Run function in the default executor, retrying like resolve_jobs while the site throttles or fails."""
+    loop = asyncio.get_running_loop()
+    attempt = 1
+    while True:
+        try:
+            return await loop.run_in_executor(None, function, *args)
+        except Exception as exc:  # pylint: disable=broad-except
+            if attempt == MAX_ATTEMPTS or not is_retryable(exc):
+                raise
+
+            PROFILER.count('retry')
+            retry_after = parse_retry_after(getattr(exc, 'response', None))
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1) if retry_after is None else retry_after)
+            attempt += 1
+
+
+async def fetch_product_pages(
+    product_category_ids: List[str], options: ScrapeOptions, base_url: Optional[str] = None, skip_missing: bool = False
+) -> List[ProductPage]:
+    """Fetch product pages concurrently, from the site of base_url or BASE_URL.
+
+    The site is a single host, at most max_concurrency and max_per_host pages are fetched at once. With parse_workers,
+    threads only fetch the pages and parse_workers processes parse them, so parsing isn't limited to one core. Fetched
+    pages wait for a process in a bounded queue, fetching pauses while the queue is full. Throttled and failed fetches
+    are retried, see run_with_retries.
+
+    With skip_missing, categories that the site doesn't have get an empty page without any variation, instead of
+    failing the whole fetch. Sites of other regions don't have every category of the catalog.
+    """
+    fetch_limit = asyncio.Semaphore(min(options.max_concurrency, options.max_per_host))
+
+    async def fetch_with_retries(
+        function: Callable[..., Union[ProductPage, RawProductPage]], product_category_id: str
+    ) -> Union[ProductPage, RawProductPage]:
+        try:
+            async with fetch_limit:
+                return await run_with_retries(function, product_category_id, None, options.response_cache, base_url)
+        except requests.HTTPError as exc:
+            if not skip_missing or exc.response is None or exc.response.status_code not in (404, 410):
+                raise
+            return ProductPage(product_page_url(product_category_id, base_url), [], [], {})
+
+    if not options.parse_workers:
+        return cast(
+            List[ProductPage],
+            await asyncio.gather(*(fetch_with_retries(fetch_product_page, i) for i in product_category_ids)),
+        )
+
+    # Fetched pages, along with when they were queued
+    queue: 'asyncio.Queue[Tuple[str, RawProductPage, float]]' = asyncio.Queue(
+        PARSE_QUEUE_PER_WORKER * options.parse_workers
+    )
+    product_pages: Dict[str, ProductPage] = {}
+    errors: List[Exception] = []
+
+    async def fetch(product_category_id: str) -> None:
+        raw_product_page = await fetch_with_retries(fetch_raw_product_page, product_category_id)
+        if isinstance(raw_product_page, ProductPage):
+            product_pages[product_category_id] = raw_product_page
+        else:
+            await queue.put((product_category_id, raw_product_page, time.perf_counter()))
+
+    async def parse() -> None:
+        loop = asyncio.get_running_loop()
+        parse_pool = get_parse_pool(options.parse_workers)
+        while True:
+            product_category_id, raw_product_page, queued = await queue.get()
+            PROFILER.record('parse_queue', queued, time.perf_counter(), category=product_category_id)
+            try:
+                with PROFILER.span('parse', category=product_category_id):
+                    product_page = await loop.run_in_executor(
+                        parse_pool, parse_product_page, raw_product_page.url, raw_product_page.html
+                    )
+                product_pages[product_category_id] = store_product_page(
+                    raw_product_page, product_page, options.response_cache
+                )
+            except Exception as exc:  # pylint: disable=broad-except
+                errors.append(exc)
+            finally:
+                queue.task_done()
+
+    parsers = [asyncio.ensure_future(parse()) for _ in range(options.parse_workers)]
+    try:
+        await asyncio.gather(*(fetch(i) for i in product_category_ids))
+        await queue.join()
+    finally:
+        for parser in parsers:
+            parser.cancel()
+
+    if errors:
+        raise errors[0]
+    return [product_pages[i] for i in product_category_ids]
+
+
+def parse_product_page(url: str, html: str) -> ProductPage:
+    # Only the option elements are needed out of the whole page, fall back to parsing all of it if they aren't found
+    with PROFILER.span('product_options', url=url):
+        options_html = ''.join(OPTIONS_PATTERN.findall(html)) or html
+        dom = bs4.BeautifulSoup(options_html, HTML_PARSER)
+
+        products = dom.select('#athena-product-variation-dropdown-5 option')
+        flavours = [Option(int(i['value']), i.text.strip()) for i in products]
+
+        size_buttons = dom.select('.athenaProductVariations_list button')
+        sizes = [Option(int(i['data-option-id']), name=i.text.strip()) for i in size_buttons]
+
+    price_data: Optional[OfferTable] = None
+    name: Optional[str] = None
+    with PROFILER.span('price_data', url=url):
+        for script in find_ld_json(html):
+            product = find_product_json(orjson.loads(script) if orjson else json.loads(script))
+
+            if product is not None:
+                price_data = OfferTable(iter_offers(product['offers']))
+                name = product.get('name') or None
+                break
+
+    return ProductPage(url, flavours, sizes, price_data, name)
+
+
+def find_product_json(script_json: Any) -> Optional[JsonDict]:
+    """Find the item with offers in ld+json, which is either a single item, a list of them or a @graph of them."""
+    if isinstance(script_json, dict):
+        items = script_json.get('@graph', [script_json])
+    else:
+        items = script_json if isinstance(script_json, list) else []
+
+    return next((i for i in items if isinstance(i, dict) and 'offers' in i), None)
+
+
+def iter_offers(offers: Any) -> Iterator[Tuple[str, float]]:
+    """Yield the sku and price of every offer in a list of offers, a single offer or an AggregateOffer of them.
+
+    Offers without a sku or a price, like an AggregateOffer that only has a price range, are skipped.
+    """
+    if isinstance(offers, list):
+        for offer in offers:
+            yield from iter_offers(offer)
+    elif isinstance(offers, dict):
+        if 'offers' in offers:
+            yield from iter_offers(offers['offers'])
+        elif offers.get('sku') is not None and offers.get('price') is not None:
+            yield str(offers['sku']), float(offers['price'])
+
+
+def get_price_data(product_category_id: str, session: Optional[requests.Session] = None) -> Mapping[str, float]:
+    """Get price information for skus.
+
+    :return: Mapping from product id to price
+    """
+    product_page = get_product_page(product_category_id, session)
+    if product_page.price_data is None:
+        raise ValueError(f'Could not find product data from {product_page.url}')
+
+    return product_page.price_data
+
+
+def get_all_products(product_id: str, session: Optional[requests.Session] = None) -> Tuple[List[Option], List[Option]]:
+    """Query endpoint to get possible product variations (size and flavour)"""
+    product_page = get_product_page(product_id, session)
+    return product_page.flavours, product_page.sizes
+
+
+def variations_url(product_category_id: str, base_url: Optional[str] = None) -> str:
+    return f'{base_url or BASE_URL}/{product_category_id}.variations'
+
+
+@single_flight(ttl=DEFAULT_PRODUCT_TTL_SECONDS)
+def get_default_product_not_found(
+    product_category_id: str, session: Optional[requests.Session] = None, base_url: Optional[str] = None
+) -> str:
     """Get default product.
 
     When invalid options are provided, the defualt product is returned. Which happens to be unflavoured whey at 2.2 lbs.
-    This is PRODUCT_INFORMATION.
+    This is the catalog entry of the category.
     """
-    response = requests.get(f'https://us.myprotein.com/{product_category_id}.variations')
+    with PROFILER.span('default_product', category=product_category_id) as span:
+        response = (session or get_session()).get(
+            variations_url(product_category_id, base_url), timeout=REQUEST_TIMEOUT_SECONDS
+        )
+        span['bytes'] = len(response.content)
     response.raise_for_status()
 
-    dom = bs4.BeautifulSoup(response.text, 'html.parser')
-
     # data-child-id is the attribute that contains the canonical product id
-    product_id_node = dom.find(attrs={'data-child-id': True})
+    product_id = find_child_id(response.text)
 
-    if not product_id_node:
+    if not product_id:
         err_msg = f'Could not get data to resolve options to product id. Url: {response.url}'
         raise ValueError(err_msg)
 
-    return cast(str, product_id_node['data-child-id'])
-
-
-def resolve_options_to_product_id(product_category_id: str, flavour: Option, size: Option) -> str:
-    response = requests.post(
-        f'https://us.myprotein.com/{product_category_id}.variations',
-        json={
-            # No idea what this means but it needs to be set to 2.
-            # Otherwise API ignores other parameters and returns default product (unflavoured)
-            'selected': 2,
-            'variation1': '5',  # 5 == Flavour
-            'option1': flavour.id,
-            'variation2': '7',  # 7 == Size
-            'option2': size.id,
-        },
-    )
+    return product_id
+
+
+def resolve_options_to_product_id(  # pylint: disable=too-many-arguments
+    product_category_id: str,
+    flavour: Option,
+    size: Option,
+    session: Optional[requests.Session] = None,
+    base_url: Optional[str] = None,
+    sku_cache: Optional[SkuCache] = None,
+) -> str:
+    session = session or get_session()
+    with PROFILER.span('resolve', category=product_category_id) as span:
+        response = session.post(
+            variations_url(product_category_id, base_url),
+            json={
+                # No idea what this means but it needs to be set to 2.
+                # Otherwise API ignores other parameters and returns default product (unflavoured)
+                'selected': 2,
+                'variation1': FLAVOUR_VARIATION_ID,
+                'option1': flavour.id,
+                'variation2': SIZE_VARIATION_ID,
+                'option2': size.id,
+            },
+            timeout=REQUEST_TIMEOUT_SECONDS,
+        )
+        span['bytes'] = len(response.content)
     response.raise_for_status()
 
-    dom = bs4.BeautifulSoup(response.text, 'html.parser')
-
     # data-child-id is the attribute that contains the canonical product id
-    product_id_node = dom.find(attrs={'data-child-id': True})
+    product_id = find_child_id(response.text)
 
-    if not product_id_node:
+    if not product_id:
         err_msg = f'Could not get data to resolve options to product id. Url: {response.url}'
         raise ValueError(err_msg)
 
-    product_id = product_id_node['data-child-id']
-    default_product_id = get_default_product_not_found(product_category_id)
-    default_product_information = PRODUCT_INFORMATION[product_category_id]
-
-    # IFF not the actually the default product
-    if all(
-        {
-            product_id == default_product_id,
-            flavour.name != default_product_information.flavour,
-            size.name != default_product_information.size,
-        }
+    # The markup lists the sizes sold in the flavour it selected. When that's the requested flavour, it tells whether
+    # the variation exists without comparing to the default product.
+    variations = find_variation_options(response.text)
+    selected_flavour_id, _ = variations.get(FLAVOUR_VARIATION_ID, (None, []))
+    selected_size_id, size_ids = variations.get(SIZE_VARIATION_ID, (None, []))
+    if selected_flavour_id == flavour.id and size_ids:
+        get_variation_index().learn(product_category_id, flavour.id, size_ids, base_url)
+        if size.id not in size_ids:
+            raise ProductNotExistError(f'Flavour {flavour} and size {size} does not exist.')
+        if selected_size_id == size.id:
+            return product_id
+
+    # Otherwise the site falling back to the default product is the only sign that the variation doesn't exist
+    if not is_default_variation(product_category_id, flavour, size, session, base_url) and (
+        product_id == get_default_product_id(product_category_id, session, base_url, sku_cache)
     ):
         raise ProductNotExistError(f'Flavour {flavour} and size {size} does not exist.')
 
-    return cast(str, product_id_node['data-child-id'])
+    return product_id
+
+
+def is_default_variation(
+    product_category_id: str, flavour: Option, size: Option, session: requests.Session, base_url: Optional[str] = None
+) -> bool:
+    """Whether flavour and size are those of the default product of the category, on the site of base_url."""
+    if base_url in (None, BASE_URL):
+        default_product = get_catalog()[product_category_id]
+        return (flavour.name, size.name) == (default_product.flavour, default_product.size)
+
+    # The catalog describes the default product of BASE_URL, elsewhere it's the first flavour and size. They are known
+    # from the product page the scrape fetched, unless the variation is resolved by itself
+    default_options = get_variation_index().default_options(product_category_id, base_url)
+    if default_options is None:
+        product_page = get_product_page(product_category_id, session, None, base_url)
+        default_options = (product_page.flavours[0].name, product_page.sizes[0].name)
+    return (flavour.name, size.name) == default_options
+
+
+def get_default_product_id(
+    product_category_id: str,
+    session: Optional[requests.Session] = None,
+    base_url: Optional[str] = None,
+    sku_cache: Optional[SkuCache] = None,
+) -> str:
+    """Get the product id of the default product of a category.
+
+    It is kept in sku_cache until it expires like the resolutions, so the site is only asked once across runs. Without
+    a sku_cache, it's asked once per run.
+    """
+    product_id = sku_cache.get_default(product_category_id, base_url) if sku_cache else None
+    if product_id is None:
+        product_id = get_default_product_not_found(product_category_id, session, base_url)
+        if sku_cache:
+            sku_cache.put_default(product_category_id, product_id, base_url)
+
+    return product_id
 
 
 if __name__ == '__main__':
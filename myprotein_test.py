@@ -1,17 +1,51 @@
 # Disable redefined function name warning because that's how pytest fixtures work by default
 # pylint: disable=redefined-outer-name
+# The tests mirror the single module they test
+# pylint: disable=too-many-lines
+import asyncio
+import contextlib
+import io
+import json
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import asdict
+from dataclasses import replace
 from typing import Any
+from typing import Dict
 from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
 from unittest import mock
 from unittest import TestCase
 
 import pytest
+import requests
 import responses
 
 import myprotein
 from myprotein import ProductInformation
 
 
+def collect_resolutions(jobs: List[myprotein.Job], **kwargs: Any) -> List[myprotein.Resolution]:
+    async def collect() -> List[myprotein.Resolution]:
+        return [i async for i in myprotein.resolve_jobs(jobs, **kwargs)]
+
+    return asyncio.run(collect())
+
+
+@pytest.fixture(autouse=True)
+def clear_caches() -> Iterator[None]:
+    '''Forget fetched pages between tests, like pytest-antilru does for lru_cache.'''
+    yield
+    myprotein.clear_caches()
+
+
 @pytest.fixture(autouse=True)
 def mocked_responses() -> Any:
     with responses.RequestsMock(assert_all_requests_are_fired=False) as _responses:
@@ -359,3 +393,1457 @@ def test_get_default_product_not_found_bad_response(mock_responses_with_default_
 
     with pytest.raises(ValueError, match='Could not get data to resolve options to product id.'):
         myprotein.get_default_product_not_found(product_category_id)
+
+
+def test_get_product_page_fetched_once(mocked_responses: Any) -> None:
+    """Test that flavours, sizes and prices are all served from a single page fetch."""
+    product_category_id = '12345'
+    body = '''
+        <html>
+            <select id="athena-product-variation-dropdown-5">
+                <option value="111">flavour_name</option>
+            </select>
+            <ul class="athenaProductVariations_list">
+                <li><button data-option-id="211">size_name1</button></li>
+            </ul>
+            <script type="application/ld+json">
+                {"offers": [{"sku": "456", "price": "456.00"}]}
+            </script>
+        </html>
+    '''
+    mocked_responses.add(responses.GET, f'https://us.myprotein.com/{product_category_id}.html', body=body)
+
+    flavours, sizes = myprotein.get_all_products(product_category_id)
+    price_data = myprotein.get_price_data(product_category_id)
+
+    assert flavours == [myprotein.Option(111, 'flavour_name')]
+    assert sizes == [myprotein.Option(211, 'size_name1')]
+    assert price_data == {'456': 456.0}
+    assert len(mocked_responses.calls) == 1
+
+
+def test_create_session() -> None:
+    """Test that the connection pool is sized for the workers and leaves retrying server errors to the callers."""
+    session = myprotein.create_session(pool_size=7, retries=2)
+
+    adapter: Any = session.get_adapter('https://us.myprotein.com')
+    assert adapter._pool_maxsize == 7  # pylint: disable=protected-access
+    assert adapter.max_retries.total == 2
+    assert not adapter.max_retries.status_forcelist
+    assert adapter.max_retries.status == 0
+    assert not adapter.max_retries.respect_retry_after_header
+    assert 'POST' not in adapter.max_retries.allowed_methods
+
+
+def test_get_session_is_shared() -> None:
+    """Test that the session is shared and can be resized."""
+    assert myprotein.get_session() is myprotein.get_session()
+
+    with mock.patch.object(myprotein, '_SESSION', None):
+        session = myprotein.configure_session(3)
+        assert myprotein.get_session() is session
+
+    session = myprotein.configure_session(3)
+
+    assert myprotein.get_session() is session
+    adapter: Any = session.get_adapter('https://us.myprotein.com')
+    assert adapter._pool_maxsize == 3  # pylint: disable=protected-access
+
+    # Grown for more workers, without closing the session that other queries may use
+    with mock.patch.object(session, 'close') as mock_close:
+        grown = myprotein.get_session(20)
+    assert grown is not session
+    assert myprotein.get_session(20) is myprotein.get_session() is grown
+    adapter = grown.get_adapter('https://us.myprotein.com')
+    assert adapter._pool_maxsize == 20  # pylint: disable=protected-access
+    mock_close.assert_not_called()
+
+
+@pytest.mark.usefixtures('mock_responses_with_default_product_information')
+def test_get_default_product_not_found_uses_session() -> None:
+    """Test that an injected session is used for requests."""
+    session = myprotein.create_session()
+
+    with mock.patch.object(session, 'get', wraps=session.get) as mock_get:
+        assert myprotein.get_default_product_not_found('10852500', session) == '1111'
+
+    mock_get.assert_called_once_with(
+        'https://us.myprotein.com/10852500.variations', timeout=myprotein.REQUEST_TIMEOUT_SECONDS
+    )
+
+
+def test_single_flight_shares_concurrent_calls() -> None:
+    """Test that callers that miss the cache while it's being fetched wait for the fetch in flight."""
+    started, release = threading.Event(), threading.Event()
+    calls: List[str] = []
+
+    def fetch(key: str) -> str:
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return f'{key}-value'
+
+    cached_fetch = myprotein.SingleFlightCache(fetch, ttl=60)
+    results: List[str] = []
+    threads = [threading.Thread(target=lambda: results.append(cached_fetch('key'))) for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == ['key-value'] * 4
+    assert calls == ['key']
+
+
+def test_single_flight_cache() -> None:
+    """Test that results expire after the ttl and beyond maxsize, and errors aren't cached."""
+    calls: List[Tuple[Any, ...]] = []
+
+    with mock.patch.object(myprotein, '_SINGLE_FLIGHT_CACHES', []), mock.patch.object(
+        myprotein.time, 'monotonic', return_value=0.0
+    ) as monotonic:
+
+        @myprotein.single_flight(maxsize=2, ttl=10)
+        def fetch(key: str, suffix: str = '') -> str:
+            """Fetch key."""
+            calls.append((key, suffix))
+            if key == 'error':
+                raise ValueError(key)
+            if key == 'clear':
+                myprotein.clear_caches()
+            return key + suffix
+
+        assert fetch('a') == fetch('a') == 'a'
+        assert fetch('a', suffix='!') == 'a!'
+        # Evicts the least recently used result
+        fetch('b')
+        fetch('a')
+        monotonic.return_value = 10.0
+        fetch('b')
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                fetch('error')
+        # Cleared while in flight
+        fetch('clear')
+        fetch('b')
+
+    assert calls == [
+        ('a', ''),
+        ('a', '!'),
+        ('b', ''),
+        ('a', ''),
+        ('b', ''),
+        ('error', ''),
+        ('error', ''),
+        ('clear', ''),
+        ('b', ''),
+    ]
+    assert fetch.__doc__ == 'Fetch key.'
+
+
+def test_resolve_jobs() -> None:
+    """Test that jobs across categories are resolved and nonexistent variations are reported."""
+    flavour = myprotein.Option(1, 'flavour')
+    jobs = [
+        myprotein.Job('111', flavour, myprotein.Option(2, 'size')),
+        myprotein.Job('222', flavour, myprotein.Option(3, 'missing')),
+    ]
+
+    def fake_resolve(product_category_id: str, _: Any, size: myprotein.Option, *__: Any) -> str:
+        if size.name == 'missing':
+            raise myprotein.ProductNotExistError('missing')
+        return f'{product_category_id}-sku'
+
+    with mock.patch.object(myprotein, 'resolve_options_to_product_id', side_effect=fake_resolve):
+        resolutions = collect_resolutions(jobs)
+
+    by_category = {i.job.product_category_id: i for i in resolutions}
+    assert by_category['111'].product_id == '111-sku'
+    assert by_category['111'].error is None
+    assert by_category['222'].product_id is None
+    assert isinstance(by_category['222'].error, myprotein.ProductNotExistError)
+
+
+def test_resolve_jobs_per_host_limit() -> None:
+    """Test that requests to a single host never exceed the per host limit."""
+    option = myprotein.Option(1, 'name')
+    jobs = [myprotein.Job(str(i), option, option) for i in range(8)]
+    lock = threading.Lock()
+    in_flight: List[int] = [0, 0]  # Current, max
+
+    def fake_resolve(*_: Any) -> str:
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return 'sku'
+
+    with mock.patch.object(myprotein, 'resolve_options_to_product_id', side_effect=fake_resolve):
+        resolutions = collect_resolutions(jobs, max_concurrency=8, max_per_host=2)
+
+    assert len(resolutions) == 8
+    assert in_flight[1] == 2
+
+
+@pytest.fixture
+def sku_cache(tmp_path: Any) -> Iterator[myprotein.SkuCache]:
+    cache = myprotein.SkuCache(str(tmp_path))
+    yield cache
+    cache.close()
+
+
+def test_sku_cache(sku_cache: myprotein.SkuCache) -> None:
+    """Test that resolved and nonexistent variations are cached."""
+    found = myprotein.Job('111', myprotein.Option(1, 'flavour'), myprotein.Option(2, 'size'))
+    missing = myprotein.Job('111', myprotein.Option(1, 'flavour'), myprotein.Option(3, 'size'))
+
+    assert sku_cache.get(found) is None
+
+    sku_cache.put(myprotein.Resolution(found, 'sku', None))
+    sku_cache.put(myprotein.Resolution(missing, None, myprotein.ProductNotExistError()))
+
+    assert sku_cache.get(found) == myprotein.Resolution(found, 'sku', None)
+    cached_missing = sku_cache.get(missing)
+    assert cached_missing is not None
+    assert isinstance(cached_missing.error, myprotein.ProductNotExistError)
+
+    # Sites are cached separately
+    assert sku_cache.get(found._replace(base_url='https://www.myprotein.com')) is None
+
+    sku_cache.invalidate(['111'])
+    assert sku_cache.get(found) is None
+
+
+def test_sku_cache_expired(tmp_path: Any) -> None:
+    """Test that expired resolutions are not returned."""
+    job = myprotein.Job('111', myprotein.Option(1, 'flavour'), myprotein.Option(2, 'size'))
+    cache = myprotein.SkuCache(str(tmp_path), ttl_days=0)
+    cache.put(myprotein.Resolution(job, 'sku', None))
+
+    with mock.patch.object(time, 'time', return_value=time.time() + 1):
+        assert cache.get(job) is None
+    cache.close()
+
+
+def test_sku_cache_migrated(tmp_path: Any) -> None:
+    """Test that resolutions cached before sites were told apart are kept, as resolutions on BASE_URL."""
+    job = myprotein.Job('111', myprotein.Option(1, 'flavour'), myprotein.Option(2, 'size'))
+    with contextlib.closing(sqlite3.connect(str(tmp_path / 'skus.sqlite3'))) as connection:
+        with connection:
+            connection.execute(
+                'CREATE TABLE skus (product_category_id TEXT NOT NULL, flavour_id INTEGER NOT NULL, '
+                'size_id INTEGER NOT NULL, product_id TEXT, updated REAL NOT NULL, '
+                'PRIMARY KEY (product_category_id, flavour_id, size_id))'
+            )
+            connection.execute('INSERT INTO skus VALUES (?, ?, ?, ?, ?)', ('111', 1, 2, 'sku', time.time()))
+
+    cache = myprotein.SkuCache(str(tmp_path))
+    reopened = myprotein.SkuCache(str(tmp_path))
+
+    assert cache.get(job) == reopened.get(job) == myprotein.Resolution(job, 'sku', None)
+    assert reopened.get(job._replace(base_url='https://www.myprotein.com')) is None
+    cache.close()
+    reopened.close()
+
+
+def test_resolve_jobs_sku_cache(sku_cache: myprotein.SkuCache) -> None:
+    """Test that cached jobs are not queried and new resolutions are cached."""
+    option = myprotein.Option(1, 'name')
+    cached_job = myprotein.Job('111', option, option)
+    new_job = myprotein.Job('222', option, option)
+    sku_cache.put(myprotein.Resolution(cached_job, 'cached-sku', None))
+
+    with mock.patch.object(myprotein, 'resolve_options_to_product_id', return_value='new-sku') as mock_resolve:
+        resolutions = collect_resolutions([cached_job, new_job], sku_cache=sku_cache)
+
+    assert mock_resolve.call_count == 1
+    assert {i.product_id for i in resolutions} == {'cached-sku', 'new-sku'}
+    assert sku_cache.get(new_job) == myprotein.Resolution(new_job, 'new-sku', None)
+
+
+@pytest.mark.parametrize(
+    'html',
+    [
+        '<div data-child-id="10852413" data-information-url="a/b.html">',
+        "<div data-child-id='10852413'>",
+        '<div DATA-CHILD-ID=10852413>',
+    ],
+)
+def test_find_child_id(html: str) -> None:
+    assert myprotein.find_child_id(html) == '10852413'
+
+
+def test_find_child_id_not_found() -> None:
+    assert myprotein.find_child_id('<div data-information-url="a/b.html"></div>') is None
+
+
+def test_find_ld_json() -> None:
+    """Test that only ld+json scripts are extracted, regardless of attribute quoting."""
+    html = '''
+        <script type="application/json">{"a": 1}</script>
+        <script type="application/ld+json">{"b": 2}</script>
+        <script data-x="y" type=application/ld+json>{"c": 3}</script>
+    '''
+    assert [i.strip() for i in myprotein.find_ld_json(html)] == ['{"b": 2}', '{"c": 3}']
+
+
+def test_find_ld_json_not_found() -> None:
+    assert myprotein.find_ld_json('<script type="application/json">{"a": 1}</script>') == []
+
+
+@pytest.mark.parametrize(
+    'offers, expected',
+    [
+        ([{'sku': '1', 'price': '10.00'}, {'sku': 2, 'price': 20}], [('1', 10.0), ('2', 20.0)]),
+        ({'@type': 'Offer', 'sku': '1', 'price': '10.00'}, [('1', 10.0)]),
+        ({'@type': 'AggregateOffer', 'lowPrice': '10.00', 'offers': [{'sku': '1', 'price': '10.00'}]}, [('1', 10.0)]),
+        ([{'@type': 'AggregateOffer', 'offers': {'offers': [{'sku': '1', 'price': 10}]}}], [('1', 10.0)]),
+        # Nothing to price
+        ({'@type': 'AggregateOffer', 'lowPrice': '10.00', 'highPrice': '20.00'}, []),
+        ([{'sku': '1'}, {'price': '10.00'}, 'not an offer'], []),
+    ],
+)
+def test_iter_offers(offers: Any, expected: List[Tuple[str, float]]) -> None:
+    assert list(myprotein.iter_offers(offers)) == expected
+
+
+@pytest.mark.parametrize(
+    'script_json, expected',
+    [
+        ({'name': 'Whey', 'offers': []}, {'name': 'Whey', 'offers': []}),
+        ([{'@type': 'Organization'}, {'offers': []}], {'offers': []}),
+        ({'@graph': [{'@type': 'BreadcrumbList'}, {'offers': []}]}, {'offers': []}),
+        ({'@type': 'Organization'}, None),
+        ('offers', None),
+    ],
+)
+def test_find_product_json(script_json: Any, expected: Optional[Dict[str, Any]]) -> None:
+    assert myprotein.find_product_json(script_json) == expected
+
+
+def test_offer_table() -> None:
+    """Test that the table behaves like a dict of prices by sku, where later offers replace earlier ones."""
+    offer_table = myprotein.OfferTable([('20', 2.0), ('10', 1.0), ('20', 3.0)])
+
+    assert offer_table == {'10': 1.0, '20': 3.0}
+    assert list(offer_table) == ['10', '20']
+    assert offer_table['20'] == 3.0
+    assert '15' not in offer_table and '30' not in offer_table
+    assert offer_table.get('30') is None
+    assert repr(offer_table) == "OfferTable({'10': 1.0, '20': 3.0})"
+    # Product pages are sent to the parse processes
+    assert pickle.loads(pickle.dumps(offer_table)) == offer_table
+
+
+def test_parse_product_page_without_orjson() -> None:
+    html = '<script type="application/ld+json">{"name": "Whey", "offers": {"sku": "1", "price": "10.00"}}</script>'
+
+    with mock.patch.object(myprotein, 'orjson', None):
+        product_page = myprotein.parse_product_page('url', html)
+
+    assert product_page.price_data == {'1': 10.0}
+    assert product_page.name == 'Whey'
+
+
+def test_price_watcher() -> None:
+    """Test that only price changes are reported and products are only resolved again when options change."""
+    flavour = myprotein.Option(1, 'flavour')
+    size = myprotein.Option(2, 'size')
+    new_size = myprotein.Option(3, 'new size')
+    missing_size = myprotein.Option(4, 'missing size')
+    pages = [
+        myprotein.ProductPage('url', [flavour], [size, missing_size], {'sku': 10.0}),
+        myprotein.ProductPage('url', [flavour], [size, missing_size], {'sku': 10.0}),
+        myprotein.ProductPage('url', [flavour], [size, missing_size], {'sku': 8.0}),
+        myprotein.ProductPage('url', [flavour], [size, new_size], {'sku': 8.0, 'new sku': 20.0}),
+        # Products without a price are skipped
+        myprotein.ProductPage('url', [flavour], [size, new_size], {'new sku': 20.0}),
+    ]
+    product_ids = {size: 'sku', new_size: 'new sku'}
+    watcher = myprotein.PriceWatcher(['10852500'])
+
+    def fake_resolve(_: Any, __: Any, size: myprotein.Option, *___: Any) -> str:
+        if size not in product_ids:
+            raise myprotein.ProductNotExistError()
+        return product_ids[size]
+
+    with mock.patch.object(myprotein, 'fetch_product_page', side_effect=pages), mock.patch.object(
+        myprotein, 'resolve_options_to_product_id', side_effect=fake_resolve
+    ) as mock_resolve:
+        changes = [asyncio.run(watcher.poll()) for _ in pages]
+
+    product = ProductInformation('impact_whey', 'flavour', 'size', 10.0, 'sku')
+    new_product = ProductInformation('impact_whey', 'flavour', 'new size', 20.0, 'new sku')
+    assert changes == [
+        [myprotein.PriceChange(product, None)],
+        # Unchanged
+        [],
+        [myprotein.PriceChange(replace(product, price=8.0), 10.0)],
+        # New option
+        [myprotein.PriceChange(new_product, None)],
+        # No price
+        [],
+    ]
+    assert watcher.snapshot() == [new_product]
+    # Both sizes for the first poll, then both sizes again when the options changed
+    assert mock_resolve.call_count == 4
+
+
+def test_price_watcher_retries_failed_variations() -> None:
+    """Test that a variation whose resolution failed is resolved again on the next poll."""
+    flavour = myprotein.Option(1, 'flavour')
+    size = myprotein.Option(2, 'size')
+    page = myprotein.ProductPage('url', [flavour], [size], {'sku': 10.0})
+    watcher = myprotein.PriceWatcher(['10852500'])
+
+    with mock.patch.object(myprotein, 'fetch_product_page', return_value=page), mock.patch.object(
+        myprotein, 'resolve_options_to_product_id', side_effect=[requests.ConnectionError(), 'sku']
+    ) as mock_resolve, mock.patch.object(myprotein, 'MAX_ATTEMPTS', 1):
+        failed, retried, unchanged = [asyncio.run(watcher.poll()) for _ in range(3)]
+
+    assert failed == []
+    assert retried == [myprotein.PriceChange(ProductInformation('impact_whey', 'flavour', 'size', 10.0, 'sku'), None)]
+    assert unchanged == []
+    assert mock_resolve.call_count == 2
+
+
+def make_response(body: str, **headers: str) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response._content = body.encode()  # pylint: disable=protected-access
+    response.encoding = 'utf-8'
+    response.headers.update(headers)
+    return response
+
+
+@pytest.fixture
+def response_cache(tmp_path: Any) -> Iterator[myprotein.ResponseCache]:
+    cache = myprotein.ResponseCache(str(tmp_path))
+    yield cache
+    cache.close()
+
+
+def test_fetch_product_page_not_modified(mocked_responses: Any, response_cache: myprotein.ResponseCache) -> None:
+    """Test that an unmodified product page is neither transferred nor parsed again."""
+    product_category_id = '12345'
+    body = '<select id="athena-product-variation-dropdown-5"><option value="111">flavour_name</option></select>'
+
+    def callback(request: Any) -> Tuple[int, Dict[str, str], str]:
+        if request.headers.get('If-None-Match') == '"v1"':
+            return 304, {'ETag': '"v1"'}, ''
+        return 200, {'ETag': '"v1"', 'Last-Modified': 'Sat, 17 Oct 2026 00:00:00 GMT'}, body
+
+    mocked_responses.add_callback(responses.GET, myprotein.product_page_url(product_category_id), callback)
+
+    first = myprotein.fetch_product_page(product_category_id, response_cache=response_cache)
+    with mock.patch.object(myprotein, 'parse_product_page') as mock_parse:
+        second = myprotein.fetch_product_page(product_category_id, response_cache=response_cache)
+
+    assert second is first
+    assert first.flavours == [myprotein.Option(111, 'flavour_name')]
+    mock_parse.assert_not_called()
+    assert mocked_responses.calls[1].request.headers['If-Modified-Since'] == 'Sat, 17 Oct 2026 00:00:00 GMT'
+
+
+def test_fetch_product_page_not_modified_from_disk(mocked_responses: Any, tmp_path: Any) -> None:
+    """Test that a cached page from an earlier process is parsed from disk when it wasn't modified."""
+    product_category_id = '12345'
+    url = myprotein.product_page_url(product_category_id)
+    body = '<select id="athena-product-variation-dropdown-5"><option value="111">flavour_name</option></select>'
+    earlier_cache = myprotein.ResponseCache(str(tmp_path))
+    earlier_cache.put(url, make_response(body, ETag='"v1"'), None)
+    earlier_cache.close()
+
+    mocked_responses.add_callback(
+        responses.GET, url, lambda request: (304 if request.headers.get('If-None-Match') == '"v1"' else 200, {}, '')
+    )
+
+    cache = myprotein.ResponseCache(str(tmp_path))
+    product_page = myprotein.fetch_product_page(product_category_id, response_cache=cache)
+
+    assert product_page.flavours == [myprotein.Option(111, 'flavour_name')]
+    assert cache.get_parsed(url) is product_page
+    cache.close()
+
+
+def test_response_cache_eviction(tmp_path: Any) -> None:
+    """Test that the least recently used responses are evicted to stay within the size limit."""
+    body = 'x' * 1000
+    cache = myprotein.ResponseCache(str(tmp_path), max_mb=2500 / 1024 / 1024)
+
+    cache.put('first', make_response(body, ETag='1'), 'first parsed')
+    cache.put('second', make_response(body, ETag='2'), 'second parsed')
+    # Use first so that second is the least recently used
+    with mock.patch.object(time, 'time', return_value=time.time() + 1):
+        assert cache.get('first') == myprotein.CachedResponse('1', None, body)
+    cache.put('third', make_response(body, ETag='3'), 'third parsed')
+
+    assert cache.get('second') is None
+    assert cache.get_parsed('second') is None
+    assert cache.get('first') is not None
+    assert cache.get_parsed('third') == 'third parsed'
+    cache.close()
+
+
+def test_response_cache_uncacheable(response_cache: myprotein.ResponseCache) -> None:
+    """Test that responses without validators, larger than the whole cache, or unsuccessful are not cached."""
+    error = make_response('throttled', ETag='1')
+    error.status_code = 429
+    response_cache.put('no validators', make_response('body'), 'parsed')
+    response_cache.put('too large', make_response('x' * (response_cache.max_bytes + 1), ETag='1'), 'parsed')
+    response_cache.put('error', error, 'parsed')
+
+    assert response_cache.get('no validators') is None
+    assert response_cache.get('too large') is None
+    assert response_cache.get('error') is None
+
+
+def http_error(status_code: int, **headers: str) -> requests.HTTPError:
+    response = make_response('', **headers)
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+def test_adaptive_limiter() -> None:
+    """Test that the limit grows while responses are healthy and halves on failures."""
+
+    async def run() -> None:
+        limiter = myprotein.AdaptiveLimiter(maximum=4, slow_seconds=1)
+        assert limiter.limit == 2
+
+        for _ in range(10):
+            await limiter.acquire()
+            await limiter.release(0.1)
+        assert limiter.limit == 4
+
+        await limiter.acquire()
+        await limiter.release(2)
+        assert limiter.limit == 2
+
+        await limiter.acquire()
+        await limiter.release(0.1, healthy=False)
+        await limiter.acquire()
+        await limiter.release(0.1, healthy=False)
+        assert limiter.limit == 1
+        assert limiter.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_adaptive_limiter_waits() -> None:
+    """Test that no more than the limit are in flight, and nothing starts while paused by retry after."""
+
+    async def run() -> None:
+        loop = asyncio.get_running_loop()
+        limiter = myprotein.AdaptiveLimiter(maximum=2)
+        await limiter.acquire()
+
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        start = loop.time()
+        await limiter.release(0.1, healthy=False, retry_after=0.05)
+        await waiter
+        assert loop.time() - start >= 0.05
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    ('headers', 'expected'),
+    [({}, None), ({'Retry-After': '3'}, 3.0), ({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}, 0.0)],
+)
+def test_parse_retry_after(headers: Dict[str, str], expected: Optional[float]) -> None:
+    assert myprotein.parse_retry_after(make_response('', **headers)) == expected
+
+
+def test_parse_retry_after_date() -> None:
+    with mock.patch.object(time, 'time', return_value=1445412470.0):
+        assert myprotein.parse_retry_after(make_response('', **{'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 10
+
+
+@pytest.mark.parametrize(
+    ('exc', 'expected'),
+    [
+        (http_error(429), True),
+        (http_error(503), True),
+        (http_error(404), False),
+        (requests.ConnectionError(), True),
+        (ValueError(), False),
+    ],
+)
+def test_is_retryable(exc: Exception, expected: bool) -> None:
+    assert myprotein.is_retryable(exc) == expected
+
+
+def test_resolve_jobs_retries() -> None:
+    """Test that throttled and failed resolutions are retried instead of dropped."""
+    option = myprotein.Option(1, 'name')
+    job = myprotein.Job('111', option, option)
+
+    with mock.patch.object(myprotein, 'RETRY_BACKOFF_SECONDS', 0), mock.patch.object(
+        myprotein,
+        'resolve_options_to_product_id',
+        side_effect=[http_error(429, **{'Retry-After': '0'}), requests.ConnectionError(), 'sku'],
+    ) as mock_resolve:
+        resolutions = collect_resolutions([job])
+
+    assert resolutions == [myprotein.Resolution(job, 'sku', None)]
+    assert mock_resolve.call_count == 3
+
+
+def test_resolve_jobs_gives_up(sku_cache: myprotein.SkuCache) -> None:
+    """Test that failed requests are reported once attempts run out and other errors are raised straight away."""
+    option = myprotein.Option(1, 'name')
+    job = myprotein.Job('111', option, option)
+
+    with mock.patch.object(myprotein, 'RETRY_BACKOFF_SECONDS', 0), mock.patch.object(
+        myprotein, 'resolve_options_to_product_id', side_effect=http_error(503)
+    ) as mock_resolve:
+        (resolution,) = collect_resolutions([job], sku_cache=sku_cache)
+    assert mock_resolve.call_count == myprotein.MAX_ATTEMPTS
+    assert isinstance(resolution.error, requests.HTTPError)
+    # The variation might still exist
+    assert sku_cache.get(job) is None
+
+    with mock.patch.object(
+        myprotein, 'resolve_options_to_product_id', side_effect=requests.TooManyRedirects
+    ) as mock_resolve:
+        (resolution,) = collect_resolutions([job])
+    assert mock_resolve.call_count == 1
+    assert isinstance(resolution.error, requests.TooManyRedirects)
+
+    with mock.patch.object(myprotein, 'resolve_options_to_product_id', side_effect=ValueError) as mock_resolve:
+        with pytest.raises(ValueError):
+            collect_resolutions([job])
+    assert mock_resolve.call_count == 1
+
+
+def test_checkpoint(tmp_path: Any) -> None:
+    """Test that finished jobs are resumed, including after a line cut short by a crash."""
+    path = str(tmp_path / 'checkpoint' / 'checkpoint.jsonl')
+    flavour = myprotein.Option(1, 'Vanilla')
+    jobs = [myprotein.Job('111', flavour, myprotein.Option(i, f'{i} kg')) for i in range(4)]
+    product = ProductInformation('impact_whey', 'Vanilla', '0 kg', 10.0, '1')
+
+    checkpoint = myprotein.Checkpoint(path)
+    checkpoint.finish(jobs[0], product)
+    checkpoint.finish(jobs[1], None)
+    checkpoint.fail(jobs[2])
+    checkpoint.close()
+    with open(path, 'a') as checkpoint_file:
+        checkpoint_file.write('{"job": ["111", 1, 3], "pro')
+
+    resumed = myprotein.Checkpoint(path, resume=True)
+    assert len(resumed) == 2
+    assert resumed[jobs[0]] == product
+    assert resumed[jobs[1]] is None
+    assert jobs[2] not in resumed and jobs[3] not in resumed
+    resumed.finish(jobs[3], None)
+    resumed.close()
+
+    assert len(myprotein.Checkpoint(path, resume=True)) == 3
+    # A new run starts over
+    assert len(myprotein.Checkpoint(path)) == 0
+
+
+def test_checkpoint_sites(tmp_path: Any) -> None:
+    """Test that jobs are resumed on their own site, including the ones journaled before sites were told apart."""
+    path = str(tmp_path / 'checkpoint.jsonl')
+    jobs = [myprotein.Job('111', myprotein.Option(1, 'Vanilla'), myprotein.Option(i, f'{i} kg')) for i in range(3)]
+    product = ProductInformation('impact_whey', 'Vanilla', '0 kg', 10.0, '1')
+    with open(path, 'w') as checkpoint_file:
+        checkpoint_file.write(json.dumps({'job': ['111', 1, 0], 'product': asdict(product)}) + '\n')
+        checkpoint_file.write(json.dumps({'job': ['111', 1, 1], 'product': None}) + '\n')
+        checkpoint_file.write(json.dumps({'job': ['111', 1], 'product': None}) + '\n')
+        checkpoint_file.write(json.dumps({'job': ['111', 1, 2]}) + '\n')
+
+    resumed = myprotein.Checkpoint(path, resume=True)
+    resumed.finish(jobs[2]._replace(base_url='https://www.myprotein.com'), None)
+    resumed.close()
+
+    assert len(resumed) == 3
+    assert resumed[jobs[0]] == product
+    assert resumed[jobs[0]._replace(base_url=myprotein.BASE_URL)] == product
+    # Jobs of the single site are journaled with its url, so another --base-url doesn't reuse them
+    assert jobs[2] not in resumed
+    with mock.patch.object(myprotein, 'BASE_URL', 'https://www.myprotein.com'):
+        resumed_elsewhere = myprotein.Checkpoint(path, resume=True)
+        assert resumed_elsewhere[jobs[2]] is None
+    resumed_elsewhere.close()
+
+
+def test_checkpoint_removed_when_finished(tmp_path: Any) -> None:
+    path = str(tmp_path / 'checkpoint.jsonl')
+    job = myprotein.Job('111', myprotein.Option(1, 'Vanilla'), myprotein.Option(1, '1 kg'))
+
+    checkpoint = myprotein.Checkpoint(path)
+    checkpoint.fail(job)
+    checkpoint.close(finished=True)
+    assert os.path.exists(path)
+
+    myprotein.Checkpoint(path).close(finished=True)
+    assert not os.path.exists(path)
+
+
+def test_lazy_imports() -> None:
+    """Test that importing doesn't load the dependencies for scraping, which commands like --list don't need."""
+    modules = subprocess.run(
+        [sys.executable, '-c', 'import sys, myprotein; print(*sys.modules)'],
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout.split()
+
+    for module in ['asyncio.base_events', 'bs4.element', 'requests.sessions', 'sqlite3.dbapi2', 'tqdm.std']:
+        assert module not in modules
+
+
+def test_lazy_import() -> None:
+    """Test that the package is returned like import does, with the submodule imported once it's used."""
+    with mock.patch.dict(sys.modules):
+        sys.modules.pop('json.tool', None)
+        lazy_json = myprotein.lazy_import('json.tool')
+        assert 'json.tool' not in sys.modules
+
+        assert lazy_json.tool is sys.modules['json.tool']
+        assert lazy_json.dumps is json.dumps
+    with pytest.raises(ModuleNotFoundError):
+        myprotein.lazy_import('not_a_module')
+
+
+def test_price_history(tmp_path: Any) -> None:
+    """Test that the lowest price in the window is found for every sku, across chunks and reopening."""
+    day = 24 * 60 * 60
+    history = myprotein.PriceHistory(str(tmp_path))
+    whey = ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 0.0, '1')
+    creatine = ProductInformation('creatine', 'Unflavored', '1.1 lb', 0.0, '2')
+
+    history.append([replace(whey, price=10.0), replace(creatine, price=30.0)], timestamp=0)
+    history.append([replace(whey, price=20.0), replace(creatine, price=25.0)], timestamp=5 * day)
+    history.append([replace(whey, price=15.0)], timestamp=8 * day)
+
+    with mock.patch.object(myprotein.PriceHistory, 'CHUNK_ROWS', 2):
+        reopened = myprotein.PriceHistory(str(tmp_path))
+        all_time = reopened.lowest_prices(days=10, now=9 * day)
+        last_week = reopened.lowest_prices(days=7, now=9 * day)
+
+    assert len(reopened) == 5
+    assert sorted(all_time) == [
+        myprotein.PriceLow('creatine', 'Unflavored', '1.1 lb', '2', 25.0, 25.0),
+        myprotein.PriceLow('impact_whey', 'Vanilla', '2.2 lb', '1', 10.0, 15.0),
+    ]
+    assert sorted(last_week) == [
+        myprotein.PriceLow('creatine', 'Unflavored', '1.1 lb', '2', 25.0, 25.0),
+        myprotein.PriceLow('impact_whey', 'Vanilla', '2.2 lb', '1', 15.0, 15.0),
+    ]
+
+
+def test_price_history_at_low(tmp_path: Any) -> None:
+    """Test that only skus of the latest run at their lowest price are returned."""
+    history = myprotein.PriceHistory(str(tmp_path))
+    whey = ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 0.0, '1')
+    isolate = ProductInformation('whey_isolate', 'Vanilla', '2.2 lb', 0.0, '2')
+    creatine = ProductInformation('creatine', 'Unflavored', '1.1 lb', 0.0, '3')
+
+    assert history.at_low(days=90) == []
+
+    history.append([replace(whey, price=10.0), replace(isolate, price=20.0), replace(creatine, price=5.0)], 100)
+    history.append([replace(whey, price=9.0), replace(isolate, price=25.0)], 200)
+
+    assert history.at_low(days=1, now=300) == [myprotein.PriceLow('impact_whey', 'Vanilla', '2.2 lb', '1', 9.0, 9.0)]
+
+
+def test_price_history_incomplete_append(tmp_path: Any) -> None:
+    """Test that a row missing from some columns, after an interrupted append, is ignored and then overwritten."""
+    history = myprotein.PriceHistory(str(tmp_path))
+    whey = ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 10.0, '1')
+    history.append([whey], timestamp=100)
+
+    with open(tmp_path / 'timestamp.bin', 'ab') as timestamps:
+        timestamps.write(bytes(8))
+
+    assert len(history) == 1
+    assert history.lowest_prices(days=1, now=100) == [
+        myprotein.PriceLow('impact_whey', 'Vanilla', '2.2 lb', '1', 10.0, 10.0)
+    ]
+
+    history.append([replace(whey, price=9.0)], timestamp=200)
+
+    assert len(history) == 2
+    assert os.path.getsize(tmp_path / 'timestamp.bin') == 2 * 8
+    assert history.lowest_prices(days=1, now=86550) == [
+        myprotein.PriceLow('impact_whey', 'Vanilla', '2.2 lb', '1', 9.0, 9.0)
+    ]
+    assert history.at_low(days=1, now=200) == [myprotein.PriceLow('impact_whey', 'Vanilla', '2.2 lb', '1', 9.0, 9.0)]
+
+
+def test_price_history_incomplete_strings(tmp_path: Any) -> None:
+    """Test that a string cut short by an interrupted append is ignored, and then overwritten by the next append."""
+    whey = ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 10.0, '1')
+    myprotein.PriceHistory(str(tmp_path)).append([whey], timestamp=100)
+    with open(tmp_path / 'strings.jsonl', 'a') as strings_file:
+        strings_file.write('"Chocol')
+
+    history = myprotein.PriceHistory(str(tmp_path))
+    assert history.lowest_prices(days=1, now=100) == [
+        myprotein.PriceLow('impact_whey', 'Vanilla', '2.2 lb', '1', 10.0, 10.0)
+    ]
+
+    history.append([replace(whey, flavour='Chocolate', sku='2')], timestamp=200)
+
+    assert sorted(myprotein.PriceHistory(str(tmp_path)).lowest_prices(days=1, now=200)) == [
+        myprotein.PriceLow('impact_whey', 'Chocolate', '2.2 lb', '2', 10.0, 10.0),
+        myprotein.PriceLow('impact_whey', 'Vanilla', '2.2 lb', '1', 10.0, 10.0),
+    ]
+
+
+@pytest.mark.parametrize(
+    'output_format, expected',
+    [
+        (
+            'jsonl',
+            '{"category": "impact_whey", "flavour": "Vanilla", "size": "2.2 lb", "price": 20.0, "sku": "2", '
+            '"price_per_kg": 20.04}\n'
+            '{"category": "impact_whey", "flavour": "Chocolate", "size": "2.2 lb", "price": 10.0, "sku": "1", '
+            '"price_per_kg": 10.02}\n',
+        ),
+        (
+            'csv',
+            'category,flavour,size,price,sku,region,price_per_kg\n'
+            'impact_whey,Vanilla,2.2 lb,20.0,2,,20.04\n'
+            'impact_whey,Chocolate,2.2 lb,10.0,1,,10.02\n',
+        ),
+        (
+            'table',
+            'category     flavour    size      price    sku    price_per_kg\n'
+            '-----------  ---------  ------  -------  -----  --------------\n'
+            'impact_whey  Chocolate  2.2 lb       10      1           10.02\n'
+            'impact_whey  Vanilla    2.2 lb       20      2           20.04\n',
+        ),
+    ],
+)
+def test_product_writers(output_format: str, expected: str) -> None:
+    """Test that streaming formats write products in the order they are priced and the table sorts them."""
+    output = io.StringIO()
+    writer = myprotein.OUTPUT_FORMATS[output_format](output)
+
+    writer.write(ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 20.0, '2'))
+    writer.write(ProductInformation('impact_whey', 'Chocolate', '2.2 lb', 10.0, '1'))
+    if output_format != 'table':
+        # Rows are available before the run finishes
+        assert output.getvalue() == expected
+    writer.close()
+
+    assert output.getvalue() == expected
+
+
+def test_product_writers_normalized() -> None:
+    """Test that prices of every region are converted to one currency, and left empty when the region isn't known."""
+    output = io.StringIO()
+    normalizer = myprotein.PriceNormalizer('USD', {'USD': 1.0, 'GBP': 1.5})
+    writer = myprotein.OUTPUT_FORMATS['csv'](output, normalizer=normalizer)
+
+    writer.write(ProductInformation('impact_whey', 'Vanilla', '1kg', 20.0, '1', 'uk'))
+    writer.write(ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 20.0, '1', 'us'))
+    writer.write(ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 20.0, '1', 'au'))
+    writer.write(ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 20.0, '1'))
+
+    assert output.getvalue().splitlines() == [
+        'category,flavour,size,price,sku,region,price_per_kg,price_usd',
+        'impact_whey,Vanilla,1kg,20.0,1,uk,20.0,30.0',
+        'impact_whey,Vanilla,2.2 lb,20.0,1,us,20.04,20.0',
+        # No rate for AUD
+        'impact_whey,Vanilla,2.2 lb,20.0,1,au,20.04,',
+        'impact_whey,Vanilla,2.2 lb,20.0,1,,20.04,',
+    ]
+    # Built in rates by default
+    assert myprotein.PriceNormalizer('EUR').rates == myprotein.EXCHANGE_RATES
+
+
+def test_parse_cli_currency_requires_regions(capsys: Any) -> None:
+    """Test that --currency is rejected for the single site, whose prices it couldn't convert."""
+    with mock.patch.object(sys, 'argv', ['myprotein.py', '--currency', 'USD']), pytest.raises(SystemExit):
+        myprotein.parse_cli()
+
+    assert '--currency converts the prices of --regions' in capsys.readouterr().err
+
+
+def test_product_row() -> None:
+    """Test that the region is only output when there is one."""
+    product = ProductInformation('impact_whey', 'Vanilla', 'Single', 20.0, '1')
+
+    assert 'region' not in myprotein.product_row(product)
+    assert myprotein.product_row(product)['price_per_kg'] is None
+    assert myprotein.product_row(replace(product, region='uk'))['region'] == 'uk'
+
+
+def test_parse_rates() -> None:
+    assert myprotein.parse_rates(['gbp=1.25', ' EUR = 1.1']) == {'GBP': 1.25, 'EUR': 1.1}
+
+    with pytest.raises(ValueError, match="Invalid rate 'GBP'"):
+        myprotein.parse_rates(['GBP'])
+
+
+def test_catalog(tmp_path: Any) -> None:
+    """Test that categories are found by name and id, and survive saving and loading."""
+    path = str(tmp_path / 'data' / 'catalog.json')
+    whey = ProductInformation('impact_whey', 'Unflavored', '2.2 lb', 0.0, '1111')
+    catalog = myprotein.Catalog({'10852500': whey})
+    catalog.update({'99': ProductInformation('creatine', 'Unflavored', '1.1 lb', 0.0)})
+    catalog.save(path)
+
+    loaded = myprotein.Catalog.load(path)
+
+    assert len(loaded) == 2
+    assert loaded['10852500'] == whey
+    assert loaded.find('creatine') == '99'
+    assert loaded.names() == ['creatine', 'impact_whey']
+    # Sorted once
+    assert loaded.names() is loaded.names()
+    assert 'impact_whey' in loaded
+
+    # A rediscovered category can be renamed
+    loaded.update({'99': ProductInformation('creapure', 'Unflavored', '1.1 lb', 0.0)})
+    assert loaded.names() == ['creapure', 'impact_whey']
+    with pytest.raises(KeyError, match='creatine is not in the catalog'):
+        loaded.find('creatine')
+
+
+def test_get_catalog(tmp_path: Any) -> None:
+    """Test that discovered categories are loaded on top of the built in ones."""
+    path = str(tmp_path / 'catalog.json')
+    discovered = ProductInformation('new_whey', 'Vanilla', '5.5 lb', 0.0, '2222')
+    myprotein.Catalog({'123': discovered}).save(path)
+
+    assert myprotein.get_catalog().names() == sorted(i.category for i in myprotein.PRODUCT_INFORMATION.values())
+
+    with mock.patch.object(myprotein, 'CATALOG_PATH', path):
+        catalog = myprotein.get_catalog()
+        product_category_id = myprotein.get_product_information('new_whey')
+
+    assert len(catalog) == len(myprotein.PRODUCT_INFORMATION) + 1
+    assert catalog[product_category_id] == discovered
+    assert catalog['10852500'] == myprotein.PRODUCT_INFORMATION['10852500']
+
+
+def test_get_default_product_id_cached(sku_cache: myprotein.SkuCache) -> None:
+    """Test that default products are kept in the sku cache, per site, and looked up again once they expire."""
+    base_url = 'https://www.myprotein.com'
+
+    with mock.patch.object(myprotein, 'get_default_product_not_found', side_effect=['1111', '2222', '3333']) as lookup:
+        assert myprotein.get_default_product_id('10852500', None, None, sku_cache) == '1111'
+        assert myprotein.get_default_product_id('10852500', None, None, sku_cache) == '1111'
+        assert myprotein.get_default_product_id('10852500', None, base_url, sku_cache) == '2222'
+        with mock.patch.object(sku_cache, 'ttl', 0), mock.patch.object(time, 'time', return_value=time.time() + 1):
+            assert myprotein.get_default_product_id('10852500', None, None, sku_cache) == '3333'
+
+    assert lookup.call_args_list == [
+        mock.call('10852500', None, None),
+        mock.call('10852500', None, base_url),
+        mock.call('10852500', None, None),
+    ]
+    assert sku_cache.get_default('10852500') == '3333'
+
+    sku_cache.invalidate(['10852500'])
+    assert sku_cache.get_default('10852500') is None
+    assert sku_cache.get_default('10852500', base_url) is None
+
+
+VARIATIONS_MARKUP = '''
+<div data-variation-container="productVariations" data-child-id="{product_id}">
+<select class="productVariations_dropdown" data-variation-id="5">
+<option value="111" {flavour_selected}>Vanilla</option>
+<option value="112">Chocolate</option>
+</select>
+<select class="productVariations_dropdown" data-variation-id="7">
+<option value="">Choose a size</option>
+<option value="221">1.1 lb</option>
+<option value="222"
+selected>2.2 lb</option>
+</select>
+</div>
+'''
+
+
+def test_find_variation_options() -> None:
+    markup = VARIATIONS_MARKUP.format(product_id='1', flavour_selected='selected')
+
+    assert myprotein.find_variation_options(markup) == {'5': (111, [111, 112]), '7': (222, [221, 222])}
+    assert myprotein.find_variation_options('<div data-child-id="1"></div>') == {}
+
+
+@pytest.mark.parametrize(
+    'size, expected_product_id', [(myprotein.Option(222, '2.2 lb'), '1234'), (myprotein.Option(223, '5.5 lb'), None)]
+)
+def test_resolve_options_to_product_id_from_markup(
+    mocked_responses: Any, size: myprotein.Option, expected_product_id: Optional[str]
+) -> None:
+    """Test that markup selecting the requested flavour tells whether the size exists, without the default product."""
+    mocked_responses.add(
+        responses.POST,
+        'https://us.myprotein.com/10852500.variations',
+        body=VARIATIONS_MARKUP.format(product_id='1234', flavour_selected='selected'),
+    )
+    flavour = myprotein.Option(111, 'Vanilla')
+
+    if expected_product_id:
+        assert myprotein.resolve_options_to_product_id('10852500', flavour, size) == expected_product_id
+    else:
+        with pytest.raises(myprotein.ProductNotExistError):
+            myprotein.resolve_options_to_product_id('10852500', flavour, size)
+
+    assert len(mocked_responses.calls) == 1
+    index = myprotein.get_variation_index()
+    assert index.is_sold(myprotein.Job('10852500', flavour, myprotein.Option(221, '1.1 lb')))
+    assert index.is_sold(myprotein.Job('10852500', flavour, myprotein.Option(223, '5.5 lb'))) is False
+    assert index.is_sold(myprotein.Job('10852500', myprotein.Option(112, 'Chocolate'), size)) is None
+    # Other sites may sell other sizes
+    assert index.is_sold(myprotein.Job('10852500', flavour, size, 'https://www.myprotein.com')) is None
+
+
+def test_resolve_options_to_product_id_other_region(mocked_responses: Any) -> None:
+    """Test that the default product of another site is told from its own product page, not the catalog."""
+    base_url = 'https://www.myprotein.com'
+    mocked_responses.add(
+        responses.GET,
+        f'{base_url}/10852500.html',
+        body='''
+            <select id="athena-product-variation-dropdown-5"><option value="111">Vanilla</option></select>
+            <ul class="athenaProductVariations_list"><li><button data-option-id="221">1kg</button></li></ul>
+        ''',
+    )
+    mocked_responses.add(responses.GET, f'{base_url}/10852500.variations', body='<div data-child-id="1111">')
+    mocked_responses.add(
+        responses.POST,
+        f'{base_url}/10852500.variations',
+        body=VARIATIONS_MARKUP.format(product_id='1111', flavour_selected=''),
+    )
+    size = myprotein.Option(221, '1kg')
+
+    vanilla, chocolate = myprotein.Option(111, 'Vanilla'), myprotein.Option(112, 'Chocolate')
+
+    product_id = myprotein.resolve_options_to_product_id('10852500', vanilla, size, None, base_url)
+    with pytest.raises(myprotein.ProductNotExistError):
+        myprotein.resolve_options_to_product_id('10852500', chocolate, size, None, base_url)
+
+    assert product_id == '1111'
+
+
+def test_resolve_options_to_product_id_other_region_known_defaults(mocked_responses: Any) -> None:
+    """Test that the default options of another site are taken from its product page, when it was already fetched."""
+    base_url = 'https://www.myprotein.com'
+    vanilla, chocolate = myprotein.Option(111, 'Vanilla'), myprotein.Option(112, 'Chocolate')
+    size = myprotein.Option(221, '1kg')
+    myprotein.get_variation_index().learn_default_options(
+        '10852500', myprotein.ProductPage('url', [vanilla, chocolate], [size], {}), base_url
+    )
+    mocked_responses.add(responses.GET, f'{base_url}/10852500.variations', body='<div data-child-id="1111">')
+    mocked_responses.add(
+        responses.POST,
+        f'{base_url}/10852500.variations',
+        body=VARIATIONS_MARKUP.format(product_id='1111', flavour_selected=''),
+    )
+
+    with pytest.raises(myprotein.ProductNotExistError):
+        myprotein.resolve_options_to_product_id('10852500', chocolate, size, None, base_url)
+
+    # Only the default product and the variation, not the product page
+    assert [i.request.method for i in mocked_responses.calls] == ['POST', 'GET']
+
+    # Pages without options tell nothing
+    myprotein.get_variation_index().learn_default_options('222', myprotein.ProductPage('url', [], [], {}), base_url)
+    assert myprotein.get_variation_index().default_options('222', base_url) is None
+
+
+def test_resolve_options_to_product_id_default_flavour(
+    mock_responses_with_default_product_information: Any, sku_cache: myprotein.SkuCache
+) -> None:
+    """Test that a nonexistent size of the default flavour is detected, it used to be taken for the default product."""
+    mock_responses_with_default_product_information.add(
+        responses.POST,
+        'https://us.myprotein.com/10852500.variations',
+        body=VARIATIONS_MARKUP.format(product_id='1111', flavour_selected=''),
+    )
+
+    with pytest.raises(myprotein.ProductNotExistError):
+        myprotein.resolve_options_to_product_id(
+            '10852500', myprotein.Option(1, 'Unflavored'), myprotein.Option(2, '5.5 lb'), sku_cache=sku_cache
+        )
+
+    # The default product is only looked up once and kept in the sku cache
+    assert sku_cache.get_default('10852500') == '1111'
+    assert myprotein.get_default_product_id('10852500', sku_cache=sku_cache) == '1111'
+    assert len([i for i in mock_responses_with_default_product_information.calls if i.request.method == 'GET']) == 1
+
+
+def test_resolve_jobs_skips_sizes_not_sold() -> None:
+    """Test that other sizes of a flavour are only requested once the first resolution tells they are sold."""
+    flavour = myprotein.Option(1, 'flavour')
+    sizes = [myprotein.Option(i, f'size {i}') for i in range(1, 5)]
+    jobs = [myprotein.Job('111', flavour, i) for i in sizes]
+    requested = []
+
+    def fake_resolve(product_category_id: str, flavour: myprotein.Option, size: myprotein.Option, *_: Any) -> str:
+        requested.append(size)
+        myprotein.get_variation_index().learn(product_category_id, flavour.id, [1, 3])
+        return f'sku {size.id}'
+
+    with mock.patch.object(myprotein, 'resolve_options_to_product_id', side_effect=fake_resolve):
+        resolutions = collect_resolutions(jobs)
+
+    assert requested == [sizes[0], sizes[2]]
+    expected = [(1, 'sku 1'), (2, None), (3, 'sku 3'), (4, None)]
+    assert sorted((i.job.size.id, i.product_id) for i in resolutions) == expected
+    assert all(isinstance(i.error, myprotein.ProductNotExistError) for i in resolutions if i.product_id is None)
+
+
+def test_resolve_options_to_product_id_other_size_selected(
+    mock_responses_with_default_product_information: Any,
+) -> None:
+    """Test that markup selecting another size falls back to comparing to the default product."""
+    mock_responses_with_default_product_information.add(
+        responses.POST,
+        'https://us.myprotein.com/10852500.variations',
+        body=VARIATIONS_MARKUP.format(product_id='1234', flavour_selected='selected'),
+    )
+
+    product_id = myprotein.resolve_options_to_product_id(
+        '10852500', myprotein.Option(111, 'Vanilla'), myprotein.Option(221, '1.1 lb')
+    )
+
+    assert product_id == '1234'
+
+
+def test_resolve_jobs_error_cancels_pending() -> None:
+    """Test that an error is raised without waiting for the other resolutions."""
+    jobs = [myprotein.Job('111', myprotein.Option(i, 'flavour'), myprotein.Option(1, 'size')) for i in range(2)]
+
+    def fake_resolve(_: str, flavour: myprotein.Option, __: myprotein.Option, *___: Any) -> str:
+        if flavour.id == 0:
+            raise ValueError('bad markup')
+        time.sleep(0.1)
+        return 'sku'
+
+    with mock.patch.object(myprotein, 'resolve_options_to_product_id', side_effect=fake_resolve):
+        with pytest.raises(ValueError, match='bad markup'):
+            collect_resolutions(jobs)
+
+
+def conditional_callback(body: str) -> Any:
+    """Respond to conditional requests with 304, otherwise with body and an ETag."""
+
+    def callback(request: Any) -> Tuple[int, Dict[str, str], str]:
+        if request.headers.get('If-None-Match') == '"v1"':
+            return 304, {}, ''
+        return 200, {'ETag': '"v1"'}, body
+
+    return callback
+
+
+@pytest.mark.parametrize('parse_workers', [0, 1, 2])
+def test_fetch_product_pages(
+    mocked_responses: Any, response_cache: myprotein.ResponseCache, parse_workers: int
+) -> None:
+    """Test that pages are parsed in order, by the fetching threads or processes, and unmodified ones are reused."""
+    product_category_ids = [str(i) for i in range(6)]
+    for i in product_category_ids:
+        body = f'<select id="athena-product-variation-dropdown-5"><option value="{i}">flavour {i}</option></select>'
+        mocked_responses.add_callback(responses.GET, myprotein.product_page_url(i), conditional_callback(body))
+
+    options = myprotein.ScrapeOptions(3, response_cache=response_cache, parse_workers=parse_workers)
+    first = asyncio.run(myprotein.fetch_product_pages(product_category_ids, options))
+    second = asyncio.run(myprotein.fetch_product_pages(product_category_ids, options))
+
+    assert [i.flavours for i in first] == [[myprotein.Option(int(i), f'flavour {i}')] for i in product_category_ids]
+    assert all(i is j for i, j in zip(first, second))
+
+
+@pytest.mark.parametrize('parse_workers', [0, 1])
+def test_fetch_product_pages_retries(mocked_responses: Any, parse_workers: int) -> None:
+    """Test that throttled and failed pages are fetched again instead of parsed, until attempts run out."""
+    body = '<select id="athena-product-variation-dropdown-5"><option value="1">flavour</option></select>'
+    url = myprotein.product_page_url('1')
+    mocked_responses.add(responses.GET, url, status=429, headers={'Retry-After': '0'})
+    mocked_responses.add(responses.GET, url, status=503)
+    mocked_responses.add(responses.GET, url, body=body)
+
+    options = myprotein.ScrapeOptions(1, parse_workers=parse_workers)
+    with mock.patch.object(myprotein, 'RETRY_BACKOFF_SECONDS', 0):
+        (product_page,) = asyncio.run(myprotein.fetch_product_pages(['1'], options))
+        mocked_responses.replace(responses.GET, url, status=500)
+        with pytest.raises(requests.HTTPError):
+            asyncio.run(myprotein.fetch_product_pages(['1'], options))
+
+    assert product_page.flavours == [myprotein.Option(1, 'flavour')]
+    assert len(mocked_responses.calls) == 3 + myprotein.MAX_ATTEMPTS
+
+
+@pytest.mark.parametrize('parse_workers', [0, 1])
+def test_fetch_product_pages_concurrency(parse_workers: int) -> None:
+    """Test that no more than max_concurrency pages are fetched at once, whether or not they are parsed apart."""
+    lock = threading.Lock()
+    running: List[int] = [0]
+    most_running: List[int] = [0]
+
+    def fetch(product_category_id: str, *_: Any) -> myprotein.ProductPage:
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return myprotein.ProductPage(product_category_id, [], [], {})
+
+    product_category_ids = [str(i) for i in range(10)]
+    with mock.patch.object(myprotein, 'fetch_product_page', fetch), mock.patch.object(
+        myprotein, 'fetch_raw_product_page', fetch
+    ):
+        product_pages = asyncio.run(
+            myprotein.fetch_product_pages(product_category_ids, myprotein.ScrapeOptions(2, parse_workers=parse_workers))
+        )
+
+    assert [i.url for i in product_pages] == product_category_ids
+    assert most_running[0] == 2
+
+
+def test_discover_category_without_options(mocked_responses: Any) -> None:
+    mocked_responses.add(responses.GET, myprotein.product_page_url('1'), body='<html></html>')
+
+    with pytest.raises(ValueError, match='Could not find flavours and sizes'):
+        myprotein.discover_category('1')
+
+
+def test_fetch_product_pages_parse_error(mocked_responses: Any) -> None:
+    """Test that an error parsing a page in the process pool is raised."""
+    body = '<select id="athena-product-variation-dropdown-5"><option value="bad">flavour</option></select>'
+    mocked_responses.add(responses.GET, myprotein.product_page_url('1'), body=body)
+
+    with pytest.raises(ValueError):
+        asyncio.run(myprotein.fetch_product_pages(['1'], myprotein.ScrapeOptions(1, parse_workers=1)))
+
+
+def test_profiler_count_from_threads() -> None:
+    """Test that no count is lost when threads count at once."""
+    profiler = myprotein.Profiler()
+
+    def count() -> None:
+        for _ in range(10000):
+            profiler.count('retry')
+
+    threads = [threading.Thread(target=count) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert profiler.counters['retry'] == 80000
+
+
+def test_profiler(tmp_path: Any) -> None:
+    """Test that spans are summarized per stage and exported as a Chrome trace."""
+    profiler = myprotein.Profiler()
+    for i in range(1, 101):
+        profiler.record('resolve', profiler.start, profiler.start + i / 1000, bytes=10)
+    with pytest.raises(requests.ConnectionError):
+        with profiler.span('product_page', category='123') as span:
+            span['bytes'] = 5
+            raise requests.ConnectionError()
+    profiler.count('sku_cache_hit', 2)
+
+    summary = {i['stage']: i for i in profiler.summary()}
+    output = io.StringIO()
+    trace_path = tmp_path / 'trace.json'
+    myprotein.report_profile(profiler, str(trace_path), output)
+    with open(trace_path) as trace_file:
+        trace = json.load(trace_file)
+
+    resolve = summary['resolve']
+    assert (resolve['count'], resolve['bytes'], resolve['errors']) == (100, 1000, 0)
+    assert (resolve['p50_ms'], resolve['p95_ms'], resolve['p99_ms']) == pytest.approx((50, 95, 99))
+    assert resolve['per_second'] == pytest.approx(100 / 0.1)
+    assert (summary['product_page']['bytes'], summary['product_page']['errors']) == (5, 1)
+
+    assert 'resolve' in output.getvalue()
+    assert 'sku_cache_hit: 2' in output.getvalue()
+    assert len(trace['traceEvents']) == 101
+    assert trace['traceEvents'][-1]['args'] == {'category': '123', 'bytes': 5, 'error': 'ConnectionError'}
+    assert trace['traceEvents'][0]['dur'] == pytest.approx(1000)
+    assert trace['otherData'] == {'sku_cache_hit': 2}
+
+
+def test_null_profiler() -> None:
+    profiler = myprotein.NullProfiler()
+    with profiler.span('resolve') as span:
+        span['bytes'] = 10
+    profiler.record('resolve', 0, 1)
+    profiler.count('retry')
+
+    assert profiler.spans == []
+    assert profiler.summary() == []
+    assert not profiler.counters
+
+    output = io.StringIO()
+    myprotein.report_profile(profiler, output=output)
+    assert output.getvalue() == '\n'
+
+
+def test_profile_product_page(mocked_responses: Any, response_cache: myprotein.ResponseCache) -> None:
+    """Test that fetching, parsing and cache hits of product pages are profiled."""
+    body = '<select id="athena-product-variation-dropdown-5"><option value="111">flavour_name</option></select>'
+    mocked_responses.add_callback(responses.GET, myprotein.product_page_url('1'), conditional_callback(body))
+    profiler = myprotein.Profiler()
+
+    with mock.patch.object(myprotein, 'PROFILER', profiler):
+        myprotein.fetch_product_page('1', response_cache=response_cache)
+        myprotein.fetch_product_page('1', response_cache=response_cache)
+
+    url = myprotein.product_page_url('1')
+    assert [(i.stage, i.args) for i in profiler.spans] == [
+        ('product_page', {'category': '1', 'bytes': len(body)}),
+        ('product_options', {'url': url}),
+        ('price_data', {'url': url}),
+        ('parse', {'category': '1'}),
+        ('product_page', {'category': '1', 'bytes': 0}),
+    ]
+    assert profiler.counters == {'response_cache_hit': 1}
+
+
+def test_parse_vouchers() -> None:
+    """Test that vouchers without a code or a percentage are kept."""
+    html = '''
+    <ul class="navigation"><li>Vouchers</li></ul>
+    <div class="voucher-info-wrapper">
+        <h2>Extra 35% off protein</h2>
+        <div class="voucher-message"><p>Use code <b>PROTEIN35</b> at checkout</p></div>
+    </div>
+    <div class="voucher-info-wrapper">
+        <h2>Free shaker</h2>
+        <div class="voucher-message"><p>Added automatically on orders over $50</p></div>
+    </div>
+    '''
+
+    assert myprotein.parse_vouchers(html) == [
+        myprotein.Voucher('Extra 35% off protein', 'Use code \nPROTEIN35\n at checkout', 'PROTEIN35', 35.0),
+        myprotein.Voucher('Free shaker', 'Added automatically on orders over $50'),
+    ]
+
+
+def test_print_vouchers() -> None:
+    output = io.StringIO()
+    myprotein.print_vouchers([myprotein.Voucher('5% off', 'Use code: SAVE5', 'SAVE5', 5.0)], output)
+
+    assert output.getvalue() == f'Vouchers:\n{"=" * 80}\n5% off\nUse code: SAVE5\n{"-" * 80}\n'
+
+
+def test_parse_voucher_rule() -> None:
+    voucher = myprotein.Voucher('25% off Whey', 'Use code WHEY25 on orders over $60', 'WHEY25', 25.0)
+
+    assert myprotein.parse_voucher_rule(voucher) == myprotein.VoucherRule('WHEY25', 25.0, 60.0, frozenset({'whey'}))
+    assert myprotein.parse_voucher_rule(myprotein.Voucher('Free shaker', 'With every order')) is None
+    assert myprotein.parse_voucher_rule(
+        myprotein.Voucher('10% off everything', 'Use code: SAVE10', 'SAVE10', 10.0)
+    ) == myprotein.VoucherRule('SAVE10', 10.0, 0.0, None)
+
+
+def test_pricing_engine() -> None:
+    """Test that every product gets the best voucher that applies to its category and reaches its threshold."""
+    vouchers = [
+        myprotein.Voucher('10% off everything', 'Use code: SAVE10', 'SAVE10', 10.0),
+        myprotein.Voucher('5% off', 'When you spend $100', 'BIG5', 5.0),
+        myprotein.Voucher('30% off whey', 'On orders over $50', 'WHEY30', 30.0),
+        myprotein.Voucher('15% off creatine', 'Use code CREA15', 'CREA15', 15.0),
+        myprotein.Voucher('Free shaker', 'With every order'),
+    ]
+    cheap_whey = ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 40.0, '1')
+    whey = ProductInformation('impact_whey', 'Vanilla', '5.5 lb', 80.0, '2')
+    creatine = ProductInformation('creapure', 'Unflavored', '1.1 lb', 20.0, '3')
+    pouch = ProductInformation('whey_pouch', 'Vanilla', '0.55 lb', 120.0, '4')
+    tablets = ProductInformation('creapure', 'Unflavored', '180 Tablets', 10.0, '5')
+    engine = myprotein.PricingEngine(vouchers)
+
+    # Cheapest per kg after vouchers first, though the smaller sizes cost less
+    assert engine.rank([cheap_whey, whey, tablets, creatine, pouch]) == [
+        myprotein.EffectivePrice(whey, 56.0, 'WHEY30'),
+        myprotein.EffectivePrice(creatine, 17.0, 'CREA15'),
+        myprotein.EffectivePrice(cheap_whey, 36.0, 'SAVE10'),
+        myprotein.EffectivePrice(pouch, 84.0, 'WHEY30'),
+        myprotein.EffectivePrice(tablets, 8.5, 'CREA15'),
+    ]
+    assert myprotein.EffectivePrice(whey, 56.0, 'WHEY30').effective_price_per_kg == pytest.approx(22.45, abs=0.01)
+    assert myprotein.PricingEngine([]).effective_price(whey) == myprotein.EffectivePrice(whey, 80.0, None)
+
+
+def test_print_effective_prices() -> None:
+    output = io.StringIO()
+    product = ProductInformation('impact_whey', 'Vanilla', '2.2 lb', 40.0, '1')
+    myprotein.print_effective_prices(
+        [myprotein.EffectivePrice(product, 36.0, 'SAVE10'), myprotein.EffectivePrice(product, 40.0, None)], output
+    )
+
+    assert output.getvalue().splitlines()[2:] == [
+        'impact_whey  Vanilla    2.2 lb       40      1           40.08                 36                     36.08'
+        '  SAVE10',
+        'impact_whey  Vanilla    2.2 lb       40      1           40.08                 40                     40.08',
+    ]
+
+
+@pytest.mark.parametrize(
+    'size, expected',
+    [
+        ('2.2 lb', myprotein.Size(997.903214, None)),
+        ('11 lbs', myprotein.Size(4989.51607, None)),
+        ('1000g', myprotein.Size(1000.0, None)),
+        ('2 x 2.5kg', myprotein.Size(5000.0, None)),
+        ('8 oz', myprotein.Size(226.796185, None)),
+        ('250g (10 Servings)', myprotein.Size(250.0, 10)),
+        ('180 Tablets', myprotein.Size(None, 180)),
+        ('Single', myprotein.Size(None, None)),
+    ],
+)
+def test_parse_size(size: str, expected: myprotein.Size) -> None:
+    parsed = myprotein.parse_size(size)
+
+    assert parsed.servings == expected.servings
+    assert parsed.grams == pytest.approx(expected.grams)
+
+
+def test_product_sort_key() -> None:
+    """Test that sizes sort by weight rather than alphabetically."""
+    products = [
+        ProductInformation('impact_whey', 'Vanilla', size, 10.0) for size in ('11 lb', '180 Tablets', '2.2 lb', '500g')
+    ]
+
+    assert [i.size for i in sorted(products, key=myprotein.product_sort_key)] == [
+        '500g',
+        '2.2 lb',
+        '11 lb',
+        '180 Tablets',
+    ]
+
+
+def test_top_products() -> None:
+    """Test that only the n cheapest products per kg are kept, and sizes that aren't weights are skipped."""
+    top_products = myprotein.TopProducts(2)
+    sizes = [('1kg', 30.0), ('2.5kg', 50.0), ('Single', 1.0), ('500g', 10.0), ('1kg', 40.0)]
+    for sku, (size, price) in enumerate(sizes):
+        top_products.push(ProductInformation('impact_whey', 'Vanilla', size, price, str(sku)))
+
+    assert [i.sku for i in top_products.products()] == ['1', '3']
+
+
+def test_table_writer_sorted_by_price_per_kg() -> None:
+    output = io.StringIO()
+    writer = myprotein.TableWriter(output, myprotein.price_per_kg_sort_key)
+    for size, price in [('Single', 1.0), ('1kg', 30.0), ('500g', 10.0)]:
+        writer.write(ProductInformation('impact_whey', 'Vanilla', size, price))
+    writer.close()
+
+    assert [i.split()[2] for i in output.getvalue().splitlines()[2:]] == ['500g', '1kg', 'Single']
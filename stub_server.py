@@ -0,0 +1,363 @@
+#! env python
+"""Local stand-in for the myprotein site, for load and concurrency testing.
+
+Serves a generated catalog through the same endpoints the scraper uses:
+
+- GET /{id}.html: product page with flavour and size options and ld+json prices, supporting If-None-Match
+- GET /{id}.variations: default product
+- POST /{id}.variations: resolve flavour and size, falling back to the default product when the variation doesn't exist
+- GET /voucher-codes.list: voucher list
+
+Point the scraper at it with --base-url or MYPROTEIN_BASE_URL.
+"""
+import argparse
+import collections
+import hashlib
+import http.server
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from typing import Counter
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import myprotein
+
+# Real product pages are a few hundred kB, mostly navigation, reviews and footer markup
+PAGE_FILLER_BYTES = 400_000
+PRODUCT_PATH_PATTERN = re.compile(r'^/(?P<product_category_id>\w+)\.(?P<kind>html|variations)$')
+
+
+class Category:  # pylint: disable=too-few-public-methods
+    """Flavours, sizes and product ids of one product category.
+
+    The first flavour and size are the default product. Roughly missing_ratio of the other combinations don't exist,
+    like on the real site.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        product_category_id: str,
+        default: myprotein.ProductInformation,
+        num_flavours: int,
+        num_sizes: int,
+        missing_ratio: float,
+        rng: random.Random,
+    ) -> None:
+        self.product_category_id = product_category_id
+        self.name = default.category
+        self.flavours = [myprotein.Option(20000 + i, f'Flavour {i}') for i in range(1, num_flavours)]
+        self.flavours.insert(0, myprotein.Option(20000, default.flavour))
+        self.sizes = [myprotein.Option(16000 + i, f'{0.5 * i} lb') for i in range(1, num_sizes)]
+        self.sizes.insert(0, myprotein.Option(16000, default.size))
+
+        combinations = list(itertools.product(self.flavours, self.sizes))
+        self.product_ids: Dict[Tuple[int, int], str] = {
+            (flavour.id, size.id): f'{product_category_id}{index:04}'
+            for index, (flavour, size) in enumerate(combinations)
+            if index == 0 or rng.random() >= missing_ratio
+        }
+        self.prices = {product_id: round(rng.uniform(10, 100), 2) for product_id in self.product_ids.values()}
+        self.options = {product_id: options for options, product_id in self.product_ids.items()}
+
+    @property
+    def default_product_id(self) -> str:
+        return self.product_ids[(self.flavours[0].id, self.sizes[0].id)]
+
+    def sizes_of(self, flavour_id: int) -> List[myprotein.Option]:
+        """Sizes sold in a flavour."""
+        return [i for i in self.sizes if (flavour_id, i.id) in self.product_ids]
+
+
+class Catalog:  # pylint: disable=too-few-public-methods
+    """Generated catalog of num_categories categories.
+
+    The known categories in myprotein.PRODUCT_INFORMATION come first, so the scraper can query them by name. The others
+    can be added to the scraper's catalog with discovery.
+    """
+
+    def __init__(
+        self, num_categories: int, num_flavours: int, num_sizes: int, *, missing_ratio: float = 0.1, seed: int = 0
+    ) -> None:
+        rng = random.Random(seed)
+        known = list(myprotein.PRODUCT_INFORMATION.items())
+        self.categories: Dict[str, Category] = {}
+
+        for index in range(num_categories):
+            if index < len(known):
+                product_category_id, default = known[index]
+            else:
+                product_category_id = str(90000000 + index)
+                default = myprotein.ProductInformation(f'category_{index}', 'Unflavored', '2.2 lb', 0.0)
+
+            self.categories[product_category_id] = Category(
+                product_category_id, default, num_flavours, num_sizes, missing_ratio, rng
+            )
+
+
+class Latency:  # pylint: disable=too-few-public-methods
+    """Response delay, lognormal around median seconds with spread sigma. Sigma of 0 gives a constant delay."""
+
+    def __init__(self, median: float, sigma: float = 0.0, seed: int = 0) -> None:
+        self.median = median
+        self.sigma = sigma
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        if not self.median:
+            return 0.0
+
+        with self._lock:
+            return self.median * self._rng.lognormvariate(0, self.sigma)
+
+
+def render_filler(num_bytes: int) -> str:
+    block = '<li class="navigation_item"><a class="navigation_link" href="/nutrition/protein.list">Protein</a></li>\n'
+    return '<ul class="navigation">\n' + block * (num_bytes // len(block)) + '</ul>\n'
+
+
+def render_product_page(category: Category, filler_bytes: int = PAGE_FILLER_BYTES) -> str:
+    flavour_options = ''.join(f'<option value="{i.id}">\n{i.name}\n</option>\n' for i in category.flavours)
+    size_buttons = ''.join(
+        f'<li class="athenaProductVariations_listItem">'
+        f'<button class="athenaProductVariations_box" data-option-id="{i.id}">\n{i.name}\n</button></li>\n'
+        for i in category.sizes
+    )
+    offers = [{'@type': 'Offer', 'sku': sku, 'price': f'{price:.2f}'} for sku, price in category.prices.items()]
+    ld_json = json.dumps({'@context': 'http://schema.org', '@type': 'Product', 'name': category.name, 'offers': offers})
+
+    return f'''<html>
+<head>
+<script type="application/ld+json">{{"@context": "http://schema.org", "@type": "Organization"}}</script>
+</head>
+<body>
+{render_filler(filler_bytes // 2)}
+<select id="athena-product-variation-dropdown-5">
+{flavour_options}</select>
+<ul class="athenaProductVariations_list" aria-label="Amount">
+{size_buttons}</ul>
+<script type="application/ld+json">{ld_json}</script>
+{render_filler(filler_bytes // 2)}
+</body>
+</html>
+'''
+
+
+def render_dropdown(variation_id: str, options: List[myprotein.Option], selected_id: int) -> str:
+    option_html = ''.join(
+        f'<option value="{i.id}"{" selected" if i.id == selected_id else ""}>\n{i.name}\n</option>\n' for i in options
+    )
+    return f'''<div class="productVariations_dropdownSegment">
+<select class="productVariations_dropdown" data-variation-id="{variation_id}">
+{option_html}</select>
+</div>
+'''
+
+
+def render_variations(category: Category, product_id: str) -> str:
+    """Render the variations of product_id, with its flavour and size selected and the sizes sold in its flavour."""
+    flavour_id, size_id = category.options[product_id]
+    return f'''<div
+    data-variation-container="productVariations"
+    data-child-id="{product_id}"
+    data-information-url="sports-nutrition/product/{product_id}.html"
+    data-information-current-quantity-basket="0"
+    data-information-maximum-allowed-quantity="5000"
+>
+{render_dropdown(myprotein.FLAVOUR_VARIATION_ID, category.flavours, flavour_id)}\
+{render_dropdown(myprotein.SIZE_VARIATION_ID, category.sizes_of(flavour_id), size_id)}\
+</div>
+'''
+
+
+def render_vouchers(num_vouchers: int, filler_bytes: int = PAGE_FILLER_BYTES // 4) -> str:
+    vouchers = ''.join(
+        f'''<div class="voucher-info-wrapper">
+<h2>{i * 5}% off everything</h2>
+<div class="voucher-message"><p>Use code: SAVE{i * 5}</p><p>Ends midnight.</p></div>
+</div>
+'''
+        for i in range(1, num_vouchers + 1)
+    )
+    return f'<html><body>{render_filler(filler_bytes)}{vouchers}</body></html>'
+
+
+class StubServer(http.server.ThreadingHTTPServer):  # pylint: disable=too-many-instance-attributes
+    daemon_threads = True
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        address: Tuple[str, int],
+        catalog: Catalog,
+        latency: Optional[Latency] = None,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: int = 1,
+        seed: int = 0,
+    ) -> None:
+        super().__init__(address, StubRequestHandler)
+        self.host = address[0]
+        self.catalog = catalog
+        self.latency = latency or Latency(0)
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.product_pages = {i: render_product_page(category) for i, category in catalog.categories.items()}
+        self.vouchers = render_vouchers(10)
+        # Requests received, by method
+        self.request_counts: Counter[str] = collections.Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.server_address[1]}'
+
+    def roll(self, method: str) -> float:
+        """Count a request and roll the dice for its simulated failure."""
+        with self._lock:
+            self.request_counts[method] += 1
+            return self._rng.random()
+
+
+class StubRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, like the real site
+    protocol_version = 'HTTP/1.1'
+    server: StubServer
+
+    def log_message(self, format: str, *args: object) -> None:  # pylint: disable=redefined-builtin
+        pass
+
+    def send_body(self, status: int, body: str, headers: Optional[Dict[str, str]] = None) -> None:
+        encoded = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(encoded)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def simulate_network(self) -> bool:
+        """Wait for the simulated latency, then maybe fail the request. Return True if a response was already sent."""
+        time.sleep(self.server.latency.sample())
+
+        roll = self.server.roll(self.command)
+        if roll < self.server.throttle_rate:
+            self.send_body(429, 'Too Many Requests', {'Retry-After': str(self.server.retry_after)})
+            return True
+        if roll < self.server.throttle_rate + self.server.error_rate:
+            self.send_body(500, 'Internal Server Error')
+            return True
+        return False
+
+    def find_category(self) -> Tuple[Optional[Category], str]:
+        match = PRODUCT_PATH_PATTERN.match(self.path)
+        if not match:
+            return None, ''
+        return self.server.catalog.categories.get(match.group('product_category_id')), match.group('kind')
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        if self.simulate_network():
+            return
+
+        if self.path == myprotein.VOUCHER_PATH:
+            self.send_body(200, self.server.vouchers)
+            return
+
+        category, kind = self.find_category()
+        if category is None:
+            self.send_body(404, 'Not Found')
+        elif kind == 'html':
+            product_page = self.server.product_pages[category.product_category_id]
+            etag = f'"{hashlib.sha1(product_page.encode()).hexdigest()}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_body(304, '', {'ETag': etag})
+            else:
+                self.send_body(200, product_page, {'ETag': etag})
+        else:
+            self.send_body(200, render_variations(category, category.default_product_id))
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.simulate_network():
+            return
+
+        category, kind = self.find_category()
+        if category is None or kind != 'variations':
+            self.send_body(404, 'Not Found')
+            return
+
+        options = json.loads(body or b'{}')
+        # Like the real site, unknown variations silently resolve to the default product
+        product_id = category.default_product_id
+        if options.get('selected') == 2:
+            key = (int(options.get('option1', 0)), int(options.get('option2', 0)))
+            product_id = category.product_ids.get(key, category.default_product_id)
+
+        self.send_body(200, render_variations(category, product_id))
+
+
+def start_server(server: StubServer) -> threading.Thread:
+    """Serve in a background thread, stop it with server.shutdown()."""
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def parse_cli(argv: Optional[List[str]] = None) -> argparse.Namespace:  # pragma: no cover
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--categories', help='Categories in the catalog (default: %(default)s)', type=int, default=7)
+    parser.add_argument('--flavours', help='Flavours per category (default: %(default)s)', type=int, default=40)
+    parser.add_argument('--sizes', help='Sizes per category (default: %(default)s)', type=int, default=5)
+    parser.add_argument(
+        '--missing-ratio', help='Share of variations that do not exist (default: %(default)s)', type=float, default=0.1
+    )
+    parser.add_argument(
+        '--latency', help='Median response latency in seconds (default: %(default)s)', type=float, default=0.05
+    )
+    parser.add_argument(
+        '--latency-sigma', help='Spread of the lognormal latency (default: %(default)s)', type=float, default=0.5
+    )
+    parser.add_argument(
+        '--error-rate', help='Share of requests failing with 500 (default: %(default)s)', type=float, default=0.0
+    )
+    parser.add_argument(
+        '--throttle-rate', help='Share of requests failing with 429 (default: %(default)s)', type=float, default=0.0
+    )
+    parser.add_argument(
+        '--retry-after', help='Retry-After seconds sent with 429 (default: %(default)s)', type=int, default=1
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main() -> None:  # pragma: no cover
+    args = parse_cli()
+    catalog = Catalog(args.categories, args.flavours, args.sizes, missing_ratio=args.missing_ratio, seed=args.seed)
+    server = StubServer(
+        (args.host, args.port),
+        catalog,
+        Latency(args.latency, args.latency_sigma, args.seed),
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    print(f'Serving {len(catalog.categories)} categories on {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,618 @@
+# Disable redefined function name warning because that's how pytest fixtures work by default
+# pylint: disable=redefined-outer-name
+import asyncio
+import sys
+from dataclasses import replace
+from typing import Any
+from typing import Iterator
+from typing import List
+from typing import Optional
+from unittest import mock
+
+import pytest
+import requests
+
+import myprotein
+import stub_server
+
+
+@pytest.fixture(autouse=True)
+def clear_caches() -> Iterator[None]:
+    '''Forget fetched pages between tests, like pytest-antilru does for lru_cache.'''
+    yield
+    myprotein.clear_caches()
+
+
+@pytest.fixture
+def catalog() -> stub_server.Catalog:
+    return stub_server.Catalog(num_categories=2, num_flavours=3, num_sizes=2, missing_ratio=0.5, seed=1)
+
+
+@pytest.fixture
+def server(catalog: stub_server.Catalog) -> Iterator[stub_server.StubServer]:
+    server = stub_server.StubServer(('127.0.0.1', 0), catalog)
+    stub_server.start_server(server)
+    with mock.patch.object(myprotein, 'BASE_URL', server.base_url):
+        yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_catalog(catalog: stub_server.Catalog) -> None:
+    """Test that known categories come first with their default product."""
+    product_category_id, default = next(iter(myprotein.PRODUCT_INFORMATION.items()))
+    category = catalog.categories[product_category_id]
+
+    assert len(catalog.categories) == 2
+    assert category.flavours[0].name == default.flavour
+    assert category.sizes[0].name == default.size
+    assert category.default_product_id in category.prices
+
+
+def test_catalog_generated_categories() -> None:
+    """Test that categories beyond the known ones are generated."""
+    catalog = stub_server.Catalog(len(myprotein.PRODUCT_INFORMATION) + 1, num_flavours=2, num_sizes=2)
+
+    assert len(catalog.categories) == len(myprotein.PRODUCT_INFORMATION) + 1
+    assert set(myprotein.PRODUCT_INFORMATION) < set(catalog.categories)
+
+
+def test_latency() -> None:
+    assert stub_server.Latency(0).sample() == 0
+    assert stub_server.Latency(0.5).sample() == 0.5
+    assert stub_server.Latency(0.5, sigma=1).sample() > 0
+
+
+@pytest.mark.usefixtures('server')
+def test_scrape_from_server(catalog: stub_server.Catalog) -> None:
+    """Test that the scraper resolves every existing variation from the stand-in server."""
+    product_category_id = next(iter(catalog.categories))
+    category = catalog.categories[product_category_id]
+    session = myprotein.create_session(retries=0)
+
+    flavours, sizes = myprotein.get_all_products(product_category_id, session)
+    price_data = myprotein.get_price_data(product_category_id, session)
+
+    assert flavours == category.flavours
+    assert sizes == category.sizes
+    assert price_data == category.prices
+    assert myprotein.get_default_product_not_found(product_category_id, session) == category.default_product_id
+
+    for (flavour_id, size_id), product_id in category.product_ids.items():
+        flavour = next(i for i in flavours if i.id == flavour_id)
+        size = next(i for i in sizes if i.id == size_id)
+        assert myprotein.resolve_options_to_product_id(product_category_id, flavour, size, session) == product_id
+
+
+def test_nonexistent_variation_falls_back_to_default(server: stub_server.StubServer) -> None:
+    """Test that unknown options resolve to the default product, like the real site."""
+    product_category_id = next(iter(server.catalog.categories))
+    category = server.catalog.categories[product_category_id]
+
+    response = requests.post(
+        myprotein.variations_url(product_category_id),
+        json={'selected': 2, 'variation1': '5', 'option1': 1, 'variation2': '7', 'option2': 2},
+    )
+
+    assert myprotein.find_child_id(response.text) == category.default_product_id
+
+    # Without selected the options are ignored
+    flavour_id, size_id = next(i for i in category.product_ids if i != (category.flavours[0].id, category.sizes[0].id))
+    response = requests.post(
+        myprotein.variations_url(product_category_id),
+        json={'variation1': '5', 'option1': flavour_id, 'variation2': '7', 'option2': size_id},
+    )
+
+    assert myprotein.find_child_id(response.text) == category.default_product_id
+
+
+def test_vouchers(server: stub_server.StubServer) -> None:
+    response = requests.get(myprotein.voucher_url())
+
+    assert response.text == server.vouchers
+    assert response.text.count('voucher-info-wrapper') == 10
+
+
+@pytest.mark.usefixtures('server')
+def test_not_found() -> None:
+    assert requests.get(myprotein.product_page_url('unknown')).status_code == 404
+    assert requests.get(f'{myprotein.BASE_URL}/unknown').status_code == 404
+    assert requests.post(myprotein.product_page_url('unknown')).status_code == 404
+
+
+@pytest.mark.parametrize(('error_rate', 'throttle_rate', 'status_code'), [(1.0, 0.0, 500), (0.0, 1.0, 429)])
+def test_injected_errors(
+    catalog: stub_server.Catalog, error_rate: float, throttle_rate: float, status_code: int
+) -> None:
+    server = stub_server.StubServer(
+        ('127.0.0.1', 0), catalog, error_rate=error_rate, throttle_rate=throttle_rate, retry_after=3
+    )
+    stub_server.start_server(server)
+
+    with mock.patch.object(myprotein, 'BASE_URL', server.base_url):
+        get_response = requests.get(myprotein.voucher_url())
+        post_response = requests.post(myprotein.variations_url(next(iter(catalog.categories))))
+
+    server.shutdown()
+    server.server_close()
+
+    assert get_response.status_code == post_response.status_code == status_code
+    if status_code == 429:
+        assert get_response.headers['Retry-After'] == '3'
+
+
+def test_server_errors_retried_once_per_attempt(catalog: stub_server.Catalog) -> None:
+    """Test that only resolve_jobs retries server errors, so that every failure reaches its limiter."""
+    server = stub_server.StubServer(('127.0.0.1', 0), catalog, error_rate=1.0)
+    stub_server.start_server(server)
+    category = next(iter(catalog.categories.values()))
+    job = myprotein.Job(category.product_category_id, category.flavours[0], category.sizes[0])
+
+    async def collect() -> List[myprotein.Resolution]:
+        return [i async for i in myprotein.resolve_jobs([job], session=myprotein.create_session())]
+
+    try:
+        with mock.patch.object(myprotein, 'BASE_URL', server.base_url), mock.patch.object(
+            myprotein, 'RETRY_BACKOFF_SECONDS', 0
+        ):
+            (resolution,) = asyncio.run(collect())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert isinstance(resolution.error, requests.HTTPError)
+    assert server.request_counts['POST'] == myprotein.MAX_ATTEMPTS
+
+
+def test_throttled_pages_retried_once_per_attempt(catalog: stub_server.Catalog) -> None:
+    """Test that throttled GETs are left to run_with_retries instead of waiting for Retry-After in the session."""
+    server = stub_server.StubServer(('127.0.0.1', 0), catalog, throttle_rate=1.0, retry_after=0)
+    stub_server.start_server(server)
+
+    try:
+        with mock.patch.object(myprotein, 'BASE_URL', server.base_url):
+            with pytest.raises(requests.HTTPError) as exc_info:
+                asyncio.run(myprotein.fetch_product_pages([next(iter(catalog.categories))], myprotein.ScrapeOptions(2)))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert '429 Client Error' in str(exc_info.value)
+    assert server.request_counts['GET'] == myprotein.MAX_ATTEMPTS
+
+
+def test_stalled_requests_time_out(catalog: stub_server.Catalog) -> None:
+    """Test that a stalled request fails with a Timeout that is retried, instead of blocking its worker."""
+    server = stub_server.StubServer(('127.0.0.1', 0), catalog, latency=stub_server.Latency(0.5))
+    stub_server.start_server(server)
+    category = next(iter(catalog.categories.values()))
+    job = myprotein.Job(category.product_category_id, category.flavours[0], category.sizes[0])
+
+    async def collect() -> List[myprotein.Resolution]:
+        return [i async for i in myprotein.resolve_jobs([job], session=myprotein.create_session(retries=0))]
+
+    try:
+        with mock.patch.object(myprotein, 'BASE_URL', server.base_url), mock.patch.object(
+            myprotein, 'REQUEST_TIMEOUT_SECONDS', (1.0, 0.05)
+        ), mock.patch.object(myprotein, 'RETRY_BACKOFF_SECONDS', 0), mock.patch.object(myprotein, 'MAX_ATTEMPTS', 2):
+            (resolution,) = asyncio.run(collect())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert isinstance(resolution.error, requests.Timeout)
+
+
+@pytest.mark.usefixtures('server')
+def test_product_page_not_modified(catalog: stub_server.Catalog, tmp_path: Any) -> None:
+    """Test that the product page supports conditional requests."""
+    product_category_id = next(iter(catalog.categories))
+    response_cache = myprotein.ResponseCache(str(tmp_path))
+    session = myprotein.create_session(retries=0)
+
+    first = myprotein.fetch_product_page(product_category_id, session, response_cache)
+    cached = response_cache.get(first.url)
+    assert cached and cached.etag
+    response = session.get(myprotein.product_page_url(product_category_id), headers={'If-None-Match': cached.etag})
+    second = myprotein.fetch_product_page(product_category_id, session, response_cache)
+    response_cache.close()
+
+    assert response.status_code == 304
+    assert second is first
+
+
+def test_discover_catalog(tmp_path: Any) -> None:
+    """Test that generated categories are discovered with their default product and can then be resolved."""
+    catalog = stub_server.Catalog(len(myprotein.PRODUCT_INFORMATION) + 1, num_flavours=2, num_sizes=2, seed=1)
+    product_category_id, category = list(catalog.categories.items())[-1]
+    server = stub_server.StubServer(('127.0.0.1', 0), catalog)
+    stub_server.start_server(server)
+    catalog_path = str(tmp_path / 'catalog.json')
+
+    try:
+        with mock.patch.object(myprotein, 'BASE_URL', server.base_url):
+            discovered = asyncio.run(myprotein.discover_catalog([product_category_id, 'unknown'], max_concurrency=2))
+            myprotein.Catalog(discovered).save(catalog_path)
+
+            with mock.patch.object(myprotein, 'CATALOG_PATH', catalog_path):
+                assert myprotein.get_product_information(category.name) == product_category_id
+                flavour, size = category.flavours[0], category.sizes[1]
+                product_id = myprotein.resolve_options_to_product_id(product_category_id, flavour, size)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert discovered == {
+        product_category_id: myprotein.ProductInformation(
+            category.name, category.flavours[0].name, category.sizes[0].name, 0.0, category.default_product_id
+        )
+    }
+    assert product_id == category.product_ids.get((flavour.id, size.id))
+
+
+def test_resolve_jobs_skips_sizes_not_sold(catalog: stub_server.Catalog, server: stub_server.StubServer) -> None:
+    """Test that sizes the variations markup doesn't list are not requested, without losing any variation."""
+    product_category_id, category = next(iter(catalog.categories.items()))
+    jobs = [myprotein.Job(product_category_id, i, j) for i in category.flavours for j in category.sizes]
+
+    async def collect() -> List[myprotein.Resolution]:
+        return [i async for i in myprotein.resolve_jobs(jobs, session=myprotein.create_session(retries=0))]
+
+    resolutions = asyncio.run(collect())
+
+    product_ids = {(i.job.flavour.id, i.job.size.id): i.product_id for i in resolutions if i.product_id}
+    assert product_ids == category.product_ids
+    # The first size of every flavour is requested first. When it's sold, its markup lists the other sizes sold in the
+    # flavour and only those are requested. Otherwise the site falls back to the default product, which tells nothing.
+    first_size_sold = [(i.id, category.sizes[0].id) in category.product_ids for i in category.flavours]
+    expected_posts = sum(
+        len(category.sizes_of(flavour.id)) if sold else len(category.sizes)
+        for flavour, sold in zip(category.flavours, first_size_sold)
+    )
+    assert expected_posts < len(jobs)
+    assert server.request_counts['POST'] == expected_posts
+    # The default product is only looked up when a fallback needs to be told apart
+    assert server.request_counts['GET'] == (0 if all(first_size_sold) else 1)
+
+
+def test_get_vouchers(server: stub_server.StubServer, tmp_path: Any) -> None:
+    """Test that vouchers are parsed into their code and discount, and cached."""
+    vouchers = myprotein.get_vouchers(str(tmp_path))
+    cached = myprotein.get_vouchers(str(tmp_path))
+    expired = myprotein.get_vouchers(str(tmp_path), ttl_seconds=0)
+    uncached = myprotein.get_vouchers()
+
+    assert len(vouchers) == 10
+    assert vouchers[0] == myprotein.Voucher('5% off everything', 'Use code: SAVE5\nEnds midnight.', 'SAVE5', 5.0)
+    assert cached == expired == uncached == vouchers
+    assert server.request_counts['GET'] == 3
+
+
+def test_get_vouchers_per_site(catalog: stub_server.Catalog, server: stub_server.StubServer, tmp_path: Any) -> None:
+    """Test that the vouchers of one site aren't served from the cache of another one."""
+    other_server = stub_server.StubServer(('127.0.0.1', 0), catalog)
+    stub_server.start_server(other_server)
+
+    try:
+        vouchers = myprotein.get_vouchers(str(tmp_path))
+        other_vouchers = myprotein.get_vouchers(str(tmp_path), base_url=other_server.base_url)
+        cached = myprotein.get_vouchers(str(tmp_path), base_url=other_server.base_url)
+    finally:
+        other_server.shutdown()
+        other_server.server_close()
+
+    assert vouchers == other_vouchers == cached
+    assert server.request_counts['GET'] == other_server.request_counts['GET'] == 1
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_resume_from_checkpoint(catalog: stub_server.Catalog, server: stub_server.StubServer, tmp_path: Any) -> None:
+    """Test that a resumed run yields the products of the checkpoint without resolving them again."""
+    product_category_ids = list(catalog.categories)
+    path = str(tmp_path / 'checkpoint.jsonl')
+
+    async def collect(checkpoint: myprotein.Checkpoint) -> List[myprotein.ProductInformation]:
+        products = myprotein.stream_product_information(product_category_ids, myprotein.ScrapeOptions(2, 2), checkpoint)
+        return [i async for i in products]
+
+    checkpoint = myprotein.Checkpoint(path)
+    products = asyncio.run(collect(checkpoint))
+    checkpoint.close()
+    posts = server.request_counts['POST']
+
+    resumed = asyncio.run(collect(myprotein.Checkpoint(path, resume=True)))
+
+    assert sorted(resumed, key=myprotein.product_sort_key) == sorted(products, key=myprotein.product_sort_key)
+    assert len(products) == sum(len(i.product_ids) for i in catalog.categories.values())
+    assert server.request_counts['POST'] == posts
+
+
+def test_regions(catalog: stub_server.Catalog) -> None:
+    """Test that every region is resolved on its own site, in one run."""
+    servers = [stub_server.StubServer(('127.0.0.1', 0), catalog) for _ in range(2)]
+    for server in servers:
+        stub_server.start_server(server)
+    regions = [myprotein.Region('us', servers[0].base_url, 'USD'), myprotein.Region('uk', servers[1].base_url, 'GBP')]
+
+    async def collect() -> List[myprotein.ProductInformation]:
+        products = myprotein.stream_product_information(
+            list(catalog.categories), myprotein.ScrapeOptions(4, 2, regions=regions)
+        )
+        return [i async for i in products]
+
+    try:
+        products = asyncio.run(collect())
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    by_region = {
+        region.code: sorted((replace(i, region='') for i in products if i.region == region.code), key=str)
+        for region in regions
+    }
+    assert len(by_region['us']) == sum(len(i.product_ids) for i in catalog.categories.values())
+    assert by_region['us'] == by_region['uk']
+    # Both sites are resolved alike, concurrent lookups of the default product share one GET
+    assert servers[0].request_counts == servers[1].request_counts
+    assert servers[0].request_counts['POST'] > 0
+
+
+@pytest.mark.parametrize('parse_workers', (0, 1))
+def test_regions_without_category(catalog: stub_server.Catalog, parse_workers: int, capsys: Any) -> None:
+    """Test that a category is skipped on the sites that don't have it, instead of aborting the run."""
+    # Same generated categories, without the last one
+    uk_catalog = stub_server.Catalog(num_categories=1, num_flavours=3, num_sizes=2, missing_ratio=0.5, seed=1)
+    servers = [stub_server.StubServer(('127.0.0.1', 0), i) for i in (catalog, uk_catalog)]
+    for server in servers:
+        stub_server.start_server(server)
+    regions = [myprotein.Region('us', servers[0].base_url, 'USD'), myprotein.Region('uk', servers[1].base_url, 'GBP')]
+    missing_category_id = list(catalog.categories)[-1]
+
+    async def collect() -> List[myprotein.ProductInformation]:
+        products = myprotein.stream_product_information(
+            list(catalog.categories), myprotein.ScrapeOptions(4, 2, parse_workers=parse_workers, regions=regions)
+        )
+        return [i async for i in products]
+
+    try:
+        products = asyncio.run(collect())
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    uk_skus = sorted(i.sku for i in products if i.region == 'uk')
+    assert len([i for i in products if i.region == 'us']) == sum(
+        len(i.product_ids) for i in catalog.categories.values()
+    )
+    assert uk_skus == sorted(j for i in uk_catalog.categories.values() for j in i.product_ids.values())
+    assert myprotein.product_page_url(missing_category_id, servers[1].base_url) in capsys.readouterr().out
+
+
+def test_fetch_product_pages_skip_missing_only_not_found(catalog: stub_server.Catalog) -> None:
+    """Test that skipping missing categories still raises other errors."""
+    server = stub_server.StubServer(('127.0.0.1', 0), catalog, error_rate=1.0)
+    stub_server.start_server(server)
+
+    try:
+        with mock.patch.object(myprotein, 'MAX_ATTEMPTS', 1), pytest.raises(requests.HTTPError):
+            asyncio.run(
+                myprotein.fetch_product_pages(
+                    list(catalog.categories), myprotein.ScrapeOptions(2), base_url=server.base_url, skip_missing=True
+                )
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.usefixtures('server')
+def test_query_products(catalog: stub_server.Catalog, capsys: Any) -> None:
+    """Test that querying as a library yields every product without printing anything."""
+    categories = [myprotein.get_catalog()[i].category for i in catalog.categories]
+
+    products = list(myprotein.query_products(categories, myprotein.ScrapeOptions(2, 2)))
+    first_product = next(myprotein.query_products(categories[:1]))
+
+    assert len(products) == sum(len(i.product_ids) for i in catalog.categories.values())
+    assert first_product in products
+    assert capsys.readouterr() == ('', '')
+
+
+def test_query_products_async(catalog: stub_server.Catalog, server: stub_server.StubServer, tmp_path: Any) -> None:
+    """Test that later queries in the same process reuse the cache instead of resolving again."""
+    categories = [myprotein.get_catalog()[i].category for i in catalog.categories]
+    sku_cache = myprotein.SkuCache(str(tmp_path))
+
+    async def collect() -> List[myprotein.ProductInformation]:
+        return [
+            i async for i in myprotein.query_products_async(categories, myprotein.ScrapeOptions(sku_cache=sku_cache))
+        ]
+
+    products = asyncio.run(collect())
+    posts = server.request_counts['POST']
+    cached = asyncio.run(collect())
+
+    assert sorted(cached, key=myprotein.product_sort_key) == sorted(products, key=myprotein.product_sort_key)
+    assert server.request_counts['POST'] == posts > 0
+
+
+class StopWatching(Exception):
+    pass
+
+
+@pytest.mark.usefixtures('server')
+def test_main_record_history(catalog: stub_server.Catalog, tmp_path: Any, capsys: Any) -> None:
+    """Test that every run of the command appends its prices to the history."""
+    categories = [myprotein.get_catalog()[i].category for i in catalog.categories]
+    history_dir = str(tmp_path / 'history')
+    argv = [
+        'myprotein.py',
+        '--record-history',
+        '--history-dir',
+        history_dir,
+        '--cache-dir',
+        str(tmp_path / 'cache'),
+        '--checkpoint',
+        str(tmp_path / 'checkpoint.jsonl'),
+        '--catalog',
+        str(tmp_path / 'catalog.json'),
+        *categories,
+    ]
+
+    with mock.patch.object(sys, 'argv', argv), mock.patch.object(myprotein, 'CATALOG_PATH'):
+        myprotein.main()
+        myprotein.main()
+
+    num_products = sum(len(i.product_ids) for i in catalog.categories.values())
+    assert len(myprotein.PriceHistory(history_dir)) == 2 * num_products
+    assert categories[0] in capsys.readouterr().out
+    # Only discovery writes the catalog, default products are kept in the sku cache
+    assert not (tmp_path / 'catalog.json').exists()
+
+
+def test_main_without_vouchers(
+    server: stub_server.StubServer, catalog: stub_server.Catalog, tmp_path: Any, capsys: Any
+) -> None:
+    """Test that the products are still written when the vouchers can't be fetched."""
+    categories = [myprotein.get_catalog()[i].category for i in catalog.categories]
+    argv = [
+        'myprotein.py',
+        '--vouchers',
+        '--cache-dir',
+        str(tmp_path / 'cache'),
+        '--checkpoint',
+        str(tmp_path / 'checkpoint.jsonl'),
+        '--catalog',
+        str(tmp_path / 'catalog.json'),
+        *categories,
+    ]
+
+    with mock.patch.object(sys, 'argv', argv), mock.patch.object(myprotein, 'CATALOG_PATH'), mock.patch.object(
+        myprotein, 'voucher_url', return_value=f'{server.base_url}/missing.list'
+    ):
+        myprotein.main()
+
+    output = capsys.readouterr()
+    assert categories[0] in output.out
+    assert 'Could not fetch vouchers' in output.err
+    assert '404' in output.err
+
+
+@pytest.mark.usefixtures('server')
+def test_watch_record_history(catalog: stub_server.Catalog, tmp_path: Any) -> None:
+    """Test that every poll of watch appends its prices to the history."""
+    history = myprotein.PriceHistory(str(tmp_path))
+    watcher = myprotein.PriceWatcher(list(catalog.categories), myprotein.ScrapeOptions(2, 2))
+    sleep = mock.AsyncMock(side_effect=[None, StopWatching])
+
+    with mock.patch('asyncio.sleep', sleep), pytest.raises(StopWatching):
+        asyncio.run(myprotein.watch(watcher, 60, history))
+
+    num_products = sum(len(i.product_ids) for i in catalog.categories.values())
+    assert len(history) == 2 * num_products
+    sleep.assert_called_with(60)
+
+
+@pytest.mark.usefixtures('server')
+def test_scrape_product_information(catalog: stub_server.Catalog) -> None:
+    """Test that every existing variation of every category is priced."""
+    options = myprotein.ScrapeOptions(2, 2)
+    products = asyncio.run(myprotein.scrape_product_information(list(catalog.categories), options))
+
+    prices = {j: k for i in catalog.categories.values() for j, k in i.prices.items()}
+    assert len(products) == sum(len(i.product_ids) for i in catalog.categories.values())
+    assert all(i.price == prices[i.sku] for i in products)
+
+
+@pytest.mark.usefixtures('server')
+@pytest.mark.parametrize('journaled', (False, True))
+def test_stream_skips_failed_variations(catalog: stub_server.Catalog, tmp_path: Any, journaled: bool) -> None:
+    """Test that variations that keep failing are skipped and journaled as failed, without losing the others."""
+    product_category_id, category = next(iter(catalog.categories.items()))
+    failing_flavour = category.flavours[1]
+    resolve = myprotein.resolve_options_to_product_id
+
+    def flaky_resolve(product_category_id: str, flavour: myprotein.Option, *args: Any) -> str:
+        if flavour == failing_flavour:
+            raise requests.ConnectionError()
+        return resolve(product_category_id, flavour, *args)
+
+    async def collect(checkpoint: Optional[myprotein.Checkpoint]) -> List[myprotein.ProductInformation]:
+        options = myprotein.ScrapeOptions(2, 2)
+        products = myprotein.stream_product_information([product_category_id], options, checkpoint)
+        return [i async for i in products]
+
+    checkpoint = myprotein.Checkpoint(str(tmp_path / 'checkpoint.jsonl'))
+    with mock.patch.object(myprotein, 'resolve_options_to_product_id', side_effect=flaky_resolve), mock.patch.object(
+        myprotein, 'MAX_ATTEMPTS', 1
+    ):
+        products = asyncio.run(collect(checkpoint if journaled else None))
+
+    expected = [j for (i, _), j in category.product_ids.items() if i != failing_flavour.id]
+    assert sorted(i.sku for i in products) == sorted(expected)
+    if journaled:
+        assert sorted(i.size for i in checkpoint.failed) == sorted(category.sizes)
+        assert {i.flavour for i in checkpoint.failed} == {failing_flavour}
+    else:
+        assert not checkpoint.failed
+
+
+def test_stream_without_price_data() -> None:
+    """Test that a product page without offers aborts the stream instead of silently pricing nothing."""
+    product_page = myprotein.ProductPage('https://example.com/product', [], [], None)
+
+    async def collect() -> List[myprotein.ProductInformation]:
+        products = myprotein.stream_product_information(['10530943'], myprotein.ScrapeOptions(2, 2), progress=False)
+        return [i async for i in products]
+
+    with mock.patch.object(myprotein, 'fetch_product_pages', mock.AsyncMock(return_value=[product_page])):
+        with pytest.raises(ValueError, match='https://example.com/product'):
+            asyncio.run(collect())
+
+
+def test_watch_prints_changes(catalog: stub_server.Catalog, server: stub_server.StubServer, capsys: Any) -> None:
+    """Test that watch prints every price first, then only the prices that changed."""
+    product_category_id, category = next(iter(catalog.categories.items()))
+    old_price = category.prices[category.default_product_id]
+    watcher = myprotein.PriceWatcher([product_category_id], myprotein.ScrapeOptions(2, 2))
+    sleeps: List[float] = []
+
+    async def change_price(interval: float) -> None:
+        if sleeps:
+            raise StopWatching()
+        sleeps.append(interval)
+        category.prices[category.default_product_id] = 1.23
+        server.product_pages[product_category_id] = stub_server.render_product_page(category)
+
+    with mock.patch('asyncio.sleep', change_price), pytest.raises(StopWatching):
+        asyncio.run(myprotein.watch(watcher, 60))
+
+    name = myprotein.get_catalog()[product_category_id].category
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 2 + len(category.product_ids) + 1
+    assert lines[-1] == f'{name} {category.flavours[0].name} {category.sizes[0].name}: {old_price:.2f} -> 1.23'
+    assert sleeps == [60]
+
+
+def test_watch_survives_failed_poll(catalog: stub_server.Catalog, server: stub_server.StubServer, capsys: Any) -> None:
+    """Test that a poll that still fails after its retries is reported, and the watch goes on with the next one."""
+    product_category_id = next(iter(catalog.categories))
+    watcher = myprotein.PriceWatcher([product_category_id], myprotein.ScrapeOptions(2, 2))
+    sleep = mock.AsyncMock(side_effect=[None, StopWatching])
+    server.error_rate = 1.0
+
+    async def recover(interval: float) -> None:
+        server.error_rate = 0.0
+        await sleep(interval)
+
+    with mock.patch('asyncio.sleep', recover), mock.patch.object(myprotein, 'MAX_ATTEMPTS', 1), pytest.raises(
+        StopWatching
+    ):
+        asyncio.run(myprotein.watch(watcher, 60))
+
+    output = capsys.readouterr()
+    assert 'Could not poll prices, trying again in 60 seconds... 500 Server Error' in output.err
+    assert len(output.out.splitlines()) == 2 + len(catalog.categories[product_category_id].product_ids)
+    assert sleep.await_count == 2